@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+# ##
+# Fake Docker Engine API server listening on a unix socket
+# Images are read from the state directory shared with the fake docker and packer
+# executables (one "<repository> <tag>" per line in the images file).
+# Containers and events are kept in memory.
+# Point machination to it with DOCKER_HOST=unix://<socket>.
+# ##
+
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+try:
+  import SocketServer as socketserver
+  from BaseHTTPServer import BaseHTTPRequestHandler
+  from urlparse import urlparse, parse_qs
+  from urllib import unquote
+except ImportError:
+  import socketserver
+  from http.server import BaseHTTPRequestHandler
+  from urllib.parse import urlparse, parse_qs, unquote
+
+# ##
+# In memory state of the fake daemon
+# ##
+class FakeDockerState:
+  _stateDir = None
+  _containers = None
+  _events = None
+  _condition = None
+
+  def __init__(self, stateDir):
+    self._stateDir = stateDir
+    self._containers = {}
+    self._events = []
+    self._condition = threading.Condition()
+
+  def getImages(self):
+    images = []
+    path = os.path.join(self._stateDir, "images")
+    if os.path.exists(path):
+      for line in open(path):
+        fields = line.split()
+        if len(fields) == 2:
+          images.append({"Id": "sha256:" + str(abs(hash(line))), "RepoTags": ["{0}:{1}".format(fields[0], fields[1])],
+                         "Size": 42 * 1024 * 1024, "Created": int(time.time())})
+    return images
+
+  def findImage(self, name):
+    if ":" not in name:
+      name += ":latest"
+    for i in self.getImages():
+      if name in i["RepoTags"] or name == i["Id"]:
+        return i
+    return None
+
+  def addImage(self, repository, tag):
+    path = os.path.join(self._stateDir, "images")
+    with self._condition:
+      lines = []
+      if os.path.exists(path):
+        lines = [l for l in open(path) if l.split() != [repository, tag]]
+      openedFile = open(path, "w")
+      openedFile.writelines(lines + ["{0} {1}\n".format(repository, tag)])
+      openedFile.close()
+
+  def removeImage(self, image):
+    path = os.path.join(self._stateDir, "images")
+    with self._condition:
+      lines = [l for l in open(path) if "{0}:{1}".format(*l.split()) not in image["RepoTags"]]
+      openedFile = open(path, "w")
+      openedFile.writelines(lines)
+      openedFile.close()
+
+  def getContainer(self, name):
+    name = name.lstrip("/")
+    with self._condition:
+      if name in self._containers.keys():
+        return self._containers[name]
+      for c in self._containers.values():
+        if c["Id"].startswith(name):
+          return c
+    return None
+
+  def setContainer(self, container):
+    with self._condition:
+      self._containers[container["Name"].lstrip("/")] = container
+
+  def removeContainer(self, container):
+    with self._condition:
+      del self._containers[container["Name"].lstrip("/")]
+
+  def getContainers(self):
+    with self._condition:
+      return list(self._containers.values())
+
+  def addEvent(self, status, container):
+    with self._condition:
+      self._events.append({"status": status, "id": container["Id"], "from": container["Config"]["Image"], "time": int(time.time())})
+      self._condition.notify_all()
+
+  def getEvents(self, since):
+    with self._condition:
+      return [e for e in self._events if e["time"] >= since]
+
+  def waitEvents(self, count, timeout):
+    with self._condition:
+      if len(self._events) <= count:
+        self._condition.wait(timeout)
+      return self._events[count:]
+
+# ##
+# Handler of the HTTP requests received on the socket
+# ##
+class FakeDockerHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, format, *args):
+    pass
+
+  def getState(self):
+    return self.server.state
+
+  def reply(self, status, data=None):
+    body = b""
+    if data != None:
+      body = json.dumps(data).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def readBody(self):
+    length = int(self.headers.get("Content-Length", 0) or 0)
+    if length == 0:
+      return {}
+    return json.loads(self.rfile.read(length).decode("utf-8"))
+
+  def route(self, method):
+    url = urlparse(self.path)
+    params = dict((k, v[0]) for (k, v) in parse_qs(url.query).items())
+    path = re.sub("^/v[0-9.]+", "", url.path)
+    for (m, regex, handler) in ROUTES:
+      match = re.match("^{0}$".format(regex), path)
+      if m == method and match != None:
+        return handler(self, params, *[unquote(g) for g in match.groups()])
+    return self.reply(404, {"message": "page not found"})
+
+  def do_GET(self):
+    self.route("GET")
+
+  def do_POST(self):
+    self.route("POST")
+
+  def do_DELETE(self):
+    self.route("DELETE")
+
+  # ##
+  # API endpoints
+  # ##
+  def ping(self, params):
+    self.send_response(200)
+    self.send_header("Content-Length", "2")
+    self.end_headers()
+    self.wfile.write(b"OK")
+
+  def version(self, params):
+    self.reply(200, {"Version": "1.4.1", "ApiVersion": "1.16"})
+
+  def listImages(self, params):
+    self.reply(200, self.getState().getImages())
+
+  def inspectImage(self, params, name):
+    image = self.getState().findImage(name)
+    if image == None:
+      return self.reply(404, {"message": "No such image: {0}".format(name)})
+    self.reply(200, image)
+
+  def removeImage(self, params, name):
+    image = self.getState().findImage(name)
+    if image == None:
+      return self.reply(404, {"message": "No such image: {0}".format(name)})
+    for c in self.getState().getContainers():
+      if c["Config"]["Image"] in image["RepoTags"] and params.get("force", "0") != "1":
+        return self.reply(409, {"message": "Conflict, image is used by container {0}".format(c["Id"])})
+    self.getState().removeImage(image)
+    self.reply(200, [{"Untagged": t} for t in image["RepoTags"]])
+
+  # ##
+  # The fake images share all their layers but the last one
+  # ##
+  def diskUsage(self, params):
+    images = self.getState().getImages()
+    shared = 40 * 1024 * 1024 if len(images) > 1 else 0
+    self.reply(200, {"LayersSize": sum([i["Size"] - shared for i in images]) + shared,
+                     "Images": [dict(i, SharedSize=shared) for i in images], "Containers": [], "Volumes": []})
+
+  def tagImage(self, params, name):
+    if self.getState().findImage(name) == None:
+      return self.reply(404, {"message": "No such image: {0}".format(name)})
+    self.getState().addImage(params["repo"], params.get("tag", "latest"))
+    self.reply(201)
+
+  def listContainers(self, params):
+    containers = []
+    for c in self.getState().getContainers():
+      if c["State"]["Running"] or params.get("all", "0") == "1":
+        containers.append({"Id": c["Id"], "Names": [c["Name"]], "Image": c["Config"]["Image"],
+                           "State": "running" if c["State"]["Running"] else "exited",
+                           "Labels": c["Config"].get("Labels", {})})
+    self.reply(200, containers)
+
+  def createContainer(self, params):
+    body = self.readBody()
+    name = params.get("name", "container{0}".format(len(self.getState().getContainers())))
+    if self.getState().getContainer(name) != None:
+      return self.reply(409, {"message": "Conflict, name '{0}' already in use".format(name)})
+    if self.getState().findImage(body.get("Image", "")) == None:
+      return self.reply(404, {"message": "No such image: {0}".format(body.get("Image"))})
+    container = {"Id": "%064x" % abs(hash(name + str(time.time()))), "Name": "/" + name, "Config": body,
+                 "HostConfig": body.get("HostConfig", {}),
+                 "State": {"Running": False, "Pid": 0, "StartedAt": "0001-01-01T00:00:00Z"},
+                 "NetworkSettings": {"IPAddress": ""}}
+    self.getState().setContainer(container)
+    self.getState().addEvent("create", container)
+    self.reply(201, {"Id": container["Id"], "Warnings": None})
+
+  def inspectContainer(self, params, name):
+    container = self.getState().getContainer(name)
+    if container == None:
+      return self.reply(404, {"message": "No such container: {0}".format(name)})
+    self.reply(200, container)
+
+  def startContainer(self, params, name):
+    container = self.getState().getContainer(name)
+    if container == None:
+      return self.reply(404, {"message": "No such container: {0}".format(name)})
+    if container["State"]["Running"]:
+      return self.reply(304)
+    container["State"] = {"Running": True, "Pid": os.getpid(),
+                          "StartedAt": time.strftime("%Y-%m-%dT%H:%M:%S.000000000Z", time.gmtime())}
+    container["NetworkSettings"]["IPAddress"] = "172.17.0.2"
+    self.getState().addEvent("start", container)
+    self.reply(204)
+
+  def stopContainer(self, params, name):
+    container = self.getState().getContainer(name)
+    if container == None:
+      return self.reply(404, {"message": "No such container: {0}".format(name)})
+    if not container["State"]["Running"]:
+      return self.reply(304)
+    container["State"] = {"Running": False, "Pid": 0, "StartedAt": container["State"]["StartedAt"]}
+    container["NetworkSettings"]["IPAddress"] = ""
+    self.getState().addEvent("die", container)
+    self.reply(204)
+
+  def renameContainer(self, params, name):
+    container = self.getState().getContainer(name)
+    if container == None:
+      return self.reply(404, {"message": "No such container: {0}".format(name)})
+    if self.getState().getContainer(params.get("name", "")) != None:
+      return self.reply(409, {"message": "Conflict, name '{0}' already in use".format(params.get("name"))})
+    self.getState().removeContainer(container)
+    container["Name"] = "/" + params["name"]
+    self.getState().setContainer(container)
+    self.getState().addEvent("rename", container)
+    self.reply(204)
+
+  def removeContainer(self, params, name):
+    container = self.getState().getContainer(name)
+    if container == None:
+      return self.reply(404, {"message": "No such container: {0}".format(name)})
+    if container["State"]["Running"] and params.get("force", "0") != "1":
+      return self.reply(409, {"message": "Conflict, container is running"})
+    self.getState().removeContainer(container)
+    self.getState().addEvent("destroy", container)
+    self.reply(204)
+
+  def events(self, params):
+    since = int(params.get("since", 0))
+    until = params.get("until", None)
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Transfer-Encoding", "chunked")
+    self.end_headers()
+    events = self.getState().getEvents(since)
+    count = len(self.getState().getEvents(0))
+    while True:
+      for e in events:
+        if until != None and e["time"] > int(until):
+          continue
+        data = json.dumps(e).encode("utf-8")
+        self.wfile.write("{0:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+      if until != None and time.time() >= int(until):
+        break
+      events = self.getState().waitEvents(count, 1.0)
+      count += len(events)
+    self.wfile.write(b"0\r\n\r\n")
+
+ROUTES = [
+  ("GET", "/_ping", FakeDockerHandler.ping),
+  ("GET", "/version", FakeDockerHandler.version),
+  ("GET", "/system/df", FakeDockerHandler.diskUsage),
+  ("GET", "/images/json", FakeDockerHandler.listImages),
+  ("GET", "/images/(.+)/json", FakeDockerHandler.inspectImage),
+  ("POST", "/images/(.+)/tag", FakeDockerHandler.tagImage),
+  ("DELETE", "/images/(.+)", FakeDockerHandler.removeImage),
+  ("GET", "/containers/json", FakeDockerHandler.listContainers),
+  ("POST", "/containers/create", FakeDockerHandler.createContainer),
+  ("GET", "/containers/([^/]+)/json", FakeDockerHandler.inspectContainer),
+  ("POST", "/containers/([^/]+)/start", FakeDockerHandler.startContainer),
+  ("POST", "/containers/([^/]+)/stop", FakeDockerHandler.stopContainer),
+  ("POST", "/containers/([^/]+)/rename", FakeDockerHandler.renameContainer),
+  ("DELETE", "/containers/([^/]+)", FakeDockerHandler.removeContainer),
+  ("GET", "/events", FakeDockerHandler.events),
+]
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+  state = None
+
+  def __init__(self, socketPath, stateDir):
+    if os.path.exists(socketPath):
+      os.remove(socketPath)
+    socketserver.UnixStreamServer.__init__(self, socketPath, FakeDockerHandler)
+    self.state = FakeDockerState(stateDir)
+
+  # ##
+  # Serve requests in a background thread
+  # ##
+  def startInBackground(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def main():
+  parser = argparse.ArgumentParser(description="Fake Docker Engine API server")
+  parser.add_argument("socket", help="Path of the unix socket to listen on", type=str)
+  parser.add_argument("--statedir", help="State directory shared with the fake executables", type=str,
+                      default=os.getenv("MACHINATION_SHIM_STATEDIR", "/tmp/machination-shims"))
+  args = parser.parse_args()
+  server = FakeDockerServer(args.socket, args.statedir)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    os.remove(args.socket)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
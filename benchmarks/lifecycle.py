@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+# ##
+# Lifecycle benchmark of machination
+# The docker, vagrant and packer executables are replaced by the fake ones stored
+# in the shims directory so that the benchmark can run on any Linux box.
+# Each instance goes through create -> start -> infos -> ssh -c -> stop -> destroy
+# and the time spent in machination itself (wall time minus time spent in the tools)
+# is reported for each phase.
+# ##
+
+import argparse
+import json
+import os
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+
+from fakedocker import FakeDockerServer
+
+BENCHMARKS_DIR = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
+SHIMS_DIR = os.path.join(BENCHMARKS_DIR, "shims")
+TEMPLATES_DIR = os.path.join(BENCHMARKS_DIR, "templates")
+MACHINATION_BIN = os.path.join(BENCHMARKS_DIR, "..", "src", "bin", "machination")
+
+PHASES = ["create", "start", "infos", "ssh", "stop", "destroy"]
+
+# ##
+# Class running the machination command line in a sandboxed environment
+# ##
+class LifecycleBenchmark:
+  _python = None
+  _workDir = None
+  _args = None
+
+  def __init__(self, python, workDir, args):
+    self._python = python
+    self._workDir = workDir
+    self._args = args
+
+  # ##
+  # Build the environment given to machination and to the shims
+  # ##
+  def getEnvironment(self, logFile):
+    env = dict(os.environ)
+    env["HOME"] = os.path.join(self._workDir, "home")
+    env["PATH"] = SHIMS_DIR + os.pathsep + env.get("PATH", "")
+    env["SUDO_USER"] = pwd.getpwuid(os.getuid()).pw_name
+    env["MACHINATION_SHIM_STATEDIR"] = os.path.join(self._workDir, "state")
+    env["MACHINATION_SHIM_LATENCY"] = str(self._args.latency)
+    env["MACHINATION_SHIM_OUTPUT_LINES"] = str(self._args.output_lines)
+    env["MACHINATION_SHIM_LOG"] = logFile
+    if self._args.docker_api:
+      env["DOCKER_HOST"] = "unix://" + os.path.join(self._workDir, "docker.sock")
+    else:
+      env["DOCKER_HOST"] = "unix://" + os.path.join(self._workDir, "missing.sock")
+    return env
+
+  def getArguments(self, phase, name):
+    arguments = {
+      "create": ["create", self._args.template, name, "--no-interactive",
+                 "--provider", self._args.provider, "--osversion", self._args.osversion],
+      "start": ["start", name],
+      "infos": ["infos", name],
+      "ssh": ["ssh", name, "-c", "true"],
+      "stop": ["stop", name],
+      "destroy": ["destroy", name, "--force"],
+    }
+    return arguments[phase]
+
+  # ##
+  # Run a single machination command and returns its timings
+  # ##
+  def run(self, phase, name):
+    logFile = os.path.join(self._workDir, "logs", "{0}-{1}.log".format(phase, name))
+    cmd = [self._python, MACHINATION_BIN] + self.getArguments(phase, name)
+    start = time.time()
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         env=self.getEnvironment(logFile))
+    out = p.communicate()[0]
+    wall = time.time() - start
+
+    toolTime = 0.0
+    toolCalls = 0
+    if os.path.exists(logFile):
+      for line in open(logFile):
+        fields = line.split()
+        if len(fields) == 4:
+          toolTime += float(fields[3]) - float(fields[2])
+          toolCalls += 1
+    if p.returncode != 0:
+      raise RuntimeError("'{0}' failed with code {1}:\n{2}".format(" ".join(cmd), p.returncode, out))
+    return {"wall": wall, "tools": toolTime, "calls": toolCalls}
+
+  # ##
+  # Run every phase for the given number of instances
+  # ##
+  def execute(self, count):
+    if os.path.exists(self._workDir):
+      shutil.rmtree(self._workDir)
+    for d in ["home", "state", "logs"]:
+      os.makedirs(os.path.join(self._workDir, d))
+    # The templates of the benchmarks are user templates of the sandboxed home
+    shutil.copytree(TEMPLATES_DIR, os.path.join(self._workDir, "home", ".machination", "templates"))
+
+    names = ["bench{0}".format(i) for i in range(0, count)]
+    pool = ThreadPool(self._args.jobs)
+    results = {}
+    server = None
+    if self._args.docker_api:
+      server = FakeDockerServer(os.path.join(self._workDir, "docker.sock"), os.path.join(self._workDir, "state"))
+      server.startInBackground()
+    try:
+      for phase in PHASES:
+        start = time.time()
+        timings = pool.map(lambda n: self.run(phase, n), names)
+        results[phase] = summarize(timings, time.time() - start)
+    finally:
+      pool.close()
+      pool.join()
+      if server != None:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def percentile(values, pct):
+  values = sorted(values)
+  idx = int(round((len(values) - 1) * pct))
+  return values[idx]
+
+def summarize(timings, elapsed):
+  walls = [t["wall"] for t in timings]
+  overheads = [t["wall"] - t["tools"] for t in timings]
+  return {
+    "count": len(timings),
+    "wall_mean": sum(walls) / len(walls),
+    "wall_p50": percentile(walls, 0.5),
+    "wall_max": max(walls),
+    "overhead_mean": sum(overheads) / len(overheads),
+    "overhead_max": max(overheads),
+    "tool_calls": sum(t["calls"] for t in timings),
+    "throughput": len(timings) / elapsed if elapsed > 0 else 0.0,
+  }
+
+def display(count, results):
+  print("Instances: {0}".format(count))
+  print("Phase".ljust(10) + "Mean(s)".ljust(10) + "P50(s)".ljust(10) + "Max(s)".ljust(10) +
+        "Overhead(s)".ljust(13) + "Tool calls".ljust(12) + "Ops/s")
+  for phase in PHASES:
+    r = results[phase]
+    print(phase.ljust(10) +
+          "{0:.3f}".format(r["wall_mean"]).ljust(10) +
+          "{0:.3f}".format(r["wall_p50"]).ljust(10) +
+          "{0:.3f}".format(r["wall_max"]).ljust(10) +
+          "{0:.3f}".format(r["overhead_mean"]).ljust(13) +
+          str(r["tool_calls"]).ljust(12) +
+          "{0:.2f}".format(r["throughput"]))
+  print("")
+
+def main():
+  parser = argparse.ArgumentParser(description="Machination lifecycle benchmark using fake docker/vagrant/packer executables")
+  parser.add_argument("--instances", "-n", help="Comma separated list of instance counts to benchmark", type=str, default="1,5,10")
+  parser.add_argument("--jobs", "-j", help="Number of machination commands executed concurrently", type=int, default=1)
+  parser.add_argument("--latency", "-l", help="Latency of each fake tool call in seconds", type=float, default=0.0)
+  parser.add_argument("--output-lines", help="Number of lines printed by each fake tool call", type=int, default=0)
+  parser.add_argument("--template", "-t", help="Template used to create the instances", type=str, default="benchbox:1.0")
+  parser.add_argument("--provider", "-p", help="Provider used to create the instances", type=str, default="docker")
+  parser.add_argument("--osversion", "-o", help="OS version used to create the instances", type=str, default="trusty")
+  parser.add_argument("--python", help="Python interpreter used to run machination", type=str, default=sys.executable)
+  parser.add_argument("--no-docker-api", help="Do not serve the fake docker engine API, machination falls back to the docker executable",
+                      dest="docker_api", action="store_false")
+  parser.add_argument("--json", help="Write the results in the given file", type=str)
+  parser.add_argument("--max-overhead", help="Fail if the mean overhead of a phase exceeds this value in seconds", type=float)
+  parser.add_argument("--keep", help="Keep the working directory", action="store_true")
+  args = parser.parse_args()
+
+  workDir = tempfile.mkdtemp(prefix="machination-bench-")
+  benchmark = LifecycleBenchmark(args.python, workDir, args)
+  allResults = {}
+  res = 0
+  try:
+    for count in [int(c) for c in args.instances.split(",")]:
+      results = benchmark.execute(count)
+      allResults[str(count)] = results
+      display(count, results)
+      if args.max_overhead != None:
+        for phase in PHASES:
+          if results[phase]["overhead_mean"] > args.max_overhead:
+            print("Phase '{0}' exceeds the maximum overhead for {1} instances: {2:.3f}s > {3:.3f}s".format(
+                  phase, count, results[phase]["overhead_mean"], args.max_overhead))
+            res = 1
+  finally:
+    if not args.keep:
+      shutil.rmtree(workDir, True)
+
+  if args.json != None:
+    with open(args.json, "w") as f:
+      json.dump(allResults, f, indent=2)
+  return res
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+# ##
+# Shared folders benchmark of machination
+# A container is started for each shared folder mode with the folder given the way the
+# docker provider gives it, then small files and a large file are read and written in it.
+# The copy of the folder made when a container of the rsync and tmpfs modes is started is
+# reported as the sync time.
+# This benchmark needs a working docker engine.
+# ##
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+MODES = ["bind", "cached", "delegated", "rsync", "tmpfs"]
+WORKLOADS = ["small_read", "small_write", "large_read", "large_write"]
+GUEST_DIR = "/bench"
+CONTAINER_PREFIX = "machination-bench-folders-"
+
+def docker(args, stdin=None):
+  p = subprocess.Popen(["docker"] + args, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  (out, err) = p.communicate()
+  if p.returncode != 0:
+    raise RuntimeError("'docker {0}' failed with code {1}: {2}".format(" ".join(args), p.returncode, err))
+  return out
+
+# ##
+# Class running the workloads in a container for each mode
+# ##
+class SharedFoldersBenchmark:
+  _workDir = None
+  _args = None
+
+  def __init__(self, workDir, args):
+    self._workDir = workDir
+    self._args = args
+
+  def getHostDir(self):
+    return os.path.join(self._workDir, "folder")
+
+  # ##
+  # Fill the host folder with the small files and the large file read by the workloads
+  # ##
+  def prepare(self):
+    smallDir = os.path.join(self.getHostDir(), "small")
+    os.makedirs(smallDir)
+    data = b"x" * self._args.small_size
+    for i in range(0, self._args.small_files):
+      with open(os.path.join(smallDir, "file{0}".format(i)), "wb") as f:
+        f.write(data)
+    block = b"x" * (1024 * 1024)
+    with open(os.path.join(self.getHostDir(), "large"), "wb") as f:
+      for i in range(0, self._args.large_size):
+        f.write(block)
+
+  # ##
+  # Arguments given to docker run for the folder, as the docker provider does for each mode
+  # ##
+  def getRunArguments(self, mode):
+    if mode == "bind":
+      return ["-v", "{0}:{1}".format(self.getHostDir(), GUEST_DIR)]
+    if mode in ["cached", "delegated"]:
+      return ["-v", "{0}:{1}:{2}".format(self.getHostDir(), GUEST_DIR, mode)]
+    if mode == "tmpfs":
+      return ["--tmpfs", "{0}:exec".format(GUEST_DIR)]
+    return []
+
+  # ##
+  # Copy the host folder in the container, returns the time spent
+  # ##
+  def sync(self, name):
+    start = time.time()
+    tar = subprocess.Popen(["tar", "-C", self.getHostDir(), "-cf", "-", "."], stdout=subprocess.PIPE)
+    try:
+      docker(["exec", "-i", name, "sh", "-c", "mkdir -p {0} && tar -C {0} -xf -".format(GUEST_DIR)], stdin=tar.stdout)
+    finally:
+      tar.stdout.close()
+      tar.wait()
+    return time.time() - start
+
+  def execute(self, name, command):
+    start = time.time()
+    docker(["exec", name, "sh", "-c", command])
+    return time.time() - start
+
+  # ##
+  # Run the workloads in a container of the given mode
+  # The time of an empty command is subtracted so that only the file operations are measured
+  # ##
+  def run(self, mode):
+    name = CONTAINER_PREFIX + mode
+    subprocess.call(["docker", "rm", "-f", name], stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    docker(["run", "-d", "--name", name] + self.getRunArguments(mode) + [self._args.image, "sleep", "86400"])
+    try:
+      syncTime = 0.0
+      if mode in ["rsync", "tmpfs"]:
+        syncTime = self.sync(name)
+      commands = {
+        "small_read": "cat {0}/small/* > /dev/null".format(GUEST_DIR),
+        "small_write": "mkdir -p {0}/out && for i in $(seq 1 {1}); do head -c {2} {0}/large > {0}/out/file$i; done".format(
+                       GUEST_DIR, self._args.small_files, self._args.small_size),
+        "large_read": "cat {0}/large > /dev/null".format(GUEST_DIR),
+        "large_write": "dd if=/dev/zero of={0}/out.large bs=1048576 count={1} conv=fsync 2> /dev/null".format(
+                       GUEST_DIR, self._args.large_size),
+      }
+      results = {"sync": syncTime}
+      for workload in WORKLOADS:
+        timings = []
+        for i in range(0, self._args.repeat):
+          baseline = self.execute(name, "true")
+          timings.append(max(0.0, self.execute(name, commands[workload]) - baseline))
+          self.execute(name, "rm -rf {0}/out {0}/out.large".format(GUEST_DIR))
+        results[workload] = min(timings)
+      return results
+    finally:
+      docker(["rm", "-f", name])
+
+  def getThroughputs(self, results):
+    def rate(amount, duration):
+      if duration <= 0:
+        return float("inf")
+      return amount / duration
+    return {
+      "sync": results["sync"],
+      "small_read": rate(self._args.small_files, results["small_read"]),
+      "small_write": rate(self._args.small_files, results["small_write"]),
+      "large_read": rate(self._args.large_size, results["large_read"]),
+      "large_write": rate(self._args.large_size, results["large_write"]),
+    }
+
+def display(args, throughputs):
+  print("Small files: {0} x {1} bytes, large file: {2} MiB".format(args.small_files, args.small_size, args.large_size))
+  print("Mode".ljust(11) + "Sync(s)".ljust(10) + "Small read(files/s)".ljust(21) + "Small write(files/s)".ljust(22) +
+        "Large read(MiB/s)".ljust(19) + "Large write(MiB/s)")
+  for mode in [m for m in MODES if m in throughputs.keys()]:
+    t = throughputs[mode]
+    print(mode.ljust(11) +
+          "{0:.3f}".format(t["sync"]).ljust(10) +
+          "{0:.0f}".format(t["small_read"]).ljust(21) +
+          "{0:.0f}".format(t["small_write"]).ljust(22) +
+          "{0:.1f}".format(t["large_read"]).ljust(19) +
+          "{0:.1f}".format(t["large_write"]))
+  print("")
+
+def main():
+  parser = argparse.ArgumentParser(description="Machination shared folders benchmark comparing the folder modes with docker")
+  parser.add_argument("--modes", "-m", help="Comma separated list of modes to benchmark", type=str, default=",".join(MODES))
+  parser.add_argument("--image", "-i", help="Image of the containers", type=str, default="busybox")
+  parser.add_argument("--small-files", help="Number of small files read and written", type=int, default=2000)
+  parser.add_argument("--small-size", help="Size of the small files in bytes", type=int, default=4096)
+  parser.add_argument("--large-size", help="Size of the large file in MiB", type=int, default=256)
+  parser.add_argument("--repeat", "-r", help="Number of runs of each workload, the fastest one is kept", type=int, default=3)
+  parser.add_argument("--json", help="Write the results in the given file", type=str)
+  parser.add_argument("--keep", help="Keep the working directory", action="store_true")
+  args = parser.parse_args()
+
+  modes = args.modes.split(",")
+  for m in modes:
+    if m not in MODES:
+      parser.error("Unknown mode '{0}', supported modes are {1}".format(m, ",".join(MODES)))
+
+  workDir = tempfile.mkdtemp(prefix="machination-bench-")
+  benchmark = SharedFoldersBenchmark(workDir, args)
+  throughputs = {}
+  try:
+    benchmark.prepare()
+    for mode in modes:
+      throughputs[mode] = benchmark.getThroughputs(benchmark.run(mode))
+    display(args, throughputs)
+  finally:
+    if not args.keep:
+      shutil.rmtree(workDir, True)
+
+  if args.json != None:
+    with open(args.json, "w") as f:
+      json.dump(throughputs, f, indent=2)
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
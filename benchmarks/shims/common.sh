@@ -0,0 +1,52 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+# Helpers shared by the fake docker, vagrant and packer executables.
+# Behaviour is driven by the following environment variables:
+#   MACHINATION_SHIM_STATEDIR          directory holding the fake host state
+#   MACHINATION_SHIM_LOG               file receiving one timing line per call
+#   MACHINATION_SHIM_LATENCY           default latency of each call (seconds)
+#   MACHINATION_SHIM_<TOOL>_LATENCY    latency override for a given tool
+#   MACHINATION_SHIM_OUTPUT_LINES      number of filler lines printed per call
+
+SHIM_TOOL=$(basename "$0")
+SHIM_START=$(date +%s.%N)
+SHIM_STATEDIR=${MACHINATION_SHIM_STATEDIR:-/tmp/machination-shims}
+mkdir -p "$SHIM_STATEDIR"
+
+shim_latency() {
+  eval "lat=\${MACHINATION_SHIM_$(echo "$SHIM_TOOL" | tr 'a-z' 'A-Z')_LATENCY:-}"
+  if [ -z "$lat" ]; then
+    lat=${MACHINATION_SHIM_LATENCY:-0}
+  fi
+  if [ "$lat" != "0" ]; then
+    sleep "$lat"
+  fi
+  i=0
+  while [ $i -lt "${MACHINATION_SHIM_OUTPUT_LINES:-0}" ]; do
+    echo "==> $SHIM_TOOL: fake output line $i"
+    i=$((i+1))
+  done
+}
+
+shim_exit() {
+  if [ -n "$MACHINATION_SHIM_LOG" ]; then
+    echo "$SHIM_TOOL $1 $SHIM_START $(date +%s.%N)" >> "$MACHINATION_SHIM_LOG"
+  fi
+  exit 0
+}
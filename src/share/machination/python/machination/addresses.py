@@ -0,0 +1,338 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import re
+import json
+import fcntl
+import base64
+import socket
+import struct
+import traceback
+
+from machination.exceptions import AddressAllocationException
+from machination.helpers import mkdir_p
+from machination.helpers import randomMAC
+from machination.loggers import CORELOGGER
+
+ADDRESSES_INDEX_VERSION = 1
+AUTO = "auto"
+# Prefix length of the static addresses of the guests outside of the subnets of the pools
+DEFAULT_ADDRESS_PREFIX = 24
+
+def ipToInt(ipAddr):
+  return struct.unpack("!I", socket.inet_aton(ipAddr))[0]
+
+def intToIP(value):
+  return socket.inet_ntoa(struct.pack("!I", value))
+
+def normalizeMAC(macAddr):
+  return re.sub("[\.-]", ":", macAddr).lower()
+
+# ##
+# Range of IPv4 addresses given to the guests of one host interface
+# Ranges are either a subnet, whose network, gateway (first host) and broadcast addresses are
+# skipped, or an inclusive range of addresses:
+#   address_pools:
+#     eth0: 192.168.1.0/24
+#     br0: 10.0.0.10-10.0.0.200
+# Used addresses are tracked in a bitmap, allocation looks for a free bit from the position
+# following the last allocated address so that it does not scan the addresses already given.
+# ##
+class AddressPool:
+  _range = None
+  _first = 0
+  _size = 0
+  _bitmap = None
+  _next = 0
+
+  def __init__(self, addressRange, bitmap=None, nextIndex=0):
+    self._range = addressRange
+    (self._first, self._size) = AddressPool.parseRange(addressRange)
+    self._bitmap = bytearray((self._size + 7) // 8)
+    if bitmap != None and len(bitmap) == len(self._bitmap):
+      self._bitmap = bytearray(bitmap)
+    self._next = nextIndex % self._size
+
+  @staticmethod
+  def parseRange(addressRange):
+    try:
+      match = re.match("^([0-9.]+)/([0-9]+)$", addressRange)
+      if match != None:
+        prefix = int(match.group(2))
+        if prefix > 29:
+          raise ValueError("subnet is too small")
+        network = ipToInt(match.group(1)) & (0xffffffff << (32 - prefix)) & 0xffffffff
+        return (network + 2, (1 << (32 - prefix)) - 3)
+      match = re.match("^([0-9.]+)-([0-9.]+)$", addressRange)
+      if match != None:
+        first = ipToInt(match.group(1))
+        last = ipToInt(match.group(2))
+        if last >= first:
+          return (first, last - first + 1)
+    except (socket.error, ValueError) as e:
+      raise AddressAllocationException("Invalid address range '{0}': {1}".format(addressRange, str(e)))
+    raise AddressAllocationException("Invalid address range '{0}'".format(addressRange))
+
+  # ##
+  # Prefix length of the network of the guests given addresses of the range
+  # A range of addresses is in the network of the default prefix length, widened until it holds the whole range
+  # ##
+  @staticmethod
+  def getRangePrefix(addressRange):
+    match = re.match("^([0-9.]+)/([0-9]+)$", addressRange)
+    if match != None:
+      return int(match.group(2))
+    (first, size) = AddressPool.parseRange(addressRange)
+    prefix = DEFAULT_ADDRESS_PREFIX
+    while prefix > 0 and (first >> (32 - prefix)) != ((first + size - 1) >> (32 - prefix)):
+      prefix -= 1
+    return prefix
+
+  def getRange(self):
+    return self._range
+
+  def getIndex(self, ipAddr):
+    index = ipToInt(ipAddr) - self._first
+    if index < 0 or index >= self._size:
+      return None
+    return index
+
+  def isUsed(self, index):
+    return self._bitmap[index >> 3] & (1 << (index & 7)) != 0
+
+  def reserve(self, ipAddr):
+    index = self.getIndex(ipAddr)
+    if index != None:
+      self._bitmap[index >> 3] |= 1 << (index & 7)
+
+  def release(self, ipAddr):
+    index = self.getIndex(ipAddr)
+    if index != None:
+      self._bitmap[index >> 3] &= ~(1 << (index & 7)) & 0xff
+
+  def allocate(self):
+    index = self._next
+    for i in range(0, self._size):
+      # Full bytes are skipped at once
+      if index & 7 == 0 and self._bitmap[index >> 3] == 0xff and index + 8 <= self._size:
+        index = (index + 8) % self._size
+        continue
+      if not self.isUsed(index):
+        self._bitmap[index >> 3] |= 1 << (index & 7)
+        self._next = (index + 1) % self._size
+        return intToIP(self._first + index)
+      index = (index + 1) % self._size
+    return None
+
+  def toDict(self):
+    return {"range": self._range, "next": self._next,
+            "bitmap": base64.b64encode(bytes(self._bitmap)).decode("ascii")}
+
+  @staticmethod
+  def fromDict(values):
+    return AddressPool(values["range"], base64.b64decode(values["bitmap"]), values.get("next", 0))
+
+# ##
+# Class giving IP and MAC addresses to the guest interfaces
+# The addresses of every instance are recorded in a persistent index, built from the
+# configuration of the instances the first time it is needed. The index is locked while
+# it is modified and replaced atomically.
+# ##
+class AddressAllocator:
+  _path = None
+  _settings = None
+  _registry = None
+  _instancesDir = None
+
+  def __init__(self, path, settings, registry, instancesDir):
+    self._path = path
+    self._settings = settings
+    self._registry = registry
+    self._instancesDir = instancesDir
+
+  def getPath(self):
+    return self._path
+
+  # ##
+  # Address ranges declared in the settings by host interface
+  # ##
+  def getRanges(self):
+    ranges = self._settings.get("address_pools", {}) or {}
+    if type(ranges) is not dict:
+      CORELOGGER.warning("address_pools must be a mapping of host interfaces to address ranges, it is ignored")
+      return {}
+    return dict((str(k), str(v)) for (k, v) in ranges.items())
+
+  def hasPool(self, hostInterface):
+    return hostInterface in self.getRanges().keys()
+
+  # ##
+  # Prefix length of the static addresses of the guests attached to the host interface
+  # ##
+  def getPrefix(self, hostInterface):
+    ranges = self.getRanges()
+    if hostInterface in ranges.keys():
+      return AddressPool.getRangePrefix(ranges[hostInterface])
+    return DEFAULT_ADDRESS_PREFIX
+
+  def load(self):
+    try:
+      openedFile = open(self._path, "r")
+      values = json.load(openedFile)
+      openedFile.close()
+      if type(values) is dict and values.get("version", None) == ADDRESSES_INDEX_VERSION:
+        return values
+    except (IOError, ValueError):
+      pass
+    return None
+
+  # ##
+  # Build the index from the configuration of the existing instances
+  # ##
+  def build(self):
+    instances = {}
+    for (name, instance) in self._registry.getInstances().items():
+      try:
+        instances[name] = [[i.getHostInterface(), i.getIPAddr(), normalizeMAC(i.getMACAddr())] for i in instance.getGuestInterfaces()]
+      except Exception as e:
+        CORELOGGER.warning("Addresses of instance '{0}' are not indexed: {1}".format(name, str(e)))
+        CORELOGGER.debug(traceback.format_exc())
+    CORELOGGER.debug("Addresses index built from {0} instance(s).".format(len(instances)))
+    return {"version": ADDRESSES_INDEX_VERSION, "pools": {}, "instances": instances}
+
+  # ##
+  # Returns the pools of the index, a pool whose range changed in the settings is rebuilt
+  # ##
+  def getPools(self, index):
+    pools = {}
+    for (hostInterface, addressRange) in self.getRanges().items():
+      stored = index["pools"].get(hostInterface, None)
+      if stored != None and stored.get("range", None) == addressRange:
+        pools[hostInterface] = AddressPool.fromDict(stored)
+      else:
+        pool = AddressPool(addressRange)
+        for entries in index["instances"].values():
+          for (i, ipAddr, macAddr) in entries:
+            if i == hostInterface and ipAddr != "dhcp":
+              pool.reserve(ipAddr)
+        pools[hostInterface] = pool
+    return pools
+
+  # ##
+  # Apply a modification to the index
+  # ##
+  def modify(self, function):
+    mkdir_p(os.path.dirname(self._path))
+    lockFile = open(self._path + ".lock", "w")
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    try:
+      index = self.load()
+      if index == None:
+        index = self.build()
+      pools = self.getPools(index)
+      result = function(index, pools)
+      index["pools"] = dict((k, p.toDict()) for (k, p) in pools.items())
+      tmpPath = "{0}.{1}".format(self._path, os.getpid())
+      openedFile = open(tmpPath, "w")
+      json.dump(index, openedFile)
+      openedFile.close()
+      os.rename(tmpPath, self._path)
+      return result
+    finally:
+      fcntl.flock(lockFile, fcntl.LOCK_UN)
+      lockFile.close()
+
+  @staticmethod
+  def releaseEntries(index, pools, name):
+    for (hostInterface, ipAddr, macAddr) in index["instances"].pop(name, []):
+      if hostInterface in pools.keys() and ipAddr != "dhcp":
+        pools[hostInterface].release(ipAddr)
+
+  # ##
+  # Forget the instances whose directory does not exist anymore
+  # ##
+  def prune(self, index, pools):
+    pruned = 0
+    for name in list(index["instances"].keys()):
+      if not os.path.exists(os.path.join(self._instancesDir, name)):
+        AddressAllocator.releaseEntries(index, pools, name)
+        pruned += 1
+    return pruned
+
+  # ##
+  # Give addresses to the interfaces of an instance
+  # Interfaces are given as (host interface, IP address, MAC address) where addresses can be "auto".
+  # Addresses previously given to the instance are released first, explicit addresses are
+  # checked against the ones of the other instances.
+  # Returns the interfaces with their addresses
+  # ##
+  def allocate(self, name, interfaces):
+    def update(index, pools):
+      AddressAllocator.releaseEntries(index, pools, name)
+      usedIPs = {}
+      usedMACs = {}
+      for (instanceName, entries) in index["instances"].items():
+        for (hostInterface, ipAddr, macAddr) in entries:
+          if ipAddr != "dhcp":
+            usedIPs[ipAddr] = instanceName
+          usedMACs[macAddr] = instanceName
+      # Addresses of instances removed without being destroyed are given back when they are requested again
+      def isUsed(used, value):
+        if value not in used.keys():
+          return False
+        if os.path.exists(os.path.join(self._instancesDir, used[value])):
+          return True
+        AddressAllocator.releaseEntries(index, pools, used[value])
+        return False
+      result = []
+      for (hostInterface, ipAddr, macAddr) in interfaces:
+        if ipAddr == AUTO:
+          if hostInterface not in pools.keys():
+            raise AddressAllocationException("No address pool is declared for host interface '{0}' in the settings".format(hostInterface))
+          ipAddr = pools[hostInterface].allocate()
+          if ipAddr == None and self.prune(index, pools) != 0:
+            ipAddr = pools[hostInterface].allocate()
+          if ipAddr == None:
+            raise AddressAllocationException("Address pool '{0}' of host interface '{1}' is exhausted".format(pools[hostInterface].getRange(), hostInterface))
+        elif ipAddr != "dhcp":
+          if isUsed(usedIPs, ipAddr):
+            raise AddressAllocationException("IP address {0} is already used by instance '{1}'".format(ipAddr, usedIPs[ipAddr]))
+          if hostInterface in pools.keys():
+            pools[hostInterface].reserve(ipAddr)
+        if macAddr == AUTO or macAddr == None:
+          macAddr = randomMAC()
+          while macAddr in usedMACs.keys():
+            macAddr = randomMAC()
+        elif isUsed(usedMACs, normalizeMAC(macAddr)):
+          raise AddressAllocationException("MAC address {0} is already used by instance '{1}'".format(macAddr, usedMACs[normalizeMAC(macAddr)]))
+        if ipAddr != "dhcp":
+          usedIPs[ipAddr] = name
+        usedMACs[normalizeMAC(macAddr)] = name
+        result.append((hostInterface, ipAddr, macAddr))
+      index["instances"][name] = [[h, i, normalizeMAC(m)] for (h, i, m) in result]
+      return result
+    return self.modify(update)
+
+  # ##
+  # Return the addresses of an instance to the pools
+  # ##
+  def release(self, name):
+    def update(index, pools):
+      AddressAllocator.releaseEntries(index, pools, name)
+    self.modify(update)
@@ -0,0 +1,254 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import subprocess
+import traceback
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+from machination.exceptions import InvalidImageBundleException
+from machination.helpers import mkdir_p
+from machination.loggers import CORELOGGER
+
+BUNDLE_FORMAT = 1
+BUNDLE_MANIFEST_NAME = "manifest.json"
+BUNDLE_CHUNKS_DIR = "chunks"
+
+# Bounds of the content defined chunks
+CHUNK_MIN_SIZE = 256 * 1024
+CHUNK_MAX_SIZE = 8 * 1024 * 1024
+# Boundaries are looked for after each newline byte, the window of bytes ending with it is hashed
+# and a boundary is cut when the low bits of its hash are zero (1 in 4096 candidates on average)
+CHUNK_ANCHOR = b"\n"
+CHUNK_WINDOW_SIZE = 32
+CHUNK_BOUNDARY_MASK = (1 << 12) - 1
+
+# ##
+# Split a stream into content defined chunks
+# Boundaries only depend on the bytes around them so that a change in the stream only changes the chunks around it.
+# Candidates are searched with bytearray.find so that the stream is not scanned byte per byte in python.
+# ##
+def splitStream(stream, blockSize=1024 * 1024):
+  buf = bytearray()
+  start = 0
+  pos = 0
+  while True:
+    data = stream.read(blockSize)
+    if not data:
+      break
+    buf.extend(data)
+    end = len(buf)
+    while True:
+      searchFrom = max(pos, start + CHUNK_MIN_SIZE)
+      limit = min(end, start + CHUNK_MAX_SIZE)
+      idx = -1
+      if searchFrom < limit:
+        idx = buf.find(CHUNK_ANCHOR, searchFrom, limit)
+      if idx == -1:
+        if end - start >= CHUNK_MAX_SIZE:
+          yield bytes(buf[start:start + CHUNK_MAX_SIZE])
+          start += CHUNK_MAX_SIZE
+          pos = start
+          continue
+        pos = max(pos, limit)
+        break
+      pos = idx + 1
+      if zlib.crc32(bytes(buf[pos - CHUNK_WINDOW_SIZE:pos])) & CHUNK_BOUNDARY_MASK == 0:
+        yield bytes(buf[start:pos])
+        start = pos
+    del buf[:start]
+    pos -= start
+    start = 0
+  if len(buf) != 0:
+    yield bytes(buf)
+
+# ##
+# Compression of the chunks, zstd is used when the zstandard module is available
+# ##
+def getDefaultCompression():
+  if zstandard != None:
+    return "zstd"
+  return "zlib"
+
+def compress(data, compression):
+  if compression == "zstd":
+    return zstandard.ZstdCompressor(level=3).compress(data)
+  return zlib.compress(data, 6)
+
+def decompress(data, compression):
+  if compression == "zstd":
+    if zstandard == None:
+      raise InvalidImageBundleException("The bundle is compressed with zstd but the zstandard python module is not available")
+    return zstandard.ZstdDecompressor().decompress(data)
+  return zlib.decompress(data)
+
+# ##
+# Directory of compressed chunks named after the SHA-256 of their content
+# ##
+class ChunkStore:
+  _path = None
+  _compression = None
+
+  def __init__(self, path, compression):
+    self._path = path
+    self._compression = compression
+
+  def getChunkPath(self, digest):
+    return os.path.join(self._path, digest[0:2], "{0}.{1}".format(digest, self._compression))
+
+  def has(self, digest):
+    return os.path.exists(self.getChunkPath(digest))
+
+  # ##
+  # Store an already compressed chunk, the file is written atomically
+  # ##
+  def putCompressed(self, digest, data):
+    path = self.getChunkPath(digest)
+    mkdir_p(os.path.dirname(path))
+    tmpPath = "{0}.{1}".format(path, os.getpid())
+    openedFile = open(tmpPath, "wb")
+    openedFile.write(data)
+    openedFile.close()
+    os.rename(tmpPath, path)
+
+  def getCompressed(self, digest):
+    openedFile = open(self.getChunkPath(digest), "rb")
+    data = openedFile.read()
+    openedFile.close()
+    return data
+
+  def get(self, digest):
+    data = decompress(self.getCompressed(digest), self._compression)
+    if hashlib.sha256(data).hexdigest() != digest:
+      raise InvalidImageBundleException("Chunk '{0}' is corrupted".format(digest))
+    return data
+
+# ##
+# Class exporting and importing machination images as bundles
+# A bundle is a directory holding a manifest and the chunks of the saved image. Exporting
+# into an existing bundle only writes the chunks that changed, importing only copies the
+# chunks missing from the local chunk store.
+# ##
+class ImageBundle:
+  _path = None
+
+  def __init__(self, path):
+    self._path = path
+
+  def getManifestPath(self):
+    return os.path.join(self._path, BUNDLE_MANIFEST_NAME)
+
+  def getManifest(self):
+    try:
+      openedFile = open(self.getManifestPath(), "r")
+      manifest = json.load(openedFile)
+      openedFile.close()
+    except (IOError, ValueError) as e:
+      raise InvalidImageBundleException("Unable to read the manifest of bundle '{0}': {1}".format(self._path, str(e)))
+    for key in ["format", "image", "compression", "chunks"]:
+      if key not in manifest.keys():
+        raise InvalidImageBundleException("Invalid manifest in bundle '{0}': '{1}' is missing".format(self._path, key))
+    if manifest["format"] != BUNDLE_FORMAT:
+      raise InvalidImageBundleException("Unsupported bundle format '{0}'".format(manifest["format"]))
+    return manifest
+
+  # ##
+  # Save the image with docker and write its chunks in the bundle
+  # Returns the manifest of the bundle and the number of bytes written
+  # ##
+  def export(self, image, metadata):
+    mkdir_p(self._path)
+    compression = getDefaultCompression()
+    if os.path.exists(self.getManifestPath()):
+      # Keep the compression of the existing chunks so that they can be reused
+      compression = self.getManifest()["compression"]
+    store = ChunkStore(os.path.join(self._path, BUNDLE_CHUNKS_DIR), compression)
+    p = subprocess.Popen(["docker", "save", image], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    chunks = []
+    written = 0
+    size = 0
+    try:
+      for chunk in splitStream(p.stdout):
+        digest = hashlib.sha256(chunk).hexdigest()
+        chunks.append([digest, len(chunk)])
+        size += len(chunk)
+        if not store.has(digest):
+          data = compress(chunk, compression)
+          store.putCompressed(digest, data)
+          written += len(data)
+    finally:
+      err = p.communicate()[1]
+    if p.returncode != 0:
+      raise RuntimeError("Unable to save image '{0}': {1}".format(image, err))
+
+    manifest = dict(metadata)
+    manifest["format"] = BUNDLE_FORMAT
+    manifest["image"] = image
+    manifest["created"] = int(time.time())
+    manifest["compression"] = compression
+    manifest["size"] = size
+    manifest["chunks"] = chunks
+    tmpPath = self.getManifestPath() + ".tmp"
+    openedFile = open(tmpPath, "w")
+    json.dump(manifest, openedFile, indent=2)
+    openedFile.close()
+    os.rename(tmpPath, self.getManifestPath())
+    return (manifest, written)
+
+  # ##
+  # Copy the missing chunks in the local store and load the image in docker
+  # Returns the manifest of the bundle and the number of bytes copied
+  # ##
+  def load(self, storePath):
+    manifest = self.getManifest()
+    compression = manifest["compression"]
+    bundleStore = ChunkStore(os.path.join(self._path, BUNDLE_CHUNKS_DIR), compression)
+    localStore = ChunkStore(storePath, compression)
+    copied = 0
+    for (digest, length) in manifest["chunks"]:
+      if not localStore.has(digest):
+        if not bundleStore.has(digest):
+          raise InvalidImageBundleException("Chunk '{0}' is missing from bundle '{1}'".format(digest, self._path))
+        data = bundleStore.getCompressed(digest)
+        localStore.putCompressed(digest, data)
+        copied += len(data)
+
+    p = subprocess.Popen(["docker", "load"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+      for (digest, length) in manifest["chunks"]:
+        p.stdin.write(localStore.get(digest))
+    except Exception:
+      CORELOGGER.debug(traceback.format_exc())
+      p.kill()
+      raise
+    finally:
+      err = p.communicate()[1]
+    if p.returncode != 0:
+      raise RuntimeError("Unable to load image '{0}': {1}".format(manifest["image"], err))
+    # The last use of the store is the one of its directory (see GarbageCollector.getChunks)
+    mkdir_p(storePath)
+    os.utime(storePath, None)
+    return (manifest, copied)
@@ -18,6 +18,7 @@
 
 import argparse, argcomplete
 import os
+import re
 import errno
 import traceback
 
@@ -38,12 +39,51 @@ from machination.providers import Provider
 from machination.provisioners import Provisioner
 
 from machination.exceptions import InvalidCmdLineArgument
+from machination.exceptions import InvalidFleetManifestException
 from machination.exceptions import InvalidHardwareSupport
 
 from machination.helpers import getAllNetInterfaces
 from machination.globals import MACHINE_INSTANCE_REGISTRY
 from machination.globals import MACHINE_TEMPLATE_REGISTRY
 from machination.constants import MACHINATION_VERSIONFILE
+from machination.fleet import Fleet, FleetManifest
+from machination.pool import WarmPool
+from machination.globals import DOCKER_CLIENT
+from machination.globals import SETTINGS
+from machination.globals import IMAGE_USAGE
+from machination.globals import ADDRESS_ALLOCATOR
+from machination.collector import GarbageCollector
+from machination.helpers import parseSize
+from machination.helpers import formatSize
+from machination.helpers import formatDuration
+from machination.helpers import hashFile
+from machination.constants import MACHINATION_USERINSTANCESDIR
+from machination.constants import MACHINATION_USERCHUNKSDIR
+from machination.bundles import ImageBundle
+from machination.providers import DockerProvider
+from machination.providers import STATE_PROBE_TIMEOUT
+from machination.network import NetworkAttacher
+from machination.fanout import CommandFanOut
+
+# ##
+# Argument type accepting strictly positive integers only
+# ##
+def positiveInt(value):
+  try:
+    res = int(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError("invalid int value: '{0}'".format(value))
+  if res < 1:
+    raise argparse.ArgumentTypeError("must be at least 1: '{0}'".format(value))
+  return res
+
+# ##
+# Argument type accepting the names usable as instance directory names only
+# ##
+def instanceName(value):
+  if re.match("^[0-9a-zA-Z_-]+$", value) == None:
+    raise argparse.ArgumentTypeError("invalid instance name: '{0}' (letters, digits, '_' and '-' only)".format(value))
+  return value
 
 
 class MachineInstanceCreationWizard:
@@ -57,29 +97,30 @@ class MachineInstanceCreationWizard:
       (hostInterface,ipAddr,macAddr,hostname) = pack + [None,None]
     else:
         raise InvalidCmdLineArgument("guestinterface", strCmdLine )
-    if(macAddr == "auto" or macAddr == None):
-        macAddr = machination.helpers.randomMAC()
+    # Automatic addresses are given by the address allocator
+    if(macAddr == None):
+        macAddr = "auto"
     print((hostInterface,ipAddr,macAddr,hostname))
     return (hostInterface,ipAddr,macAddr,hostname)
   
   
   def requestGuestInterface(self,networkInterfaces):
     hostnameRegex = "([0-9a-zA-Z]*)"
-    ipAddrRegex = "(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)|dhcp"
-    macAddrRegex = "([0-9a-fA-F]{2}[\.:-]){5}([0-9a-fA-F]{2})"
+    ipAddrRegex = "(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)|dhcp|auto"
+    macAddrRegex = "([0-9a-fA-F]{2}[\.:-]){5}([0-9a-fA-F]{2})|auto"
     counter = 0
     hostname = RegexedQuestion("Enter an Hostname for the interface eth{0}".format(counter),
                                "Hostname must be a string",
                                 COMMANDLINELOGGER,
                                 "^{0}$".format(hostnameRegex), "").ask()
     ipAddr = RegexedQuestion("Enter an IP address for the interface",
-                             "IPAddress must be of form XXX.XXX.XXX.XXX",
+                             "IPAddress must be of form XXX.XXX.XXX.XXX, dhcp or auto",
                              COMMANDLINELOGGER,
-                             "^{0}$".format(ipAddrRegex),"dhcp").ask()
+                             "^({0})$".format(ipAddrRegex),"dhcp").ask()
     macAddr = RegexedQuestion("Enter a MAC address for the interface",
-                              "MAC address must be of form XX:XX:XX:XX:XX",
+                              "MAC address must be of form XX:XX:XX:XX:XX or auto",
                               COMMANDLINELOGGER,
-                              "^{0}$".format(macAddrRegex), machination.helpers.randomMAC()).ask()
+                              "^({0})$".format(macAddrRegex), "auto").ask()
       # Ask for the host interface to use
     COMMANDLINELOGGER.debug("Request an host interface...")
     hostInterface = RegexedQuestion("Enter the host interface [{0}]".format(",".join(map(str, networkInterfaces))),
@@ -202,7 +243,7 @@ class MachineInstanceCreationWizard:
     guestInterfaces = []
     sharedFolders = []
     hostInterface = None
-    networkInterfaces = getAllNetInterfaces();
+    networkInterfaces = []
     arch = None
     osversion = None
     provisioner = None
@@ -211,6 +252,7 @@ class MachineInstanceCreationWizard:
     if args.template in templates.keys():
       template = templates[args.template]
       guestInterfaces = []
+      requestedInterfaces = []
       sharedFolders = []
       hostInterface = None
       networkInterfaces = getAllNetInterfaces();
@@ -231,23 +273,23 @@ class MachineInstanceCreationWizard:
       if args.guestinterface != None:
         for i in range(0,template.getGuestInterfaces()):
           (hostInterface,ipAddr,macAddr,hostname) = self.unpackInterface(args.guestinterface[itfCounter] )
-          guestInterfaces.append(NetworkInterface(ipAddr, macAddr, hostInterface, hostname))
+          requestedInterfaces.append((hostInterface,ipAddr,macAddr,hostname))
         for i in range(itfCounter, len(args.guestinterface)):
           (hostInterface,ipAddr,macAddr,hostname) = self.unpackInterface(args.guestinterface[itfCounter] )
-          guestInterfaces.append(NetworkInterface(ipAddr, macAddr, hostInterface, hostname))
+          requestedInterfaces.append((hostInterface,ipAddr,macAddr,hostname))
           itfCounter += 1
       else:
         for i in range(0,template.getGuestInterfaces()):
-          (hostInterface,ipAddr,macAddr,hostname) = self.requestInterface(networkInterfaces)
-          guestInterfaces.append(NetworkInterface(ipAddr, macAddr, hostInterface, hostname))
+          (hostname,ipAddr,macAddr,hostInterface) = self.requestGuestInterface(networkInterfaces)
+          requestedInterfaces.append((hostInterface,ipAddr,macAddr,hostname))
 
       # Ask for additional network interfaces
       if args.no_interactive == False:
         for i in range(itfCounter,template.getGuestInterfaces()):
-          (hostInterface,ipAddr,macAddr,hostname) = self.requestInterface(networkInterfaces)
-          guestInterfaces.append(NetworkInterface(ipAddr, macAddr, hostInterface, hostname))
+          (hostname,ipAddr,macAddr,hostInterface) = self.requestGuestInterface(networkInterfaces)
+          requestedInterfaces.append((hostInterface,ipAddr,macAddr,hostname))
       else:
-        if(len(args.guestinterface) < template.getGuestInterfaces()):
+        if(args.guestinterface == None and template.getGuestInterfaces() != 0) or (args.guestinterface != None and len(args.guestinterface) < template.getGuestInterfaces()):
           COMMANDLINELOGGER.error("Not enough guestinterfaces given to fill requirement of template")
           raise InvalidCmdLineArgument("guestinterface", args.guestinterface)
 
@@ -263,11 +305,24 @@ class MachineInstanceCreationWizard:
                                      "Entered path is invalid, Please enter a valid path",
                                      COMMANDLINELOGGER,
                                      "^/.+", None, False).ask()
-          sharedFolders.append(SharedFolder(hostPathQues, guestPathQues))
+          modeQues = RegexedQuestion("Select a mode [{0}]".format(",".join(SharedFolder.MODES)),
+                                     "Entered mode is invalid",
+                                     COMMANDLINELOGGER,
+                                     "^({0})$".format("|".join(SharedFolder.MODES)), "bind").ask()
+          sharedFolders.append(SharedFolder(hostPathQues, guestPathQues, True, modeQues))
 
-        if args.sharedfolder != None:
-          for s in args.sharedfolder:
-            sharedFolders.append(SharedFolder(s[0], s[1]))
+      if args.sharedfolder != None:
+        for s in args.sharedfolder:
+          # The mode can be appended to the guest folder: /var/www:cached
+          (guestDir, mode) = (s[1], "bind")
+          if s[1].rpartition(":")[2] in SharedFolder.MODES:
+            (guestDir, mode) = (s[1].rpartition(":")[0], s[1].rpartition(":")[2])
+          sharedFolders.append(SharedFolder(s[0], guestDir, True, mode))
+
+      # Resolve the automatic addresses
+      addresses = ADDRESS_ALLOCATOR.allocate(args.name, [(h, ip, mac) for (h, ip, mac, hostname) in requestedInterfaces])
+      for ((hostInterface,ipAddr,macAddr), (h, ip, mac, hostname)) in zip(addresses, requestedInterfaces):
+        guestInterfaces.append(NetworkInterface(ipAddr, macAddr, hostInterface, hostname))
         
     else:
       COMMANDLINELOGGER.error("Unable to create machine: MachineInstance template '{0}:{1}' does not exists".format(args.template,args.templateversion))
@@ -393,8 +448,13 @@ class CmdLine:
           instances = MACHINE_INSTANCE_REGISTRY.getInstances()
           COMMANDLINELOGGER.debug("Instances loaded.")
 
+          if "state" in args and args.state:
+            self.listMachineInstancesStates(instances, args.timeout)
+            COMMANDLINELOGGER.info("")
+            return res
+
           # Create an array to display the available templates
-          data = {'name': [], 'path': [], 'started': []}
+          data = {'name': [], 'path': []}
           for i in instances.values():
             data['name'].append(i.getName())
             data['path'].append(i.getPath())
@@ -423,11 +483,49 @@ class CmdLine:
         COMMANDLINELOGGER.info("")
         return res
       
+    # ##
+    # Function displaying the instances with their live state
+    # Instances of a provider are probed together, concurrently or with one bulk query
+    # ##
+    def listMachineInstancesStates(self, instances, timeout):
+      columns = ["Name", "Template", "Provider", "State", "Uptime"]
+      rows = []
+      byProvider = {}
+      for i in sorted(instances.values(), key=lambda i: i.getName()):
+        try:
+          byProvider.setdefault(str(i.getProvider()), []).append(i)
+        except Exception as e:
+          COMMANDLINELOGGER.debug("Unable to load instance '{0}': {1}".format(i.getName(), str(e)))
+          COMMANDLINELOGGER.debug(traceback.format_exc())
+          rows.append([i.getName(), "?", "?", "invalid", "-"])
+      states = {}
+      for group in byProvider.values():
+        states.update(group[0].getProvider().getStates(group, timeout))
+      for group in byProvider.values():
+        for i in group:
+          (state, uptime) = states.get(i.getName(), ("unknown", None))
+          rows.append([i.getName(), str(i.getTemplate()), str(i.getProvider()), state,
+                       formatDuration(uptime) if uptime != None else "-"])
+      if len(rows) == 0:
+        COMMANDLINELOGGER.info("No instances available")
+        return
+      rows.sort(key=lambda r: r[0])
+      widths = [max([len(c)] + [len(r[idx]) for r in rows]) + 2 for (idx, c) in enumerate(columns)]
+      COMMANDLINELOGGER.info("".join([c.ljust(w) for (c, w) in zip(columns, widths)]))
+      for r in rows:
+        COMMANDLINELOGGER.info("".join([v.ljust(w) for (v, w) in zip(r, widths)]))
+
     # ##
     # Function to create a new machine
     # ##
     def createMachineInstance(self, args):
+      if args.resume != None:
+        return self.resumeMachineInstance(args)
+      if args.template == None or args.name == None:
+        COMMANDLINELOGGER.error("Unable to create machine: a template and a name are required.")
+        return errno.EINVAL
       res = 0
+      instance = None
       COMMANDLINELOGGER.info("Creating a new machine instance named '{0}' using template '{1}'".format(args.name, args.template))
       # Creating the template and instances registries
 
@@ -456,9 +554,12 @@ class CmdLine:
           # Try to create the new machine
           instance = MachineInstance(args.name, template, arch, osversion, provider, provisioner, guestInterfaces, sharedFolders)
           instance.create()
+          if not args.no_pool:
+            self.claimPooledContainer(instance, templates)
           COMMANDLINELOGGER.info("MachineInstance successfully created:")
           instances = MACHINE_INSTANCE_REGISTRY.getInstances()
           COMMANDLINELOGGER.info(instances[args.name].getInfos())
+          self.autoCollectGarbage()
 
       
       except (KeyboardInterrupt, SystemExit):
@@ -466,6 +567,8 @@ class CmdLine:
         res = errno.EINVAL          
       except Exception as e:
         COMMANDLINELOGGER.error("Unable to create machine instance '{0}': {1}.".format(args.name,str(e)))
+        if instance != None and instance.isIncomplete():
+          COMMANDLINELOGGER.info("Run 'machination create --resume {0}' to resume the creation".format(args.name))
         if (not args.verbose):
           COMMANDLINELOGGER.info("Run with --verbose flag for more details")
         COMMANDLINELOGGER.debug(traceback.format_exc())
@@ -473,6 +576,173 @@ class CmdLine:
         
       return res
 
+    # ##
+    # Function to resume the interrupted creation of an instance
+    # ##
+    def resumeMachineInstance(self, args):
+      res = 0
+      COMMANDLINELOGGER.info("Resuming the creation of machine instance '{0}'".format(args.resume))
+      try:
+        instances = MACHINE_INSTANCE_REGISTRY.getInstances()
+        if args.resume in instances.keys():
+          instance = instances[args.resume].load()
+          instance.resume()
+          if not args.no_pool:
+            self.claimPooledContainer(instance, MACHINE_TEMPLATE_REGISTRY.getTemplates())
+          COMMANDLINELOGGER.info("MachineInstance successfully created:")
+          COMMANDLINELOGGER.info(instance.getInfos())
+          self.autoCollectGarbage()
+        else:
+          COMMANDLINELOGGER.error("MachineInstance instance '{0}' does not exist.".format(args.resume))
+          res = errno.EINVAL
+      except Exception as e:
+        COMMANDLINELOGGER.error("Unable to resume the creation of machine instance '{0}': {1}.".format(args.resume,str(e)))
+        if (not args.verbose):
+          COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      except (KeyboardInterrupt, SystemExit):
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      return res
+
+    # ##
+    # Function giving a pre-started container of the warm pools to a new instance
+    # Failures are not fatal, the container is then started by vagrant as usual
+    # ##
+    def claimPooledContainer(self, instance, templates):
+      try:
+        pool = WarmPool(DOCKER_CLIENT, SETTINGS, templates)
+        if pool.claim(instance):
+          COMMANDLINELOGGER.info("Pre-started container claimed from the warm pool.")
+        if len(pool.getPools()) != 0:
+          pool.fillInBackground()
+      except Exception as e:
+        COMMANDLINELOGGER.info("Unable to use the warm pool: {0}".format(str(e)))
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+
+    # ##
+    # Function to manage the warm pools
+    # ##
+    def manageWarmPools(self, args):
+      res = 0
+      try:
+        pool = WarmPool(DOCKER_CLIENT, SETTINGS, MACHINE_TEMPLATE_REGISTRY.getTemplates())
+        if args.action == "fill":
+          COMMANDLINELOGGER.info("{0} container(s) started.".format(pool.fill()))
+        elif args.action == "drain":
+          COMMANDLINELOGGER.info("{0} container(s) removed.".format(pool.drain()))
+        else:
+          pools = pool.getPools()
+          if len(pools) == 0:
+            COMMANDLINELOGGER.info("No warm pool configured in '{0}'".format(SETTINGS.getPath()))
+          for (key, spec) in pools:
+            COMMANDLINELOGGER.info("{0}: {1}/{2} container(s) ready".format(key, len(pool.getContainers(key)), spec["size"]))
+      except Exception as e:
+        COMMANDLINELOGGER.error("Unable to {0} warm pools: {1}".format(args.action, str(e)))
+        if (not args.verbose):
+          COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      except (KeyboardInterrupt, SystemExit):
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      return res
+
+    # ##
+    # Function to attach the guest interfaces of running machines to their containers
+    # All the interfaces of all the given machines are attached in one pass
+    # ##
+    def attachNetworkInterfaces(self, args):
+      res = 0
+      try:
+        instances = MACHINE_INSTANCE_REGISTRY.getInstances()
+        NetworkAttacher(DOCKER_CLIENT, ADDRESS_ALLOCATOR).attach([instances[name] for name in args.names])
+        COMMANDLINELOGGER.info("Network interfaces successfully attached.")
+      except Exception as e:
+        COMMANDLINELOGGER.error("Unable to attach network interfaces: {0}.".format(str(e)))
+        if (not args.verbose):
+          COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      except (KeyboardInterrupt, SystemExit):
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      return res
+
+    # ##
+    # Function to create copies of an existing machine
+    # ##
+    def cloneMachineInstance(self, args):
+      res = 0
+      names = [args.destination]
+      if args.count > 1:
+        names = ["{0}-{1}".format(args.destination,i) for i in range(1,args.count+1)]
+      try:
+        instances = MACHINE_INSTANCE_REGISTRY.getInstances()
+        if args.source not in instances.keys():
+          COMMANDLINELOGGER.error("MachineInstance instance '{0}' does not exist.".format(args.source))
+          return errno.EINVAL
+        usedIPAddrs = []
+        for i in instances.values():
+          usedIPAddrs.extend([intf.getIPAddr() for intf in i.getGuestInterfaces()])
+        skipped = []
+        for name in names:
+          if name in instances.keys():
+            COMMANDLINELOGGER.error("Unable to clone machine: MachineInstance named '{0}' already exists.".format(name))
+            skipped.append(name)
+            continue
+          COMMANDLINELOGGER.info("Cloning machine instance '{0}' into '{1}'...".format(args.source,name))
+          instances[args.source].clone(name,usedIPAddrs)
+        if len(skipped) == 0:
+          COMMANDLINELOGGER.info("MachineInstance instance '{0}' successfully cloned.".format(args.source))
+        else:
+          COMMANDLINELOGGER.error("MachineInstance instance '{0}' not cloned into: {1}.".format(args.source,", ".join(skipped)))
+          res = errno.EALREADY
+      except Exception as e:
+        COMMANDLINELOGGER.error("Unable to clone machine instance '{0}': {1}.".format(args.source,str(e)))
+        if (not args.verbose):
+          COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      except (KeyboardInterrupt, SystemExit):
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      return res
+
+    # ##
+    # Function to create the instances described in a fleet manifest
+    # Only the instances that are missing or that differ from the manifest are (re)created
+    # ##
+    def applyFleet(self, args):
+      res = 0
+      COMMANDLINELOGGER.info("Applying fleet manifest '{0}'".format(args.manifest))
+      try:
+        templates = MACHINE_TEMPLATE_REGISTRY.getTemplates()
+        COMMANDLINELOGGER.debug("Templates loaded.")
+        manifest = FleetManifest.load(args.manifest, templates)
+        failures = Fleet(MACHINE_INSTANCE_REGISTRY).apply(manifest, args.workers, args.dry_run)
+        if len(failures) != 0:
+          COMMANDLINELOGGER.error("Unable to create the following instances: {0}".format(", ".join(failures)))
+          if (not args.verbose):
+            COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+          res = errno.EINVAL
+        else:
+          COMMANDLINELOGGER.info("Fleet manifest successfully applied.")
+      except InvalidFleetManifestException as e:
+        COMMANDLINELOGGER.error(str(e))
+        res = errno.EINVAL
+      except Exception as e:
+        COMMANDLINELOGGER.error("Unable to apply fleet manifest '{0}': {1}.".format(args.manifest,str(e)))
+        if (not args.verbose):
+          COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      except (KeyboardInterrupt, SystemExit):
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      return res
+
     # ##
     # Function to destroy a machine
     # Files related to the machine are deleted
@@ -510,6 +780,141 @@ class CmdLine:
         except (KeyboardInterrupt, SystemExit):
           COMMANDLINELOGGER.debug(traceback.format_exc())
           res = errno.EINVAL
+      self.autoCollectGarbage()
+      return res
+
+    # ##
+    # Function to export and import images as bundles
+    # ##
+    def manageImageBundles(self, args):
+      res = 0
+      try:
+        bundle = ImageBundle(args.bundle)
+        if args.action == "export":
+          template = MACHINE_TEMPLATE_REGISTRY.getTemplates()[args.template]
+          arch = args.arch
+          if arch == None:
+            arch = str(template.getArchs()[0])
+          osVersion = args.osversion
+          if osVersion == None:
+            osVersion = template.getOsVersions()[0]
+          provisioner = args.provisioner
+          if provisioner == None:
+            provisioner = str(template.getProvisioners()[0])
+          if arch not in [str(a) for a in template.getArchs()] or osVersion not in template.getOsVersions() or provisioner not in [str(p) for p in template.getProvisioners()]:
+            raise InvalidCmdLineArgument("image", "{0}/{1}/{2}".format(arch, osVersion, provisioner))
+          metadata = {"template": str(template), "template_hash": hashFile(template.getPath()),
+                      "arch": arch, "os_version": osVersion, "provisioner": provisioner}
+          image = "{0}:{1}".format(DockerProvider.getImageNameFor(template, arch, osVersion, provisioner), template.getVersion())
+          COMMANDLINELOGGER.info("Exporting image '{0}' to '{1}'...".format(image, args.bundle))
+          (manifest, written) = bundle.export(image, metadata)
+          COMMANDLINELOGGER.info("{0} chunk(s) for {1}, {2} written.".format(len(manifest["chunks"]), formatSize(manifest["size"]), formatSize(written)))
+        else:
+          COMMANDLINELOGGER.info("Importing image bundle '{0}'...".format(args.bundle))
+          (manifest, copied) = bundle.load(MACHINATION_USERCHUNKSDIR)
+          IMAGE_USAGE.touch(manifest["image"])
+          COMMANDLINELOGGER.info("Image '{0}' imported, {1} copied.".format(manifest["image"], formatSize(copied)))
+      except Exception as e:
+        COMMANDLINELOGGER.error("Unable to {0} image bundle '{1}': {2}".format(args.action, args.bundle, str(e)))
+        if (not args.verbose):
+          COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      except (KeyboardInterrupt, SystemExit):
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      return res
+
+    # ##
+    # Function to check the templates and the instances
+    # All the errors are reported at once
+    # ##
+    def checkRegistries(self, args):
+      res = 0
+      errors = MACHINE_TEMPLATE_REGISTRY.validate() + MACHINE_INSTANCE_REGISTRY.validate()
+      if len(errors) == 0:
+        COMMANDLINELOGGER.info("Templates and instances are valid.")
+      else:
+        COMMANDLINELOGGER.error("{0} error(s) found:".format(len(errors)))
+        for e in errors:
+          COMMANDLINELOGGER.error("  - {0}".format(e.replace("\n", "\n    ")))
+        res = errno.EINVAL
+      return res
+
+    # ##
+    # Function to remove the unused images and export tarballs
+    # ##
+    def collectGarbage(self, args):
+      res = 0
+      try:
+        budget = args.budget
+        if budget == None:
+          budget = SETTINGS.get("gc_budget", 0)
+        collector = GarbageCollector(DOCKER_CLIENT, MACHINE_INSTANCE_REGISTRY.getInstances(), IMAGE_USAGE, MACHINATION_USERINSTANCESDIR,
+                                     MACHINATION_USERCHUNKSDIR)
+        (evicted, usage) = collector.collect(parseSize(budget), args.dry_run)
+        for e in evicted:
+          if args.dry_run:
+            COMMANDLINELOGGER.info("Would remove {0} '{1}' ({2})".format(e["kind"], e["name"], formatSize(e["size"])))
+          else:
+            COMMANDLINELOGGER.info("Removed {0} '{1}' ({2})".format(e["kind"], e["name"], formatSize(e["size"])))
+        COMMANDLINELOGGER.info("{0} element(s) evicted, {1} used by images, exports and chunks.".format(len(evicted), formatSize(usage)))
+      except Exception as e:
+        COMMANDLINELOGGER.error("Unable to collect garbage: {0}".format(str(e)))
+        if (not args.verbose):
+          COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      except (KeyboardInterrupt, SystemExit):
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      return res
+
+    # ##
+    # Function applying the automatic garbage collection policy of the settings
+    # ##
+    def autoCollectGarbage(self):
+      if SETTINGS.get("gc_auto", False) != True:
+        return
+      try:
+        collector = GarbageCollector(DOCKER_CLIENT, MACHINE_INSTANCE_REGISTRY.getInstances(), IMAGE_USAGE, MACHINATION_USERINSTANCESDIR,
+                                     MACHINATION_USERCHUNKSDIR)
+        (evicted, usage) = collector.collect(parseSize(SETTINGS.get("gc_budget", 0)))
+        for e in evicted:
+          COMMANDLINELOGGER.debug("Removed {0} '{1}' ({2})".format(e["kind"], e["name"], formatSize(e["size"])))
+      except Exception as e:
+        COMMANDLINELOGGER.debug("Automatic garbage collection failed: {0}".format(str(e)))
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+
+    # ##
+    # Function to re-apply the roles that changed to a machine
+    # ##
+    def updateMachineInstance(self, args):
+      res = 0
+      for name in args.names:
+        COMMANDLINELOGGER.info("Updating machine {0}".format(name))
+        try:
+          instances = MACHINE_INSTANCE_REGISTRY.getInstances()
+          if name in instances.keys():
+            roles = instances[name].update(args.dry_run)
+            if len(roles) == 0:
+              COMMANDLINELOGGER.info("MachineInstance instance '{0}' is up to date.".format(name))
+            elif args.dry_run:
+              COMMANDLINELOGGER.info("Roles to re-apply: {0}".format(", ".join(roles)))
+            else:
+              COMMANDLINELOGGER.info("MachineInstance instance '{0}' successfully updated (roles: {1}).".format(name,", ".join(roles)))
+          else:
+            COMMANDLINELOGGER.error("MachineInstance instance '{0}' does not exist.".format(name))
+            res = errno.EINVAL
+        except Exception as e:
+          COMMANDLINELOGGER.error("Unable to update machine instance '{0}': {1}.".format(name,str(e)))
+          if (not args.verbose):
+            COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+          COMMANDLINELOGGER.debug(traceback.format_exc())
+          res = errno.EINVAL
+        except (KeyboardInterrupt, SystemExit):
+          COMMANDLINELOGGER.debug(traceback.format_exc())
+          res = errno.EINVAL
       return res
 
     # ##
@@ -625,7 +1030,7 @@ class CmdLine:
             COMMANDLINELOGGER.error("MachineInstance instance '{0}' is not started, starting it before connecting to it.".format(args.name))
             instances[args.name].start()
 
-          instances[args.name].ssh(args.command)
+          res = instances[args.name].ssh(args.command)
         else:
           COMMANDLINELOGGER.error("MachineInstance instance '{0}' does not exist.".format(args.name))
       except Exception as e:
@@ -638,6 +1043,48 @@ class CmdLine:
         COMMANDLINELOGGER.debug(traceback.format_exc())
       return res
   
+    # ##
+    # Function to run a command on several machines at once
+    # ##
+    def execOnMachineInstances(self, args):
+      res = 0
+      try:
+        instances = MACHINE_INSTANCE_REGISTRY.getInstances()
+        for name in args.names:
+          if name not in instances.keys():
+            raise RuntimeError("Machine instance '{0}' does not exist".format(name))
+        names = list(args.names)
+        if args.all:
+          names = sorted(instances.keys())
+        elif args.template != None:
+          names += sorted(n for (n, i) in instances.items() if n not in names and
+                          (str(i.getTemplate()) == args.template or i.getTemplate().getName() == args.template))
+        if len(names) == 0:
+          COMMANDLINELOGGER.error("No machine instance to run the command on, give their names, --all or --template.")
+          return errno.EINVAL
+
+        results = CommandFanOut(args.jobs, args.collect).run([instances[n] for n in names], args.command)
+
+        nameColWidth = max([len("Name")] + [len(r.getName()) for r in results]) + 2
+        COMMANDLINELOGGER.info("")
+        COMMANDLINELOGGER.info("Name".ljust(nameColWidth) + "Exit code".ljust(11) + "Time")
+        for r in results:
+          COMMANDLINELOGGER.info(r.getName().ljust(nameColWidth) + str(r.getReturnCode()).ljust(11) + "{0:.2f}s".format(r.getDuration()))
+        failures = [r.getName() for r in results if r.getReturnCode() != 0]
+        if len(failures) != 0:
+          COMMANDLINELOGGER.error("Command failed on {0} of {1} machine instances: {2}".format(len(failures), len(results), ", ".join(failures)))
+          res = errno.EINVAL
+      except Exception as e:
+        COMMANDLINELOGGER.error("Unable to run the command on the machine instances: {0}".format(str(e)))
+        if (not args.verbose):
+          COMMANDLINELOGGER.info("Run with --verbose flag for more details")
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      except (KeyboardInterrupt, SystemExit):
+        COMMANDLINELOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+      return res
+
     def displayVersion(self,args):
       version = "Unknown version"
       
@@ -668,29 +1115,87 @@ class CmdLine:
       # Parser for list command
       listParser = rootSubparsers.add_parser('list', help='List templates and instances')
       listParser.add_argument('type', help='Type to list',nargs='?', type=str, choices = ("templates","instances"))
+      listParser.add_argument('--state', help='Display the state, template, provider and uptime of the instances', action='store_true')
+      listParser.add_argument('--timeout', help='Time given to each instance to report its state, in seconds', type=int, default=STATE_PROBE_TIMEOUT)
       listParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
       
       # Parser for create command
       createParser = rootSubparsers.add_parser('create', help='Create the given machine in the path')
-      createParser.add_argument('template', help='Name of the template to create', type=str, choices = templates.keys())
-      createParser.add_argument('name', help='Name of the machine to create', type=str)
+      createParser.add_argument('template', help='Name of the template to create', nargs='?', type=str, choices = templates.keys())
+      createParser.add_argument('name', help='Name of the machine to create', nargs='?', type=str)
+      createParser.add_argument('--resume', help='Resume the interrupted creation of the given machine', metavar="<name>", type=str)
       createParser.add_argument('--arch','-a', help='Architecture to use', type=str)
       createParser.add_argument('--provider','-p', help='Provider to use', type=str)
       createParser.add_argument('--provisioner','-n', help='Provisioner to use', type=str)
       createParser.add_argument('--osversion','-o', help='OS Version to use', type=str)
-      createParser.add_argument('--guestinterface','-i', help='Network interface to add', metavar="<host_interface>,<ip_addr>[,mac_addr,hostname]", action='append', type=str)
-      createParser.add_argument('--sharedfolder','-s', nargs=2, help='Shared folder between the new machine and the host', metavar=("<host folder>","<guest folder>"), action='append', type=str)
+      createParser.add_argument('--guestinterface','-i', help='Network interface to add', metavar="<host_interface>,<ip_addr|dhcp|auto>[,mac_addr|auto,hostname]", action='append', type=str)
+      createParser.add_argument('--sharedfolder','-s', nargs=2, help='Shared folder between the new machine and the host', metavar=("<host folder>","<guest folder>[:bind|cached|delegated|rsync|tmpfs]"), action='append', type=str)
       createParser.add_argument('--no-interactive', help='Do not request for interactive configuration of optional elements (interfaces,sharedfolders)', action='store_true')
       createParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
       createParser.add_argument('--force',"-f", help='Force creation by deleting an instance with same name', action='store_true')
+      createParser.add_argument('--no-pool', help='Do not claim a pre-started container from the warm pools', action='store_true')
       
+
+      # Parser for clone command
+      cloneParser = rootSubparsers.add_parser('clone', help='Create copies of an existing machine instance without rebuilding it')
+      cloneParser.add_argument('source', help='Name of the machine to clone', type=str, choices=instances.keys())
+      cloneParser.add_argument('destination', help='Name of the new machine (suffixed by -<number> when count is greater than 1)', type=instanceName)
+      cloneParser.add_argument('--count','-c', help='Number of copies to create', type=positiveInt, default=1)
+      cloneParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+
+      # Parser for apply command
+      applyParser = rootSubparsers.add_parser('apply', help='Create the instances described in a fleet manifest')
+      applyParser.add_argument('manifest', help='Path of the fleet manifest', type=str)
+      applyParser.add_argument('--workers','-w', help='Number of instances created concurrently (overrides the manifest)', type=positiveInt)
+      applyParser.add_argument('--dry-run', help='Only display what would be done', action='store_true')
+      applyParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
             
+      # Parser for pool command
+      poolParser = rootSubparsers.add_parser('pool', help='Manage the warm pools of pre-started containers')
+      poolParser.add_argument('action', help='Action to perform', nargs='?', type=str, choices=("status","fill","drain"), default="status")
+      poolParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+
+      # Parser for attach command
+      attachParser = rootSubparsers.add_parser('attach', help='Attach the guest interfaces of running machine instances (requires root)')
+      attachParser.add_argument('names', help='Name of the machines', nargs="+", type=str, choices=instances.keys())
+      attachParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+
+      # Parser for image command
+      imageParser = rootSubparsers.add_parser('image', help='Move images between hosts as deduplicated bundles')
+      imageSubparsers = imageParser.add_subparsers(dest="action")
+      imageExportParser = imageSubparsers.add_parser('export', help='Write the image of a template in a bundle, only changed chunks are written')
+      imageExportParser.add_argument('template', help='Name of the template of the image', type=str, choices=templates.keys())
+      imageExportParser.add_argument('bundle', help='Directory of the bundle', type=str)
+      imageExportParser.add_argument('--arch','-a', help='Architecture of the image', type=str)
+      imageExportParser.add_argument('--osversion','-o', help='OS Version of the image', type=str)
+      imageExportParser.add_argument('--provisioner','-n', help='Provisioner of the image', type=str)
+      imageExportParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+      imageImportParser = imageSubparsers.add_parser('import', help='Load the image of a bundle, only missing chunks are copied')
+      imageImportParser.add_argument('bundle', help='Directory of the bundle', type=str)
+      imageImportParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+
+      # Parser for check command
+      checkParser = rootSubparsers.add_parser('check', help='Check the templates and the instances and report all the errors found')
+      checkParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+
+      # Parser for gc command
+      gcParser = rootSubparsers.add_parser('gc', help='Remove the images and export tarballs that are not used anymore')
+      gcParser.add_argument('--budget','-b', help='Disk space that images and exports may use (e.g. 20G), defaults to the gc_budget setting', type=str)
+      gcParser.add_argument('--dry-run', help='Only display what would be removed', action='store_true')
+      gcParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+
       # Parser for destroy command
       destroyParser = rootSubparsers.add_parser('destroy', help='Destroy the given machine in the path')
       destroyParser.add_argument('names', help='Name of the machine to destroy',nargs="+",type=str, choices=instances.keys())
       destroyParser.add_argument('--force','-f', help='Do not ask for confirmation', action='store_true')
       destroyParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
 
+      # Parser for update command
+      updateParser = rootSubparsers.add_parser('update', help='Re-apply the roles that changed to the given machine instance')
+      updateParser.add_argument('names', help='Name of the machine to update', nargs="+", type=str, choices=instances.keys())
+      updateParser.add_argument('--dry-run', help='Only display the roles that would be re-applied', action='store_true')
+      updateParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+
       # Parser for start command
       startParser = rootSubparsers.add_parser('start', help='Start the given machine instance')
       startParser.add_argument('names', help='Name of the machine to start', nargs="+", type=str, choices=instances.keys())
@@ -716,19 +1221,38 @@ class CmdLine:
       sshParser.add_argument('name', help='Name of the machine to ssh in',choices=instances.keys(),type=str)
       sshParser.add_argument('--command',"-c", help='Command to execute in SSH',type=str) 
       sshParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
+
+      # Parser for exec command
+      execParser = rootSubparsers.add_parser('exec', help='Run a command on several machines concurrently')
+      execParser.add_argument('names', help='Name of the machines', nargs="*", type=str)
+      execParser.add_argument('--command',"-c", help='Command to run', type=str, required=True)
+      execParser.add_argument('--all',"-a", help='Run the command on all the machines', action='store_true')
+      execParser.add_argument('--template',"-t", help='Run the command on the machines created from the given template', metavar="<name>[:<version>]", type=str)
+      execParser.add_argument('--jobs',"-j", help='Number of machines running the command at the same time', type=int, default=10)
+      execParser.add_argument('--collect', help='Display the output of each machine once its command completed instead of prefixing each line', action='store_true')
+      execParser.add_argument('--verbose',"-v", help='Verbose mode', action='store_true')
       # Parse the command
       argcomplete.autocomplete(parser)
-      args = parser.parse_args()
+      args = parser.parse_args(args[1:])
       
       functions = {
                   "list":self.listElements,
                   "create":self.createMachineInstance,
+                  "apply":self.applyFleet,
+                  "clone":self.cloneMachineInstance,
+                  "pool":self.manageWarmPools,
+                  "attach":self.attachNetworkInterfaces,
+                  "gc":self.collectGarbage,
+                  "check":self.checkRegistries,
+                  "image":self.manageImageBundles,
                   "destroy":self.destroyMachineInstance,
+                  "update":self.updateMachineInstance,
                   "start":self.startMachineInstance,
                   "stop":self.stopMachineInstance,
                   "restart":self.restartMachineInstance,
                   "infos":self.getMachineInstanceInfos,
                   "ssh":self.sshIntoMachineInstance,
+                  "exec":self.execOnMachineInstances,
                   "version":self.displayVersion
                   }
       
@@ -0,0 +1,240 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import traceback
+
+from machination.exceptions import DockerEngineException
+from machination.helpers import listPath
+from machination.helpers import mkdir_p
+from machination.loggers import CORELOGGER
+
+# Export tarballs whose image never showed up are considered abandoned after this delay
+STALE_EXPORT_DELAY = 24 * 3600
+
+# ##
+# Class recording the last time each image has been used by a build or an instance
+# Records are stored as a JSON mapping "<repository>:<tag>" -> timestamp
+# ##
+class ImageUsage:
+  _path = None
+
+  def __init__(self, path):
+    self._path = path
+
+  def getPath(self):
+    return self._path
+
+  def getAll(self):
+    try:
+      openedFile = open(self._path, "r")
+      values = json.load(openedFile)
+      openedFile.close()
+      if type(values) is dict:
+        return values
+    except (IOError, ValueError):
+      pass
+    return {}
+
+  def getLastUse(self, image):
+    return self.getAll().get(image, None)
+
+  # ##
+  # Apply a modification to the records
+  # The records are locked while they are modified and replaced atomically
+  # ##
+  def modify(self, function):
+    mkdir_p(os.path.dirname(self._path))
+    lockFile = open(self._path + ".lock", "w")
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    try:
+      values = self.getAll()
+      function(values)
+      tmpPath = "{0}.{1}".format(self._path, os.getpid())
+      openedFile = open(tmpPath, "w")
+      json.dump(values, openedFile, indent=2)
+      openedFile.close()
+      os.rename(tmpPath, self._path)
+    finally:
+      fcntl.flock(lockFile, fcntl.LOCK_UN)
+      lockFile.close()
+
+  def touch(self, image):
+    def update(values):
+      values[image] = int(time.time())
+    self.modify(update)
+
+  def forget(self, images):
+    def update(values):
+      for i in images:
+        values.pop(i, None)
+    self.modify(update)
+
+# ##
+# Class removing the machination images, the export tarballs and the chunks of the imported bundles that are not needed anymore
+# Images referenced by an instance or by a container are always kept, the others, the stale tarballs
+# and the chunk store are evicted from the least recently used until the disk usage fits in the budget
+# ##
+class GarbageCollector:
+  _client = None
+  _instances = None
+  _usage = None
+  _instancesDir = None
+
+  _chunksDir = None
+
+  def __init__(self, client, instances, usage, instancesDir, chunksDir=None):
+    self._client = client
+    self._instances = instances
+    self._usage = usage
+    self._instancesDir = instancesDir
+    self._chunksDir = chunksDir
+
+  # ##
+  # Images that must be kept
+  # ##
+  def getReferencedImages(self):
+    referenced = set()
+    for i in self._instances.values():
+      image = i.getProvider().getImageReference(i)
+      if image != None:
+        referenced.add(image)
+    for c in self._client.getContainers(True):
+      referenced.add(c.get("Image", ""))
+      referenced.add(c.get("ImageID", ""))
+    return referenced
+
+  # ##
+  # Sizes of the images as (size, shared size) by image id
+  # The size of an image includes the layers it shares with other images, engines that cannot
+  # tell the shared size apart report -1 for it
+  # ##
+  def getImageSizes(self):
+    sizes = {}
+    try:
+      for i in self._client.getDiskUsage().get("Images") or []:
+        sizes[i["Id"]] = (i.get("Size", 0), i.get("SharedSize", -1))
+    except DockerEngineException as e:
+      CORELOGGER.debug("Shared layers of the images are not known: {0}".format(str(e)))
+    return sizes
+
+  # ##
+  # The size of an image is the one of the layers it does not share, the one freed by its removal
+  # The shared size is counted once for all the images, see getUsage
+  # ##
+  def getImages(self):
+    images = []
+    lastUses = self._usage.getAll()
+    sizes = self.getImageSizes()
+    for i in self._client.getImages(False):
+      tags = [t for t in (i.get("RepoTags") or []) if t.startswith("machination-")]
+      if len(tags) != 0:
+        lastUse = max([lastUses.get(t, i.get("Created", 0)) for t in tags])
+        (size, shared) = sizes.get(i["Id"], (i.get("Size", 0), -1))
+        shared = max(shared, 0)
+        images.append({"kind": "image", "name": tags[0], "id": i["Id"], "tags": tags,
+                       "size": size - shared, "shared": shared, "lastUse": lastUse})
+    return images
+
+  # ##
+  # Local chunk store of the imported image bundles
+  # The chunks only avoid copying them again from a bundle, the store is evicted as a whole
+  # ##
+  def getChunks(self):
+    if self._chunksDir == None or not os.path.isdir(self._chunksDir):
+      return []
+    size = 0
+    for (root, dirs, files) in os.walk(self._chunksDir):
+      for f in files:
+        size += os.path.getsize(os.path.join(root, f))
+    return [{"kind": "chunks", "name": self._chunksDir, "size": size, "lastUse": os.stat(self._chunksDir).st_mtime}]
+
+  # ##
+  # Disk usage of the elements, the layers shared by the images are counted once
+  # ##
+  @staticmethod
+  def getUsage(elements):
+    return sum([e["size"] for e in elements]) + max([e.get("shared", 0) for e in elements] + [0])
+
+  # ##
+  # Tarballs written by the docker export_path of packer in the instance directories
+  # A tarball is stale once its image has been imported
+  # ##
+  def getExports(self, images):
+    exports = []
+    importedImages = set()
+    for i in images:
+      for t in i["tags"]:
+        importedImages.add(t.split(":")[0])
+    for d in listPath(self._instancesDir):
+      for path in listPath(d):
+        fileName = os.path.basename(path)
+        if re.match("^machination-.*\.tar$", fileName) != None and os.path.isfile(path):
+          stat = os.stat(path)
+          stale = fileName[:-len(".tar")].lower() in importedImages or stat.st_mtime < time.time() - STALE_EXPORT_DELAY
+          exports.append({"kind": "export", "name": path, "size": stat.st_size,
+                          "lastUse": stat.st_mtime, "stale": stale})
+    return exports
+
+  # ##
+  # Evict the unused elements until the usage fits in the budget (in bytes)
+  # Returns the evicted elements and the remaining usage
+  # ##
+  def collect(self, budget=0, dryRun=False):
+    images = self.getImages()
+    exports = self.getExports(images)
+    chunks = self.getChunks()
+    referenced = self.getReferencedImages()
+    remaining = images + exports + chunks
+    usage = GarbageCollector.getUsage(remaining)
+
+    candidates = [e for e in exports if e["stale"]] + chunks
+    for i in images:
+      if i["id"] not in referenced and len(referenced.intersection(i["tags"])) == 0:
+        candidates.append(i)
+    candidates.sort(key=lambda e: e["lastUse"])
+
+    evicted = []
+    for e in candidates:
+      if usage <= budget:
+        break
+      if not dryRun:
+        try:
+          if e["kind"] == "image":
+            for t in e["tags"]:
+              self._client.removeImage(t)
+            self._usage.forget(e["tags"])
+          elif e["kind"] == "chunks":
+            shutil.rmtree(e["name"])
+          else:
+            os.remove(e["name"])
+        except (DockerEngineException, OSError) as ex:
+          CORELOGGER.warning("Unable to remove '{0}': {1}".format(e["name"], str(ex)))
+          CORELOGGER.debug(traceback.format_exc())
+          continue
+      CORELOGGER.debug("'{0}' evicted.".format(e["name"]))
+      # The shared layers are freed with the last image holding them
+      remaining.remove(e)
+      usage = GarbageCollector.getUsage(remaining)
+      evicted.append(e)
+    return (evicted, usage)
@@ -38,6 +38,19 @@ MACHINATION_USERTEMPLATESDIR = os.path.join(MACHINATION_USERDIR,"templates")
 MACHINATION_USERPROVISIONERSDIR = os.path.join(MACHINATION_USERDIR,"provisioners")
 MACHINATION_USERANSIBLEPLAYBOOKSDIR = os.path.join(MACHINATION_USERPROVISIONERSDIR,"ansible","playbooks")
 MACHINATION_USERANSIBLEROLESDIR = os.path.join(MACHINATION_USERPROVISIONERSDIR,"ansible","roles")
+MACHINATION_USERSETTINGSFILE = os.path.join(MACHINATION_USERDIR,"settings.yml")
+MACHINATION_IMAGESUSAGEFILE = os.path.join(MACHINATION_USERDIR,"images.usage")
+MACHINATION_USERCHUNKSDIR = os.path.join(MACHINATION_USERDIR,"chunks")
+MACHINATION_TEMPLATESCACHEFILE = os.path.join(MACHINATION_USERDIR,"templates.cache")
+MACHINATION_ADDRESSESFILE = os.path.join(MACHINATION_USERDIR,"addresses.index")
+MACHINATION_DAEMONSOCKET = os.path.join(MACHINATION_USERDIR,"machinationd.sock")
+MACHINATION_USERLOCKSDIR = os.path.join(MACHINATION_USERDIR,"locks")
+MACHINATION_USERSSHDIR = os.path.join(MACHINATION_USERDIR,"ssh")
 
 MACHINATION_CONFIGFILE_NAME="machine.config"
-MACHINATION_PACKERFILE_NAME="machine.packer"
\ No newline at end of file
+MACHINATION_PACKERFILE_NAME="machine.packer"
+MACHINATION_UPDATEPACKERFILE_NAME="machine.update.packer"
+MACHINATION_ROLESSTATEFILE_NAME="roles.state"
+MACHINATION_CREATIONJOURNALFILE_NAME="create.journal"
+MACHINATION_SSHCONFIGFILE_NAME="ssh.config"
+MACHINATION_IMAGEFILE_NAME="machine.image"
\ No newline at end of file
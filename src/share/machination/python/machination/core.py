@@ -31,20 +31,31 @@ from machination.constants import MACHINATION_INSTALLDIR
 from machination.constants import MACHINATION_USERINSTANCESDIR
 from machination.constants import MACHINATION_CONFIGFILE_NAME
 from machination.constants import MACHINATION_PACKERFILE_NAME
+from machination.constants import MACHINATION_UPDATEPACKERFILE_NAME
+from machination.constants import MACHINATION_CREATIONJOURNALFILE_NAME
+from machination.constants import MACHINATION_SSHCONFIGFILE_NAME
+from machination.constants import MACHINATION_IMAGEFILE_NAME
 
 from machination.provisioners import Provisioner
 from machination.providers import Provider
 
 from machination.globals import MACHINE_TEMPLATE_REGISTRY
+from machination.globals import IMAGE_USAGE
+from machination.globals import ADDRESS_ALLOCATOR
 
 from machination.enums import Architecture
 
-from machination.exceptions import PathNotExistError
-from machination.exceptions import InvalidArgumentValue
 from machination.exceptions import InvalidYAMLException
-from machination.exceptions import InvalidMachineTemplateException
 
-from machination.helpers import accepts
+from machination.helpers import copyTree
+from machination.helpers import writeFileAtomically
+from machination.locks import getInstanceLock
+from machination.locks import getRegistryLock
+from machination.helpers import nextIPAddr
+
+from machination.validation import Schema
+from machination.validation import Rule
+from machination.validation import isTrusted
 from machination.loggers import CORELOGGER
 
 # #
@@ -57,32 +68,31 @@ class NetworkInterface(yaml.YAMLObject):
     _hostname = None
     _hostInterface = None
 
+    SCHEMA = Schema("network interface", [
+               Rule("ip_addr", str, "^(?:(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)|dhcp)$"),
+               Rule("mac_addr", str, "^([0-9a-fA-F]{2}[\.:-]){5}([0-9a-fA-F]{2})$"),
+               Rule("host_interface", str, allowNone=True),
+               Rule("hostname", str, "^([0-9a-zA-Z]*)$", allowNone=True)
+             ])
+
     # ##
     # Constructor
+    # IP Address can be also dhcp
     # ##
-    @accepts(None, str, str, str, None)
-    def __init__(self, ipAddr, macAddr, hostInterface, hostname="None"):
-      # Check each given argument
-      # IP Address can be also dhcp
-      if re.match("^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)|dhcp$", ipAddr):
-        self._ipAddr = ipAddr
-      else:
-        raise InvalidArgumentValue("ipAddr",ipAddr)
-      if re.match("^([0-9a-fA-F]{2}[\.:-]){5}([0-9a-fA-F]{2})$", macAddr):
-        self._macAddr = macAddr
-      else:
-        raise InvalidArgumentValue("macAddr",macAddr)
+    def __init__(self, ipAddr, macAddr, hostInterface, hostname="None", validate=True):
+      self._ipAddr = ipAddr
+      self._macAddr = macAddr
+      self._hostname = hostname
+      self._hostInterface = hostInterface
+      if validate:
+        NetworkInterface.SCHEMA.check(self.getValues())
 
-      if hostname == None or (type(hostname) is str and re.match("^([0-9a-zA-Z]*)$", hostname)):
-        self._hostname = hostname
-      else:
-        raise InvalidArgumentValue("hostname",hostname)
-        
-      if hostInterface == None or (type(hostInterface) is str):
-        self._hostInterface = hostInterface
-      else:
-        raise InvalidArgumentValue("hostInterface",hostInterface)
+    def getValues(self):
+      return {"ip_addr": self._ipAddr, "mac_addr": self._macAddr,
+              "host_interface": self._hostInterface, "hostname": self._hostname}
 
+    def validate(self, context=None):
+      return NetworkInterface.SCHEMA.validate(self.getValues(), context)
 
     # ##
     # Simple getters
@@ -146,30 +156,48 @@ class NetworkInterface(yaml.YAMLObject):
       if "hostname" in representation.keys():
         hostname = representation["hostname"]
 
-      return NetworkInterface(representation["ip_addr"],  representation["mac_addr"], representation["host_interface"], hostname)
+      return NetworkInterface(representation["ip_addr"],  representation["mac_addr"], representation["host_interface"], hostname, not isTrusted(loader))
     
 # ##
 # Class representing a sync folder between host and guest
+# The mode selects how the folder is given to the guest:
+#   bind: the host folder is mounted in the guest
+#   cached, delegated: the host folder is mounted with a relaxed consistency, the host
+#                      (cached) or the guest (delegated) view is authoritative
+#   rsync: the host folder is copied in the guest when it is started, changes made in
+#          the guest are not written back
+#   tmpfs: same as rsync but the copy is stored in memory and discarded when the guest stops
 # ##
 class SharedFolder(yaml.YAMLObject):
     yaml_tag = "!SharedFolder"
     _hostDir = None
     _guestDir = None
+    _mode = None
+
+    MODES = ["bind", "cached", "delegated", "rsync", "tmpfs"]
+
+    SCHEMA = Schema("shared folder", [
+               Rule("host_dir", str, check=os.path.exists, checkMessage="does not exist"),
+               Rule("guest_dir", str, "^(\/.*)$"),
+               Rule("mode", str, check=lambda m: m in SharedFolder.MODES, checkMessage="is not supported")
+             ])
 
     # ##
     # Constructor
+    # Path on the host must exist
     # ##
-    @accepts(None, str, str)
-    def __init__(self, host_dir, guest_dir):
-      # Path on the host must exist
-      if os.path.exists(host_dir):
-        self._hostDir = host_dir
-      else:
-        raise PathNotExistError(host_dir)
-      if re.match("^(\/.*)$",guest_dir):
-        self._guestDir = guest_dir
-      else:
-        raise InvalidArgumentValue("guest_dir",guest_dir)
+    def __init__(self, host_dir, guest_dir, validate=True, mode="bind"):
+      self._hostDir = host_dir
+      self._guestDir = guest_dir
+      self._mode = mode
+      if validate:
+        SharedFolder.SCHEMA.check(self.getValues())
+
+    def getValues(self):
+      return {"host_dir": self._hostDir, "guest_dir": self._guestDir, "mode": self._mode}
+
+    def validate(self, context=None):
+      return SharedFolder.SCHEMA.validate(self.getValues(), context)
 
     # ##
     # Simple getters
@@ -180,11 +208,20 @@ class SharedFolder(yaml.YAMLObject):
     def getGuestDir(self):
       return self._guestDir
 
+    def getMode(self):
+      return self._mode
+
+    # ##
+    # Folders whose content is copied in the guest instead of being mounted from the host
+    # ##
+    def isCopied(self):
+      return self._mode in ["rsync", "tmpfs"]
+
     # ##
     # ToString function
     # ##
     def __str__(self):
-      return self._hostDir + " => " + self._guestDir
+      return "{0} => {1} ({2})".format(self._hostDir, self._guestDir, self._mode)
 
     # ##
     # Function to dump the object as YAML
@@ -193,7 +230,8 @@ class SharedFolder(yaml.YAMLObject):
     def to_yaml(cls, dumper, data):
       representation = {
                          "host_dir" : data.getHostDir(),
-                         "guest_dir" : data.getGuestDir()
+                         "guest_dir" : data.getGuestDir(),
+                         "mode" : data.getMode()
                          }
       return dumper.represent_mapping(data.yaml_tag, representation)
 
@@ -210,8 +248,11 @@ class SharedFolder(yaml.YAMLObject):
       if not "guest_dir" in representation.keys():
           raise InvalidYAMLException("Invalid shared folder: missing guest directory")
 
+      # Folders created before the modes existed are bind mounted
       return SharedFolder(representation["host_dir"],
-                          representation["guest_dir"])
+                          representation["guest_dir"],
+                          not isTrusted(loader),
+                          representation.get("mode", "bind"))
 
 # ##
 # Class representing a machine template
@@ -229,46 +270,24 @@ class MachineTemplate(yaml.YAMLObject):
     _comments = ""
     _roles = []
 
+    SCHEMA = Schema("machine template", [
+               Rule("path", str, check=os.path.exists, checkMessage="does not exist"),
+               Rule("archs", list, elementTypes=Architecture, nonEmpty=True),
+               Rule("os_versions", list, nonEmpty=True),
+               Rule("providers", list, elementTypes=Provider, nonEmpty=True),
+               Rule("provisioners", list, elementTypes=Provisioner, nonEmpty=True),
+               Rule("comments", str),
+               Rule("roles", list, elementTypes=str, nonEmpty=True)
+             ])
+
     # ##
     # Constructor
     # ##
-    @accepts(None, str, list, list, list,list, None,str,list)
-    def __init__(self, path, archs, osVersions , providers, provisioners, guestInterfaces,comments,roles):
-      # Checking the arguments
-
-      if not os.path.exists(path):
-        raise InvalidArgumentValue("Template path",path)
-      if len(archs) == 0:
-        raise InvalidMachineTemplateException("Invalid number of architectures")
-      else:
-        for arch in archs:
-          if type(arch) is not Architecture:
-            raise InvalidMachineTemplateException("Invalid architecture")
-
-      if len(providers) == 0:
-        raise InvalidMachineTemplateException("Invalid number of providers")
-      else:
-        for p in providers:
-          if not isinstance(p,Provider):
-            raise InvalidMachineTemplateException("Invalid provider")
-
-      if len(provisioners) == 0:
-        raise InvalidMachineTemplateException("Invalid number of provisioners")
-      else:
-        for p in provisioners:
-          if not isinstance(p,Provisioner):
-            raise InvalidMachineTemplateException("Invalid provisioner")
-
-      if len(osVersions) == 0:
-        raise InvalidMachineTemplateException("Invalid number of os versions")
-      
-      if len(roles) == 0:
-        raise InvalidMachineTemplateException("Invalid number of roles")
-      else:
-        for r in roles:
-          if not isinstance(r,str):
-            raise InvalidMachineTemplateException("Invalid role")
-      
+    def __init__(self, path, archs, osVersions , providers, provisioners, guestInterfaces,comments,roles,validate=True):
+      if validate:
+        MachineTemplate.SCHEMA.check({"path": path, "archs": archs, "os_versions": osVersions,
+                                      "providers": providers, "provisioners": provisioners,
+                                      "comments": comments, "roles": roles}, path)
       fileName = os.path.basename(path)
       nameAndVersion = os.path.splitext(fileName)[0]
       versionIdx = nameAndVersion.find('.')
@@ -284,6 +303,48 @@ class MachineTemplate(yaml.YAMLObject):
       if type(comments) is str:
         self._comments = comments
 
+    def validate(self):
+      return MachineTemplate.SCHEMA.validate({"path": self._path, "archs": self._archs, "os_versions": self._osVersions,
+                                              "providers": self._providers, "provisioners": self._provisioners,
+                                              "comments": self._comments, "roles": self._roles}, self._path)
+
+    # ##
+    # Function to convert the template into primitive types stored in the compiled templates cache
+    # ##
+    def toCompiled(self):
+      return {
+               "path" : self.getPath(),
+               "archs" : [str(a) for a in self.getArchs()],
+               "os_versions" : list(self.getOsVersions()),
+               "providers" : [str(p) for p in self.getProviders()],
+               "provisioners" : [str(p) for p in self.getProvisioners()],
+               "guest_interfaces" : self.getGuestInterfaces(),
+               "comments" : self.getComments(),
+               "roles" : list(self.getRoles())
+             }
+
+    # ##
+    # Function to create a template from its compiled form
+    # The compiled form has been validated when it was compiled so the checks of the constructor are skipped
+    # ##
+    @classmethod
+    def fromCompiled(cls, data):
+      template = cls.__new__(cls)
+      fileName = os.path.basename(data["path"])
+      nameAndVersion = os.path.splitext(fileName)[0]
+      versionIdx = nameAndVersion.find('.')
+      template._name = nameAndVersion[0:versionIdx]
+      template._version = LooseVersion(nameAndVersion[versionIdx+1:])
+      template._path = data["path"]
+      template._archs = [Architecture.fromString(str(a)) for a in data["archs"]]
+      template._osVersions = data["os_versions"]
+      template._providers = [Provider.fromString(str(p))() for p in data["providers"]]
+      template._provisioners = [Provisioner.fromString(str(p))() for p in data["provisioners"]]
+      template._guestInterfaces = data["guest_interfaces"]
+      template._roles = data["roles"]
+      template._comments = data["comments"]
+      return template
+
     # ##
     # Simple getters
     # ##
@@ -387,7 +448,8 @@ class MachineTemplate(yaml.YAMLObject):
                              provisioners,
                              guestInterfaces,
                              comments,
-                             roles)
+                             roles,
+                             not isTrusted(loader))
 
 # ##
 # Class representing a MachineInstance instance
@@ -404,26 +466,21 @@ class MachineInstance(yaml.YAMLObject):
     _sharedFolders = None
     _packerFile = None
 
+    SCHEMA = Schema("machine instance", [
+               Rule("name", str, nonEmpty=True),
+               Rule("template", MachineTemplate),
+               Rule("arch", Architecture),
+               Rule("os_version", str, nonEmpty=True),
+               Rule("provider", Provider),
+               Rule("provisioner", Provisioner),
+               Rule("guest_interfaces", list, elementTypes=NetworkInterface),
+               Rule("shared_folders", list, elementTypes=SharedFolder)
+             ])
+
     # ##
     # Constructor
     # ##
-    @accepts(None, str, MachineTemplate, Architecture, str, Provider, Provisioner, list, list)
-    def __init__(self, name, template, arch, osVersion, provider, provisioner, guestInterfaces, sharedFolders):
-      # Check the arguments
-      if len(osVersion) == 0:
-        raise InvalidArgumentValue("osVersion",osVersion)
-
-      if len(name) == 0:
-        raise InvalidArgumentValue("name",name)
-        
-      # Manually check the type of list elements
-      for i in guestInterfaces:
-        if not type(i) is NetworkInterface:
-          raise InvalidArgumentValue("guest_interfaces",i)
-
-      for f in sharedFolders:
-        if not type(f) is SharedFolder:
-          raise InvalidArgumentValue("shared_folder",f)
+    def __init__(self, name, template, arch, osVersion, provider, provisioner, guestInterfaces, sharedFolders, validate=True):
       self._name = name
       self._template = template
       self._arch = arch
@@ -433,6 +490,26 @@ class MachineInstance(yaml.YAMLObject):
       self._guestInterfaces = guestInterfaces
       self._sharedFolders = sharedFolders
       self._packerFile = {}
+      if validate:
+        MachineInstance.SCHEMA.check(self.getValues(), name)
+
+    def getValues(self):
+      return {"name": self._name, "template": self._template, "arch": self._arch,
+              "os_version": self._osVersion, "provider": self._provider, "provisioner": self._provisioner,
+              "guest_interfaces": self._guestInterfaces, "shared_folders": self._sharedFolders}
+
+    # ##
+    # Returns all the errors of the instance, including the ones of its interfaces and shared folders
+    # ##
+    def validate(self):
+      errors = MachineInstance.SCHEMA.validate(self.getValues(), self._name)
+      for i in self._guestInterfaces or []:
+        if isinstance(i, NetworkInterface):
+          errors.extend(i.validate(self._name))
+      for f in self._sharedFolders or []:
+        if isinstance(f, SharedFolder):
+          errors.extend(f.validate(self._name))
+      return errors
 
     # ##
     # Simple getters
@@ -445,62 +522,241 @@ class MachineInstance(yaml.YAMLObject):
     
     # ##
     # Function to generate the file attached to the instance
+    # The creation is split in phases recorded in a journal stored in the instance directory.
+    # Once the configuration is written, a failure keeps the directory so that the creation can
+    # be resumed from the first phase that did not complete.
+    # The instance is locked during the whole creation, its name is allocated under the registry lock.
     # ##
     def create(self):
-      # If the machine does not exist yet
-      if not os.path.exists(self.getPath()):
-        # Create its folder and copy the Vagrant file
-        os.makedirs(self.getPath())
+      with getInstanceLock(self.getName()):
+        with getRegistryLock():
+          if os.path.exists(self.getPath()):
+            # Raise an error about the fact the machine already exists
+            raise RuntimeError("MachineInstance instance '{0}' already exists".format(self.getPath()))
+          # Record the addresses of the interfaces, fails if they are used by another instance
+          ADDRESS_ALLOCATOR.allocate(self.getName(), [(i.getHostInterface(), i.getIPAddr(), i.getMACAddr()) for i in self.getGuestInterfaces()])
+          try:
+            os.makedirs(self.getPath())
+          except Exception:
+            ADDRESS_ALLOCATOR.release(self.getName())
+            raise
+        self.runCreation()
+
+    def runCreation(self):
+      try:
+        # Copy the Vagrant file
         shutil.copy(os.path.join(MACHINATION_INSTALLDIR, "share", "machination", "vagrant", "Vagrantfile"), os.path.join(self.getPath(), "Vagrantfile"))
-        try:
-          # Create the machine config file
-          configFile = yaml.dump(self)
-          openedFile = open(os.path.join(self.getPath(), MACHINATION_CONFIGFILE_NAME), "w+")
-          openedFile.write(configFile)
-          openedFile.close()
-          # Generate the file related to the provisioner and the provider
-          variables = {}
-          variables["os_version"] = self.getOsVersion()
-          variables["architecture"] = str(self.getArch())
-          variables["template_name"] = self.getTemplate().getName()
-          variables["template_version"] = str(self.getTemplate().getVersion())
-          self.getPackerFile()["variables"] = variables
-          self.getPackerFile()["builders"] = []
-          self.getPackerFile()["provisioners"] = []
-          self.getPackerFile()["post-processors"] = []
-    
-          self.getProvider().generateFilesFor(self)
-          self.getProvisioner().generateFilesFor(self)
-          
-          outfile = open(os.path.join(self.getPath(),MACHINATION_PACKERFILE_NAME),"w")
-          json.dump(self.getPackerFile(),outfile,indent=2)
-          outfile.close()
-          self.pack()
-          
-        except Exception as e:
+        journal = {"phases": []}
+        self.saveCreationJournal(journal)
+        self.runCreationPhases(journal)
+      except Exception as e:
+        CORELOGGER.debug(traceback.format_exc())
+        if not self.isIncomplete() or "config" not in self.loadCreationJournal()["phases"]:
+          # Nothing can be resumed
           shutil.rmtree(self.getPath())
-          CORELOGGER.debug(traceback.format_exc())
-          raise e
-      else:
-        shutil.rmtree(self.getPath())
-        # Raise an error about the fact the machine already exists
-        raise RuntimeError("MachineInstance instance '{0}' already exists".format(self.getPath()))
+          ADDRESS_ALLOCATOR.release(self.getName())
+        raise e
+
+    # ##
+    # Function to resume an interrupted creation from the first phase that did not complete
+    # ##
+    def resume(self):
+      with getInstanceLock(self.getName()):
+        if not self.isIncomplete():
+          raise RuntimeError("Creation of machine instance '{0}' is not interrupted".format(self.getName()))
+        journal = self.loadCreationJournal()
+        CORELOGGER.debug("Completed creation phases: {0}".format(", ".join(journal["phases"]) or "none"))
+        self.runCreationPhases(journal)
+
+    def getCreationJournalPath(self):
+      return os.path.join(self.getPath(), MACHINATION_CREATIONJOURNALFILE_NAME)
+
+    # ##
+    # An instance is incomplete while its creation journal exists
+    # ##
+    def isIncomplete(self):
+      return os.path.exists(self.getCreationJournalPath())
+
+    def loadCreationJournal(self):
+      openedFile = open(self.getCreationJournalPath(), "r")
+      journal = json.load(openedFile)
+      openedFile.close()
+      return journal
+
+    def saveCreationJournal(self, journal):
+      writeFileAtomically(self.getCreationJournalPath(), json.dumps(journal, indent=2))
+
+    # ##
+    # Function running the creation phases missing from the journal
+    # Each phase is recorded in the journal as soon as it completes, the journal is removed at the end
+    # ##
+    def runCreationPhases(self, journal):
+      phases = [("config", self.writeConfigFile),
+                ("roles", self.stageFiles),
+                ("packer", self.writeStagedPackerFile),
+                ("image", self.buildImage)]
+      for (phase, function) in phases:
+        if phase not in journal["phases"]:
+          CORELOGGER.debug("Running creation phase '{0}' of machine instance '{1}'".format(phase, self.getName()))
+          function(journal)
+          journal["phases"].append(phase)
+          self.saveCreationJournal(journal)
+      os.remove(self.getCreationJournalPath())
 
+    def writeConfigFile(self, journal):
+      writeFileAtomically(os.path.join(self.getPath(), MACHINATION_CONFIGFILE_NAME), yaml.dump(self))
+
+    # ##
+    # Generate the files related to the provisioner and the provider
+    # The packer description is kept in the journal until it is written
+    # ##
+    def stageFiles(self, journal):
+      self.initPackerFile()
+      self.getProvider().generateFilesFor(self)
+      self.getProvisioner().generateFilesFor(self)
+      journal["packer"] = self.getPackerFile()
+
+    def writeStagedPackerFile(self, journal):
+      self._packerFile = journal.pop("packer")
+      self.writePackerFile(MACHINATION_PACKERFILE_NAME)
+
+    # ##
+    # The state of the roles is only recorded when they have been applied for the instance,
+    # an image built before for another instance may hold other versions of the roles
+    # ##
+    def buildImage(self, journal):
+      if self.pack() or self.getProvider().getImageReference(self) == None:
+        self.getProvisioner().saveRolesState(self)
+
+    def initPackerFile(self):
+      variables = {}
+      variables["os_version"] = self.getOsVersion()
+      variables["architecture"] = str(self.getArch())
+      variables["template_name"] = self.getTemplate().getName()
+      variables["template_version"] = str(self.getTemplate().getVersion())
+      self._packerFile = {}
+      self.getPackerFile()["variables"] = variables
+      self.getPackerFile()["builders"] = []
+      self.getPackerFile()["provisioners"] = []
+      self.getPackerFile()["post-processors"] = []
+
+    def writePackerFile(self,fileName):
+      writeFileAtomically(os.path.join(self.getPath(),fileName),json.dumps(self.getPackerFile(),indent=2))
+
+    def runPacker(self,fileName):
+      cmd = "packer build ./{0}".format(fileName)
+      p = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE, cwd=self.getPath())
+      p.communicate()[0]
+      returnCode = p.returncode
+      if returnCode != 0:
+        raise RuntimeError("Error while creating packing '{0}'".format(self.getName()));
+
+    # Returns True if the image has been provisioned
     def pack(self):
       # If the machine does not exist yet
       if os.path.exists(self.getPath()):
+        provisioned = False
         if self.getProvider().needsProvision(self):
           CORELOGGER.debug("Image needs provisioning, starting packer...")
-          cmd = "packer build ./{0}".format(MACHINATION_PACKERFILE_NAME)
-          
-          # Fire up the vagrant machine
-          p = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE, cwd=self.getPath())
-          p.communicate()[0]
-          returnCode = p.returncode
-          if returnCode != 0:
-            raise RuntimeError("Error while creating packing '{0}'".format(self.getName()));
+          self.runPacker(MACHINATION_PACKERFILE_NAME)
+          provisioned = True
+        # Keep track of the use of the image for the garbage collector
+        image = self.getProvider().getImageReference(self)
+        if image != None:
+          IMAGE_USAGE.touch(image)
+        return provisioned
       else:
             raise RuntimeError("Error while packing machine '{0}'".format(self.getName()));
+
+    # ##
+    # Function to re-apply the roles that changed since the instance has been created
+    # The image of the instance is provisioned again with the outdated roles only, the result
+    # is given to the instance alone then its machine is created again from it
+    # Returns the list of re-applied roles
+    # ##
+    def update(self,dryRun=False):
+      with getInstanceLock(self.getName()):
+        roles = self.getProvisioner().getOutdatedRoles(self)
+        if len(roles) == 0 or dryRun:
+          return roles
+        CORELOGGER.debug("Roles to re-apply: {0}".format(", ".join(roles)))
+        self.initPackerFile()
+        self.getProvider().generateUpdateFilesFor(self)
+        self.getProvisioner().generateUpdateFilesFor(self,roles)
+        if len(self.getPackerFile()["builders"]) != 0:
+          self.writePackerFile(MACHINATION_UPDATEPACKERFILE_NAME)
+          self.runPacker(MACHINATION_UPDATEPACKERFILE_NAME)
+          self.getProvider().invalidateSSHConfig(self)
+          self.getProvider().applyUpdate(self)
+        self.getProvisioner().saveRolesState(self)
+        return roles
+    # ##
+    # Function to create a copy of the instance under another name
+    # The image of the instance is reused, only the name, MAC and IP related fields are generated again
+    # The source is locked in shared mode and the copy in exclusive mode, in the order of their names
+    # ##
+    def clone(self,name,usedIPAddrs=None):
+      locks = [getInstanceLock(n, shared) for (n, shared) in sorted([(self.getName(), True), (name, False)])]
+      acquired = []
+      try:
+        for l in locks:
+          l.acquire()
+          acquired.append(l)
+        return self.copyTo(name, usedIPAddrs)
+      finally:
+        for l in reversed(acquired):
+          l.release()
+
+    def copyTo(self,name,usedIPAddrs=None):
+      if usedIPAddrs == None:
+        usedIPAddrs = []
+      if self.isIncomplete():
+        raise RuntimeError("Creation of machine instance '{0}' is not complete".format(self.getName()))
+      clonePath = os.path.join(MACHINATION_USERINSTANCESDIR, name)
+      with getRegistryLock():
+        if os.path.exists(clonePath):
+          raise RuntimeError("MachineInstance instance '{0}' already exists".format(clonePath))
+        os.makedirs(clonePath)
+      addresses = []
+      try:
+        for i in self.getGuestInterfaces():
+          ipAddr = i.getIPAddr()
+          if ipAddr != "dhcp":
+            # Addresses are taken from the pool of the host interface when one is declared,
+            # otherwise from the network the guest address is configured in
+            if ADDRESS_ALLOCATOR.hasPool(i.getHostInterface()):
+              ipAddr = "auto"
+            else:
+              ipAddr = nextIPAddr(ipAddr,usedIPAddrs,ADDRESS_ALLOCATOR.getPrefix(i.getHostInterface()))
+              usedIPAddrs.append(ipAddr)
+          addresses.append((i.getHostInterface(), ipAddr, "auto"))
+        addresses = ADDRESS_ALLOCATOR.allocate(name, addresses)
+      except Exception:
+        os.rmdir(clonePath)
+        raise
+      guestInterfaces = []
+      for (i, (hostInterface, ipAddr, macAddr)) in zip(self.getGuestInterfaces(), addresses):
+        hostname = None
+        if i.getHostname() != "":
+          hostname = re.sub("[^0-9a-zA-Z]","",name)
+        guestInterfaces.append(NetworkInterface(ipAddr, macAddr, hostInterface, hostname))
+      instance = MachineInstance(name, self.getTemplate(), self.getArch(), self.getOsVersion(),
+                                 self.getProvider(), self.getProvisioner(), guestInterfaces, self.getSharedFolders())
+      try:
+        # Runtime state and build artifacts of the source instance are not copied, the configuration
+        # is written last: the registry only lists the directories holding one (see
+        # MachineInstanceRegistry.isInstanceDir) so the copy is not seen before it is complete
+        copyTree(self.getPath(), clonePath, self.getProvider().getTransientFiles(self) + [MACHINATION_CONFIGFILE_NAME, MACHINATION_SSHCONFIGFILE_NAME,
+                                                                                        MACHINATION_IMAGEFILE_NAME])
+        self.getProvider().copyImage(self, instance)
+        writeFileAtomically(os.path.join(clonePath, MACHINATION_CONFIGFILE_NAME), yaml.dump(instance))
+      except Exception as e:
+        shutil.rmtree(clonePath)
+        ADDRESS_ALLOCATOR.release(name)
+        CORELOGGER.debug(traceback.format_exc())
+        raise e
+      return instance
+
     # ##
     # Simple getters
     # ##
@@ -536,33 +792,28 @@ class MachineInstance(yaml.YAMLObject):
     # This function must be ran as root as some action in the the provisioner or the provider may require a root access
     # ##
     def start(self):
-      # Fire up the vagrant machine
-      self.pack()
-      p = subprocess.Popen("vagrant up", shell=True, stderr=subprocess.PIPE, cwd=self.getPath())
-      err = p.communicate()[1]
-      if p.returncode != 0:
-        CORELOGGER.critical(err)
-        raise RuntimeError("Error while starting machine instance: '{0}'".format(self.getName()));
+      with getInstanceLock(self.getName()):
+        self.pack()
+        self.getProvider().invalidateSSHConfig(self)
+        self.getProvider().start(self)
 
     # ##
     # Function to destroy an instance
     # ##  
     def destroy(self):
-      # Destroy the vagrant machine
-      p = subprocess.Popen("vagrant destroy -f", shell=True, stdout=subprocess.PIPE, cwd=self.getPath())
-      p.wait()
-      if p.returncode != 0:
-        raise RuntimeError("Error while destroying machine instance '{0}'".format(self.getName()));
-      shutil.rmtree(self.getPath())
+      with getInstanceLock(self.getName()):
+        self.getProvider().invalidateSSHConfig(self)
+        self.getProvider().destroy(self)
+        shutil.rmtree(self.getPath())
+        ADDRESS_ALLOCATOR.release(self.getName())
 
     # ##
     # Function to stop an instance
     # ##
     def stop(self):
-      p = subprocess.Popen("vagrant halt", shell=True, stderr=subprocess.PIPE, cwd=self.getPath())
-      p.communicate()[0]
-      if p.returncode != 0:
-        raise RuntimeError("Error while stopping machine instance: '{0}'".format(self.getName()));
+      with getInstanceLock(self.getName()):
+        self.getProvider().invalidateSSHConfig(self)
+        self.getProvider().stop(self)
 
     # ##
     # ##
@@ -579,17 +830,11 @@ class MachineInstance(yaml.YAMLObject):
           output += "  State: Stopped\n"
 
       output +="  Network interfaces:\n"
-      ipAddrSearchGroup = None
+      ipAddrSearch = None
       if(isStarted):
-        p = subprocess.Popen("vagrant ssh-config", shell=True,  stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self.getPath())
-        out = p.communicate()[0]   
-        if p.returncode == 0:
-          ipAddrSearchGroup = re.search("HostName (.*)",out)
-          
-      if ipAddrSearchGroup == None:
+        ipAddrSearch = self.getProvider().getIPAddr(self)
+      if ipAddrSearch == None:
         ipAddrSearch = "N/A"
-      else:
-        ipAddrSearch = ipAddrSearchGroup.group(1)
         
       output += "    - Name: eth{0}\n".format(i)
       output += "      IPAddress: {0}\n".format(ipAddrSearch)
@@ -608,6 +853,7 @@ class MachineInstance(yaml.YAMLObject):
         for f in self.getSharedFolders():
           output += "    - Host folder: {0}\n".format(f.getHostDir())
           output += "      Guest folder: {0}\n".format(f.getGuestDir())
+          output += "      Mode: {0}\n".format(f.getMode())
             
       return output
 
@@ -616,32 +862,12 @@ class MachineInstance(yaml.YAMLObject):
     # ##
     def ssh(self,command = None):
       if(self.isStarted()):
-        # Start vagrant ssh to ssh into the instance
-        if(command == None):
-          val = subprocess.Popen("vagrant ssh", shell=True, stderr=subprocess.PIPE, cwd=self.getPath())
-        else:
-          print("vagrant ssh -c {0}".format(command))
-          val = subprocess.Popen("vagrant ssh -c \"{0}\"".format(command), shell=True, stderr=subprocess.PIPE, cwd=self.getPath())
-        # get the output of the machine
-        while True:
-            out = val.stderr.read(1)
-            if out == '' and val.poll() != None:
-                break
-            if out != '':
-                sys.stdout.write(out)
-                sys.stdout.flush()
+        return self.getProvider().ssh(self,command)
       else:
         raise RuntimeError("Machine instance not started")
 
     def isStarted(self):
-      p = subprocess.Popen("vagrant status", shell=True,  stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self.getPath())
-      isStarted = False
-      out = p.communicate()[0]
-      isStarted = (isStarted or (re.search("(.*)machination-{0}(.*)running(.*)".format(self.getName()),out) != None)) 
-      if p.returncode == 0 and isStarted:
-        return True
-      else:
-        return False
+      return self.getProvider().isStarted(self)
       
     # ##
     # Function to dump the object to YAML
@@ -705,4 +931,5 @@ class MachineInstance(yaml.YAMLObject):
                                    provider,
                                    provisioner,
                                    guestInterfaces,
-                                   sharedFolders)
+                                   sharedFolders,
+                                   not isTrusted(loader))
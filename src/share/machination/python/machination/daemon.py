@@ -0,0 +1,242 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import sys
+import time
+import errno
+import socket
+import threading
+import traceback
+
+from machination.cmdline import CmdLine
+from machination.exceptions import DaemonException
+from machination.globals import DOCKER_CLIENT
+from machination.globals import MACHINE_INSTANCE_REGISTRY
+from machination.globals import MACHINE_TEMPLATE_REGISTRY
+from machination.globals import ROLE_REGISTRY
+from machination.loggers import DAEMONLOGGER
+from machination.loggers import strHandler
+from machination.helpers import mkdir_p
+from machination.rpc import DaemonClient
+from machination.rpc import MessageReader
+from machination.rpc import sendMessage
+from machination.rpc import RPC_VERSION
+from machination.rpc import RPC_TIMEOUT
+from machination.watcher import createWatcher
+from machination.watcher import TEMPLATE_CHANGE
+from machination.watcher import INSTANCE_CHANGE
+from machination.watcher import ROLE_CHANGE
+from machination.constants import MACHINATION_USERTEMPLATESDIR
+from machination.constants import MACHINATION_USERANSIBLEROLESDIR
+
+# Time to wait before following the docker events again after an error, in seconds
+EVENTS_RETRY_DELAY = 5
+
+# ##
+# Stream sending what is written to the client of a request
+# Errors are ignored so that a client going away does not stop the command
+# ##
+class SocketOutput:
+  _sock = None
+  _name = None
+  _closed = False
+  _lock = threading.Lock()
+
+  def __init__(self, sock, name):
+    self._sock = sock
+    self._name = name
+
+  def write(self, data):
+    if self._closed or len(data) == 0:
+      return
+    if isinstance(data, bytes) and not isinstance(data, str):
+      data = data.decode("utf-8", "replace")
+    try:
+      # Threads of the daemon may log while a command runs
+      with SocketOutput._lock:
+        sendMessage(self._sock, {"stream": self._name, "output": data})
+    except socket.error:
+      self._closed = True
+
+  def flush(self):
+    pass
+
+  def isatty(self):
+    return False
+
+# ##
+# Thread following the events of the docker engine
+# The lists and inspections of the docker client are cached as long as the events are received,
+# the cache is cleared on each event. Events are requested from the time the cache is enabled so
+# that a change made before the stream is established is not missed.
+# ##
+class DockerEventsFollower(threading.Thread):
+  _client = None
+
+  def __init__(self, client):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._client = client
+
+  def run(self):
+    while True:
+      try:
+        since = time.time()
+        self._client.enableCache()
+        for event in self._client.getEvents(since=since):
+          self._client.invalidateCache()
+        DAEMONLOGGER.debug("Docker events stream closed.")
+      except Exception as e:
+        DAEMONLOGGER.debug("Unable to follow docker events: {0}".format(str(e)))
+      self._client.disableCache()
+      time.sleep(EVENTS_RETRY_DELAY)
+
+# ##
+# Daemon serving the machination commands on a unix socket
+# Registries and docker data stay in memory between the commands, the registries are updated
+# from the changes of their directories. Commands are run one at a time in the daemon process,
+# their output is sent to the client as it is written.
+# ##
+class MachinationDaemon:
+  _socketPath = None
+  _server = None
+  _polling = False
+
+  def __init__(self, socketPath, polling=False):
+    self._socketPath = socketPath
+    self._polling = polling
+
+  def getSocketPath(self):
+    return self._socketPath
+
+  def bind(self):
+    if DaemonClient(self._socketPath).isRunning():
+      raise DaemonException("A daemon is already listening on '{0}'".format(self._socketPath))
+    mkdir_p(os.path.dirname(self._socketPath))
+    if os.path.exists(self._socketPath):
+      os.remove(self._socketPath)
+    self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._server.bind(self._socketPath)
+    os.chmod(self._socketPath, 0o600)
+    self._server.listen(16)
+
+  # ##
+  # Watch the directories of the registries
+  # The watcher is started before the registries are loaded so that no change is missed
+  # ##
+  def watch(self):
+    mkdir_p(MACHINATION_USERTEMPLATESDIR)
+    mkdir_p(MACHINATION_USERANSIBLEROLESDIR)
+    roots = [(TEMPLATE_CHANGE, d, 1) for d in MACHINE_TEMPLATE_REGISTRY.getTemplateDirs()]
+    roots += [(INSTANCE_CHANGE, d, 2) for d in MACHINE_INSTANCE_REGISTRY.getInstanceDirs()]
+    roots += [(ROLE_CHANGE, d, None) for d in ROLE_REGISTRY.getRoleDirs()]
+    watcher = createWatcher(roots, self._polling)
+    for registry in [MACHINE_TEMPLATE_REGISTRY, MACHINE_INSTANCE_REGISTRY, ROLE_REGISTRY]:
+      watcher.addListener(registry.applyChanges)
+      registry.setWatched(True)
+    watcher.start()
+    DAEMONLOGGER.debug("Watching {0} directories with {1}.".format(len(roots), type(watcher).__name__))
+
+  # ##
+  # Load the templates and the instances before the first command
+  # ##
+  def warmUp(self):
+    templates = MACHINE_TEMPLATE_REGISTRY.getTemplates()
+    instances = MACHINE_INSTANCE_REGISTRY.getInstances()
+    for i in instances.values():
+      try:
+        i.load()
+      except Exception as e:
+        DAEMONLOGGER.debug("Unable to load instance '{0}': {1}".format(i.getName(), str(e)))
+    DAEMONLOGGER.debug("{0} template(s) and {1} instance(s) loaded.".format(len(templates), len(instances)))
+
+  def serve(self):
+    self.bind()
+    self.watch()
+    self.warmUp()
+    DockerEventsFollower(DOCKER_CLIENT).start()
+    DAEMONLOGGER.info("Listening on '{0}'".format(self._socketPath))
+    try:
+      while True:
+        try:
+          (conn, addr) = self._server.accept()
+        except socket.error as e:
+          if e.errno == errno.EINTR:
+            continue
+          raise
+        try:
+          conn.settimeout(RPC_TIMEOUT)
+          self.handle(conn)
+        except Exception as e:
+          DAEMONLOGGER.error("Unable to serve request: {0}".format(str(e)))
+          DAEMONLOGGER.debug(traceback.format_exc())
+        finally:
+          conn.close()
+    finally:
+      self.close()
+
+  def close(self):
+    if self._server != None:
+      self._server.close()
+      self._server = None
+      if os.path.exists(self._socketPath):
+        os.remove(self._socketPath)
+
+  def handle(self, conn):
+    request = MessageReader(conn).read()
+    if request == None:
+      return
+    if request.get("version", None) != RPC_VERSION or type(request.get("argv", None)) is not list:
+      sendMessage(conn, {"error": "Unsupported request"})
+      return
+    DAEMONLOGGER.debug("Running '{0}'".format(" ".join(request["argv"])))
+    start = time.time()
+    res = self.execute(request["argv"], request.get("cwd", None), conn)
+    sendMessage(conn, {"exit": res})
+    DAEMONLOGGER.debug("'{0}' ended with code {1} in {2:.3f}s".format(" ".join(request["argv"]), res, time.time() - start))
+
+  # ##
+  # Run a command with its output redirected to the client
+  # ##
+  def execute(self, argv, cwd, conn):
+    streams = (sys.stdout, sys.stderr, strHandler.stream)
+    workingDir = os.getcwd()
+    res = 0
+    try:
+      if cwd != None and os.path.isdir(cwd):
+        os.chdir(cwd)
+      sys.stdout = SocketOutput(conn, "stdout")
+      sys.stderr = SocketOutput(conn, "stderr")
+      strHandler.stream = sys.stdout
+      try:
+        res = CmdLine().parseArgs(["machination"] + [str(a) for a in argv])
+      except SystemExit as e:
+        res = e.code
+      except Exception as e:
+        sys.stderr.write("Error: {0}\n".format(str(e)))
+        DAEMONLOGGER.debug(traceback.format_exc())
+        res = errno.EINVAL
+    finally:
+      (sys.stdout, sys.stderr, strHandler.stream) = streams
+      os.chdir(workingDir)
+    if res == None:
+      return 0
+    if type(res) is not int:
+      return 1
+    return res
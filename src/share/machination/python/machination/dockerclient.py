@@ -0,0 +1,287 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import json
+import socket
+import threading
+
+try:
+  import httplib
+  from urllib import urlencode, quote
+except ImportError:
+  import http.client as httplib
+  from urllib.parse import urlencode, quote
+
+from machination.exceptions import DockerEngineException
+from machination.loggers import PROVIDERSLOGGER
+
+DOCKER_DEFAULT_SOCKET = "/var/run/docker.sock"
+
+# ##
+# HTTP connection going through a unix socket
+# ##
+class UnixHTTPConnection(httplib.HTTPConnection):
+  _socketPath = None
+
+  def __init__(self, socketPath, timeout=60):
+    httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+    self._socketPath = socketPath
+
+  def connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(self.timeout)
+    sock.connect(self._socketPath)
+    self.sock = sock
+
+# ##
+# Minimal client of the Docker Engine API
+# The connection to the daemon is kept open and reused between calls
+# Lists and inspections can be cached by a long running process following the events of the
+# engine, the cache is cleared on each event and on each modification made through the client
+# ##
+class DockerClient:
+  _socketPath = None
+  _connection = None
+  _lock = None
+  _timeout = 60
+  _cache = None
+  _cacheLock = None
+
+  def __init__(self, socketPath=None, timeout=60):
+    if socketPath == None:
+      socketPath = DOCKER_DEFAULT_SOCKET
+      dockerHost = os.getenv("DOCKER_HOST", "")
+      if dockerHost.startswith("unix://"):
+        socketPath = dockerHost[len("unix://"):]
+    self._socketPath = socketPath
+    self._timeout = timeout
+    self._lock = threading.Lock()
+    self._cacheLock = threading.Lock()
+
+  def getSocketPath(self):
+    return self._socketPath
+
+  # ##
+  # Check if the daemon can be reached
+  # ##
+  def isAvailable(self):
+    try:
+      return self.request("GET", "/_ping", raw=True)[0] == 200
+    except (DockerEngineException, socket.error):
+      return False
+
+  def enableCache(self):
+    with self._cacheLock:
+      self._cache = {}
+
+  def disableCache(self):
+    with self._cacheLock:
+      self._cache = None
+
+  def isCacheEnabled(self):
+    return self._cache != None
+
+  def invalidateCache(self):
+    with self._cacheLock:
+      if self._cache != None:
+        self._cache = {}
+
+  # ##
+  # Returns the result of the function, from the cache when it is enabled
+  # ##
+  def cached(self, key, function):
+    with self._cacheLock:
+      if self._cache != None and key in self._cache.keys():
+        return self._cache[key]
+    value = function()
+    with self._cacheLock:
+      if self._cache != None:
+        self._cache[key] = value
+    return value
+
+  def close(self):
+    with self._lock:
+      if self._connection != None:
+        self._connection.close()
+        self._connection = None
+
+  # ##
+  # Send a request to the daemon and returns its status and its decoded body
+  # The request is sent again on a new connection if the persistent one has been closed
+  # ##
+  def request(self, method, url, body=None, params=None, raw=False):
+    if params != None:
+      url += "?" + urlencode(params)
+    headers = {}
+    if body != None:
+      body = json.dumps(body)
+      headers["Content-Type"] = "application/json"
+    with self._lock:
+      for attempt in range(0, 2):
+        if self._connection == None:
+          self._connection = UnixHTTPConnection(self._socketPath, self._timeout)
+        try:
+          self._connection.request(method, url, body, headers)
+          response = self._connection.getresponse()
+          data = response.read()
+          break
+        except (httplib.HTTPException, socket.error) as e:
+          self._connection.close()
+          self._connection = None
+          if attempt == 1:
+            raise DockerEngineException("Unable to reach docker daemon on '{0}': {1}".format(self._socketPath, str(e)))
+          PROVIDERSLOGGER.debug("Connection to docker daemon lost, reconnecting...")
+    if not isinstance(data, str):
+      data = data.decode("utf-8")
+    if raw or len(data) == 0:
+      return (response.status, data)
+    try:
+      return (response.status, json.loads(data))
+    except ValueError:
+      return (response.status, data)
+
+  def checkedRequest(self, method, url, body=None, params=None, accepted=(200, 201, 204, 304)):
+    if method != "GET":
+      self.invalidateCache()
+    (status, data) = self.request(method, url, body, params)
+    if status not in accepted:
+      message = data
+      if isinstance(data, dict) and "message" in data.keys():
+        message = data["message"]
+      raise DockerEngineException("{0} {1} failed ({2}): {3}".format(method, url, status, message))
+    return data
+
+  # ##
+  # Images
+  # ##
+  def getImages(self, all=True):
+    return self.cached(("images", all), lambda: self.checkedRequest("GET", "/images/json", params={"all": int(all)}))
+
+  def inspectImage(self, name):
+    def inspect():
+      (status, data) = self.request("GET", "/images/{0}/json".format(quote(name, safe="")))
+      if status == 404:
+        return None
+      if status != 200:
+        raise DockerEngineException("Unable to inspect image '{0}': {1}".format(name, data))
+      return data
+    return self.cached(("image", name), inspect)
+
+  def hasImage(self, repository, tag="latest"):
+    return self.inspectImage("{0}:{1}".format(repository, tag)) != None
+
+  def removeImage(self, name, force=False):
+    self.checkedRequest("DELETE", "/images/{0}".format(quote(name, safe="")), params={"force": int(force)})
+
+  # ##
+  # Disk usage of the engine, the size of the layers shared by several images is given apart
+  # ##
+  def getDiskUsage(self):
+    return self.checkedRequest("GET", "/system/df")
+
+  def tagImage(self, name, repository, tag, force=False):
+    self.checkedRequest("POST", "/images/{0}/tag".format(quote(name, safe="")), params={"repo": repository, "tag": tag, "force": int(force)})
+
+  # ##
+  # Containers
+  # ##
+  def getContainers(self, all=True, filters=None):
+    params = {"all": int(all)}
+    if filters != None:
+      params["filters"] = json.dumps(filters, sort_keys=True)
+    return self.cached(("containers", params.get("all"), params.get("filters")),
+                       lambda: self.checkedRequest("GET", "/containers/json", params=params))
+
+  # ##
+  # Create a container, config is the body expected by the engine API
+  # Returns the id of the new container
+  # ##
+  def createContainer(self, name, config):
+    return self.checkedRequest("POST", "/containers/create", config, {"name": name})["Id"]
+
+  def renameContainer(self, name, newName):
+    self.checkedRequest("POST", "/containers/{0}/rename".format(quote(name, safe="")), params={"name": newName})
+
+  def inspectContainer(self, name):
+    def inspect():
+      (status, data) = self.request("GET", "/containers/{0}/json".format(quote(name, safe="")))
+      if status == 404:
+        return None
+      if status != 200:
+        raise DockerEngineException("Unable to inspect container '{0}': {1}".format(name, data))
+      return data
+    return self.cached(("container", name), inspect)
+
+  def isContainerRunning(self, name):
+    infos = self.inspectContainer(name)
+    return infos != None and infos["State"]["Running"] == True
+
+  def startContainer(self, name):
+    self.checkedRequest("POST", "/containers/{0}/start".format(quote(name, safe="")))
+
+  def stopContainer(self, name, timeout=10):
+    self.checkedRequest("POST", "/containers/{0}/stop".format(quote(name, safe="")), params={"t": timeout})
+
+  def removeContainer(self, name, force=False, volumes=False):
+    self.checkedRequest("DELETE", "/containers/{0}".format(quote(name, safe="")),
+                        params={"force": int(force), "v": int(volumes)})
+
+  # ##
+  # Events
+  # Events are yielded as they are received on a dedicated connection
+  # When until is given, the daemon ends the stream once the time range is covered
+  # ##
+  def getEvents(self, since=None, until=None, filters=None):
+    params = {}
+    if since != None:
+      params["since"] = int(since)
+    if until != None:
+      params["until"] = int(until)
+    if filters != None:
+      params["filters"] = json.dumps(filters)
+    url = "/events"
+    if len(params) != 0:
+      url += "?" + urlencode(params)
+    connection = UnixHTTPConnection(self._socketPath, None)
+    try:
+      connection.request("GET", url)
+      response = connection.getresponse()
+      if response.status != 200:
+        raise DockerEngineException("Unable to retrieve docker events: {0}".format(response.read()))
+      decoder = json.JSONDecoder()
+      buf = ""
+      while True:
+        chunk = response.read(1)
+        if not chunk:
+          break
+        if not isinstance(chunk, str):
+          chunk = chunk.decode("utf-8")
+        buf += chunk
+        stripped = buf.lstrip()
+        if stripped.endswith("}"):
+          try:
+            (event, end) = decoder.raw_decode(stripped)
+            buf = stripped[end:]
+            yield event
+          except ValueError:
+            pass
+    except socket.error as e:
+      raise DockerEngineException("Unable to reach docker daemon on '{0}': {1}".format(self._socketPath, str(e)))
+    finally:
+      connection.close()
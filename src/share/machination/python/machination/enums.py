@@ -17,7 +17,6 @@
 ##########################################################################
 
 from enum import Enum
-from machination.helpers import accepts
 from machination.exceptions import InvalidArgumentValue
 
 class StringifiedEnum(Enum):  
@@ -29,7 +28,6 @@ class Architecture(StringifiedEnum):
     x64 = "x64"
     
     @staticmethod
-    @accepts(str)
     def fromString(val):
         vals = {
                 "i386" : Architecture.i386,
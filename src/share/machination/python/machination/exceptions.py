@@ -121,3 +121,77 @@ class InvalidHardwareSupport(Exception):
 
     def __str__(self):
         return repr(self._message)
+
+class DockerEngineException(Exception):
+    _message = ""
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return repr(self._message)
+
+class InvalidFleetManifestException(Exception):
+    _message = ""
+    _errors = []
+    def __init__(self, message, errors):
+        self._message = message
+        self._errors = errors
+
+    def getErrors(self):
+        return self._errors
+
+    def __str__(self):
+        return "{0}:\n  - {1}".format(self._message, "\n  - ".join(self._errors))
+
+class InvalidImageBundleException(Exception):
+    _message = ""
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return repr(self._message)
+
+class ValidationException(ValueError):
+    _message = ""
+    _errors = []
+    def __init__(self, message, errors):
+        self._message = message
+        self._errors = errors
+
+    def getErrors(self):
+        return self._errors
+
+    def __str__(self):
+        return "{0}:\n  - {1}".format(self._message, "\n  - ".join(self._errors))
+
+class NetworkAttachmentException(Exception):
+    _message = ""
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return repr(self._message)
+
+class AddressAllocationException(Exception):
+    _message = ""
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return repr(self._message)
+
+class DaemonException(Exception):
+    _message = ""
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return repr(self._message)
+
+class WatcherException(Exception):
+    _message = ""
+    def __init__(self, message):
+        self._message = message
+
+    def __str__(self):
+        return repr(self._message)
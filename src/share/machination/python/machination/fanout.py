@@ -0,0 +1,124 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import sys
+import time
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from machination.loggers import CORELOGGER
+
+# Exit code reported for an instance on which the command could not be started
+FANOUT_ERROR_CODE = 255
+
+# ##
+# Result of a command ran on one instance
+# ##
+class CommandResult:
+  _name = None
+  _returnCode = None
+  _duration = 0
+  _output = None
+
+  def __init__(self, name, returnCode, duration, output):
+    self._name = name
+    self._returnCode = returnCode
+    self._duration = duration
+    self._output = output
+
+  def getName(self):
+    return self._name
+
+  def getReturnCode(self):
+    return self._returnCode
+
+  def getDuration(self):
+    return self._duration
+
+  def getOutput(self):
+    return self._output
+
+# ##
+# Class running a command on several instances concurrently
+# At most jobs instances run the command at the same time. Their output lines are written as they come,
+# prefixed with the name of the instance, or collected and written instance by instance when collect is set.
+# ##
+class CommandFanOut:
+  _jobs = 1
+  _collect = False
+  _stream = None
+  _lock = None
+  _width = 0
+
+  def __init__(self, jobs, collect=False, stream=None):
+    self._jobs = max(1, jobs)
+    self._collect = collect
+    self._stream = stream or sys.stdout
+    self._lock = threading.Lock()
+
+  def write(self, text):
+    with self._lock:
+      self._stream.write(text)
+      self._stream.flush()
+
+  def writeLine(self, name, line):
+    if not self._collect:
+      self.write("{0} | {1}\n".format(name.ljust(self._width), line))
+
+  def runOne(self, instance, command):
+    start = time.time()
+    output = []
+    try:
+      if not instance.isStarted():
+        raise RuntimeError("instance is not started")
+      p = instance.getProvider().execute(instance, command)
+      for line in iter(p.stdout.readline, b""):
+        if not isinstance(line, str):
+          line = line.decode("utf-8", "replace")
+        line = line.rstrip("\r\n")
+        output.append(line)
+        self.writeLine(instance.getName(), line)
+      p.wait()
+      returnCode = p.returncode
+    except Exception as e:
+      CORELOGGER.debug(traceback.format_exc())
+      line = "machination: unable to run the command: {0}".format(str(e))
+      output.append(line)
+      self.writeLine(instance.getName(), line)
+      returnCode = FANOUT_ERROR_CODE
+    result = CommandResult(instance.getName(), returnCode, time.time() - start, output)
+    if self._collect:
+      self.write("==> {0} (exit code {1}, {2:.2f}s)\n{3}".format(instance.getName(), returnCode, result.getDuration(),
+                                                               "".join(l + "\n" for l in output)))
+    return result
+
+  # ##
+  # Run the command on the given instances
+  # Returns the results in the order of the instances
+  # ##
+  def run(self, instances, command):
+    if len(instances) == 0:
+      return []
+    self._width = max(len(i.getName()) for i in instances)
+    pool = ThreadPool(min(self._jobs, len(instances)))
+    try:
+      return pool.map(lambda i: self.runOne(i, command), instances)
+    finally:
+      pool.close()
+      pool.join()
@@ -0,0 +1,301 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import yaml
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from machination.core import MachineInstance
+from machination.core import NetworkInterface
+from machination.core import SharedFolder
+
+from machination.enums import Architecture
+from machination.providers import Provider
+from machination.provisioners import Provisioner
+
+from machination.exceptions import InvalidFleetManifestException
+
+from machination.helpers import randomMAC
+from machination.loggers import FLEETLOGGER
+
+# ##
+# Class representing one instance described in a fleet manifest
+# ##
+class FleetInstance:
+  _instance = None
+  _explicitMACs = None
+
+  def __init__(self, instance, explicitMACs):
+    self._instance = instance
+    self._explicitMACs = explicitMACs
+
+  def getInstance(self):
+    return self._instance
+
+  def getName(self):
+    return self._instance.getName()
+
+  # ##
+  # Key identifying the image needed by the instance
+  # Instances sharing the same key share the same image build
+  # ##
+  def getImageKey(self):
+    return (str(self._instance.getProvider()),
+            str(self._instance.getTemplate()),
+            str(self._instance.getArch()),
+            self._instance.getOsVersion(),
+            str(self._instance.getProvisioner()))
+
+  # ##
+  # Check if an existing instance matches the description
+  # MAC addresses are only compared when they are given in the manifest
+  # ##
+  def matches(self, existing):
+    if FleetInstance.describe(existing, self._explicitMACs) != FleetInstance.describe(self._instance, self._explicitMACs):
+      return False
+    return True
+
+  @staticmethod
+  def describe(instance, withMACs):
+    interfaces = []
+    for idx, i in enumerate(instance.getGuestInterfaces()):
+      mac = None
+      if idx < len(withMACs) and withMACs[idx]:
+        mac = i.getMACAddr().lower()
+      interfaces.append((i.getHostInterface(), i.getIPAddr(), mac, i.getHostname()))
+    folders = [(f.getHostDir(), f.getGuestDir(), f.getMode()) for f in instance.getSharedFolders()]
+    return (str(instance.getTemplate()),
+            str(instance.getArch()),
+            instance.getOsVersion(),
+            str(instance.getProvider()),
+            str(instance.getProvisioner()),
+            interfaces,
+            folders)
+
+# ##
+# Class representing a fleet manifest
+# A manifest is a YAML file listing the instances to create:
+#   workers: 4
+#   instances:
+#     - name: web1
+#       template: basebox:1.0
+#       arch: x64
+#       os_version: trusty
+#       provider: docker
+#       guest_interfaces:
+#         - { host_interface: eth0, ip_addr: dhcp }
+#       shared_folders:
+#         - { host_dir: /srv/www, guest_dir: /var/www, mode: cached }
+# ##
+class FleetManifest:
+  _path = None
+  _workers = 1
+  _instances = None
+
+  def __init__(self, path, workers, instances):
+    self._path = path
+    self._workers = workers
+    self._instances = instances
+
+  def getPath(self):
+    return self._path
+
+  def getWorkers(self):
+    return self._workers
+
+  def getInstances(self):
+    return self._instances
+
+  # ##
+  # Load and validate the whole manifest
+  # All the errors are reported at once
+  # ##
+  @staticmethod
+  def load(path, templates):
+    errors = []
+    openedFile = open(path, "r")
+    try:
+      representation = yaml.safe_load(openedFile)
+    except yaml.YAMLError as e:
+      raise InvalidFleetManifestException("Invalid fleet manifest '{0}'".format(path), [str(e)])
+    finally:
+      openedFile.close()
+
+    if type(representation) is not dict or type(representation.get("instances")) is not list:
+      raise InvalidFleetManifestException("Invalid fleet manifest '{0}'".format(path), ["Missing list of instances"])
+
+    workers = representation.get("workers", 1)
+    if type(workers) is not int or workers < 1:
+      errors.append("Invalid number of workers: {0}".format(workers))
+      workers = 1
+
+    instances = []
+    names = set()
+    for idx, desc in enumerate(representation["instances"]):
+      try:
+        instance = FleetManifest.loadInstance(desc, templates)
+        if instance.getName() in names:
+          raise ValueError("Instance '{0}' is described more than once".format(instance.getName()))
+        names.add(instance.getName())
+        instances.append(instance)
+      except Exception as e:
+        errors.append("Instance #{0}: {1}".format(idx + 1, str(e)))
+        FLEETLOGGER.debug(traceback.format_exc())
+
+    if len(errors) != 0:
+      raise InvalidFleetManifestException("Invalid fleet manifest '{0}'".format(path), errors)
+    return FleetManifest(path, workers, instances)
+
+  @staticmethod
+  def loadInstance(desc, templates):
+    if type(desc) is not dict:
+      raise ValueError("Instance description must be a mapping")
+    name = str(desc.get("name", ""))
+    if len(name) == 0 or "/" in name:
+      raise ValueError("Invalid instance name '{0}'".format(name))
+
+    templateName = str(desc.get("template", ""))
+    if templateName not in templates.keys():
+      raise ValueError("Unknown template '{0}'".format(templateName))
+    template = templates[templateName]
+
+    arch = template.getArchs()[0]
+    if "arch" in desc.keys():
+      arch = Architecture.fromString(str(desc["arch"]))
+      if arch not in template.getArchs():
+        raise ValueError("Architecture '{0}' is not supported by template '{1}'".format(arch, templateName))
+
+    osVersion = template.getOsVersions()[0]
+    if "os_version" in desc.keys():
+      osVersion = str(desc["os_version"])
+      if osVersion not in template.getOsVersions():
+        raise ValueError("OS version '{0}' is not supported by template '{1}'".format(osVersion, templateName))
+
+    provider = template.getProviders()[0]
+    if "provider" in desc.keys():
+      provider = Provider.fromString(str(desc["provider"]))()
+      if str(provider) not in map(str, template.getProviders()):
+        raise ValueError("Provider '{0}' is not supported by template '{1}'".format(provider, templateName))
+
+    provisioner = template.getProvisioners()[0]
+    if "provisioner" in desc.keys():
+      provisioner = Provisioner.fromString(str(desc["provisioner"]))()
+      if str(provisioner) not in map(str, template.getProvisioners()):
+        raise ValueError("Provisioner '{0}' is not supported by template '{1}'".format(provisioner, templateName))
+
+    guestInterfaces = []
+    explicitMACs = []
+    for i in desc.get("guest_interfaces", []) or []:
+      if type(i) is not dict or "host_interface" not in i.keys():
+        raise ValueError("Guest interfaces must be mappings with at least a host_interface")
+      macAddr = i.get("mac_addr", "auto")
+      explicitMACs.append(macAddr != "auto")
+      if macAddr == "auto":
+        macAddr = randomMAC()
+      hostname = i.get("hostname", None)
+      if hostname != None:
+        hostname = str(hostname)
+      guestInterfaces.append(NetworkInterface(str(i.get("ip_addr", "dhcp")), str(macAddr), str(i["host_interface"]), hostname))
+    if len(guestInterfaces) < template.getGuestInterfaces():
+      raise ValueError("Template '{0}' requires {1} guest interfaces".format(templateName, template.getGuestInterfaces()))
+
+    sharedFolders = []
+    for f in desc.get("shared_folders", []) or []:
+      if type(f) is not dict or "host_dir" not in f.keys() or "guest_dir" not in f.keys():
+        raise ValueError("Shared folders must be mappings with a host_dir and a guest_dir")
+      sharedFolders.append(SharedFolder(str(f["host_dir"]), str(f["guest_dir"]), True, str(f.get("mode", "bind"))))
+
+    return FleetInstance(MachineInstance(name, template, arch, osVersion, provider, provisioner, guestInterfaces, sharedFolders),
+                         explicitMACs)
+
+# ##
+# Class applying a manifest to the instance registry
+# ##
+class Fleet:
+  _registry = None
+
+  def __init__(self, registry):
+    self._registry = registry
+
+  # ##
+  # Compute what needs to be done for each instance of the manifest
+  # Returns a list of (action, fleetInstance) with action in create, recreate, unchanged
+  # ##
+  def plan(self, manifest):
+    existing = self._registry.getInstances()
+    actions = []
+    for i in manifest.getInstances():
+      if i.getName() not in existing.keys():
+        actions.append(("create", i))
+      elif i.matches(existing[i.getName()]):
+        actions.append(("unchanged", i))
+      else:
+        actions.append(("recreate", i))
+    return actions
+
+  def applyOne(self, action, fleetInstance):
+    try:
+      instance = fleetInstance.getInstance()
+      if action == "recreate":
+        FLEETLOGGER.info("Destroying outdated instance '{0}'...".format(instance.getName()))
+        self._registry.getInstances()[instance.getName()].destroy()
+      FLEETLOGGER.info("Creating instance '{0}'...".format(instance.getName()))
+      instance.create()
+      FLEETLOGGER.info("Instance '{0}' created.".format(instance.getName()))
+      return None
+    except Exception as e:
+      FLEETLOGGER.error("Unable to create instance '{0}': {1}".format(fleetInstance.getName(), str(e)))
+      FLEETLOGGER.debug(traceback.format_exc())
+      return fleetInstance.getName()
+
+  # ##
+  # Apply the manifest
+  # The first instance needing a given image is created alone so that the image is
+  # built once, the remaining instances are then created concurrently
+  # Returns the list of instances that failed
+  # ##
+  def apply(self, manifest, workers=None, dryRun=False):
+    if workers == None:
+      workers = manifest.getWorkers()
+    plan = self.plan(manifest)
+    for (action, i) in plan:
+      FLEETLOGGER.info("{0}: {1}".format(i.getName(), action))
+    actions = [a for a in plan if a[0] != "unchanged"]
+    if dryRun or len(actions) == 0:
+      return []
+
+    builders = []
+    others = []
+    keys = set()
+    for a in actions:
+      if a[1].getImageKey() in keys:
+        others.append(a)
+      else:
+        keys.add(a[1].getImageKey())
+        builders.append(a)
+
+    failures = []
+    pool = ThreadPool(workers)
+    try:
+      for batch in [builders, others]:
+        results = pool.map(lambda a: self.applyOne(a[0], a[1]), batch)
+        failures.extend([r for r in results if r != None])
+    finally:
+      pool.close()
+      pool.join()
+    return failures
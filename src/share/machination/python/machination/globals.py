@@ -1,11 +1,26 @@
 from machination.constants import  MACHINATION_USERINSTANCESDIR
 from machination.constants import MACHINATION_USERTEMPLATESDIR
 from machination.constants import MACHINATION_DEFAULTTEMPLATESDIR
+from machination.constants import MACHINATION_USERSETTINGSFILE
+from machination.constants import MACHINATION_IMAGESUSAGEFILE
+from machination.constants import MACHINATION_TEMPLATESCACHEFILE
+from machination.constants import MACHINATION_ADDRESSESFILE
+from machination.constants import MACHINATION_DEFAULTANSIBLEROLESDIR
+from machination.constants import MACHINATION_USERANSIBLEROLESDIR
 
 from machination.registries import MachineInstanceRegistry
 from machination.registries import  MachineTemplateRegistry
+from machination.registries import RoleRegistry
+from machination.dockerclient import DockerClient
+from machination.settings import Settings
+from machination.collector import ImageUsage
+from machination.addresses import AddressAllocator
 
 
 MACHINE_INSTANCE_REGISTRY = MachineInstanceRegistry([MACHINATION_USERINSTANCESDIR])
-MACHINE_TEMPLATE_REGISTRY = MachineTemplateRegistry([MACHINATION_DEFAULTTEMPLATESDIR, MACHINATION_USERTEMPLATESDIR])
-
+MACHINE_TEMPLATE_REGISTRY = MachineTemplateRegistry([MACHINATION_DEFAULTTEMPLATESDIR, MACHINATION_USERTEMPLATESDIR], MACHINATION_TEMPLATESCACHEFILE)
+ROLE_REGISTRY = RoleRegistry([MACHINATION_DEFAULTANSIBLEROLESDIR, MACHINATION_USERANSIBLEROLESDIR])
+DOCKER_CLIENT = DockerClient()
+SETTINGS = Settings(MACHINATION_USERSETTINGSFILE)
+IMAGE_USAGE = ImageUsage(MACHINATION_IMAGESUSAGEFILE)
+ADDRESS_ALLOCATOR = AddressAllocator(MACHINATION_ADDRESSESFILE, SETTINGS, MACHINE_INSTANCE_REGISTRY, MACHINATION_USERINSTANCESDIR)
@@ -17,62 +17,18 @@
 ##########################################################################
 
 import random
+import re
 import os
+import hashlib
+import shutil
+import subprocess
 import errno
-import functools
 import socket
-import fcntl
 import struct
-import array
  
 
-from machination.exceptions import InvalidArgumentNumberError
-from machination.exceptions import ArgumentValidationError
-
-def ordinal(num):
-    '''
-    Returns the ordinal number of a given integer, as a string.
-    eg. 1 -> 1st, 2 -> 2nd, 3 -> 3rd, etc.
-    '''
-    if 10 <= num % 100 < 20:
-        return '{0}th'.format(num)
-    else:
-        val = {1 : 'st', 2 : 'nd', 3 : 'rd'}.get(num % 10, 'th')
-        return '{0}{1}'.format(num, val)
-    
-def accepts(*accepted_arg_types):
-    '''
-    A decorator to validate the parameter types of a given function.
-    It is passed a tuple of types. eg. (<type 'tuple'>, <type 'int'>)
- 
-    Note: It doesn't do a deep check, for example checking through a
-          tuple of types. The argument passed must only be types.
-    '''
-    def accept_decorator(validate_function):
-        # Check if the number of arguments to the validator
-        # function is the same as the arguments provided
-        # to the actual function to validate. We don't need
-        # to check if the function to validate has the right
-        # amount of arguments, as Python will do this
-        # automatically (also with a TypeError).
-        @functools.wraps(validate_function)
-        def decorator_wrapper(*function_args, **function_args_dict):
-            if len(accepted_arg_types) is not len(accepted_arg_types):
-                raise InvalidArgumentNumberError(validate_function.__name__)
- 
-            # We're using enumerate to get the index, so we can pass the
-            # argument number with the incorrect type to ArgumentValidationError.
-            for arg_num, (actual_arg, accepted_arg_type) in enumerate(zip(function_args, accepted_arg_types)):
-                              
-                if accepted_arg_type != None and not isinstance(actual_arg,accepted_arg_type):
-                    ord_num = ordinal(arg_num + 1)
-                    raise ArgumentValidationError(ord_num,
-                                                  validate_function.__name__,
-                                                  accepted_arg_type)
- 
-            return validate_function(*function_args)
-        return decorator_wrapper
-    return accept_decorator
+from machination.exceptions import InvalidArgumentValue
+from machination.exceptions import AddressAllocationException
 
 
 def listPath(d):
@@ -81,6 +37,69 @@ def listPath(d):
     else:
         return []
     
+# ##
+# Compute a hash of the content of a directory
+# The relative paths and the content of every file are hashed in a stable order
+# ##
+def hashDirectory(d):
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(d):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            h.update(os.path.relpath(path, d).encode("utf-8"))
+            openedFile = open(path, "rb")
+            h.update(openedFile.read())
+            openedFile.close()
+    return h.hexdigest()
+
+def hashFile(path):
+    openedFile = open(path, "rb")
+    h = hashlib.sha1(openedFile.read())
+    openedFile.close()
+    return h.hexdigest()
+
+# ##
+# Copy a directory, the excluded top level entries are skipped
+# Files are copied with copy-on-write when the filesystem supports it
+# ##
+def copyTree(src, dst, excluded=None):
+    if excluded == None:
+        excluded = []
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    entries = [os.path.join(src, e) for e in os.listdir(src) if e not in excluded]
+    if len(entries) == 0:
+        return
+    p = subprocess.Popen(["cp", "-a", "--reflink=auto"] + entries + [dst], stderr=subprocess.PIPE)
+    err = p.communicate()[1]
+    if p.returncode != 0:
+        # cp may not support reflinks, fall back to a regular copy
+        for e in entries:
+            target = os.path.join(dst, os.path.basename(e))
+            if os.path.isdir(e) and not os.path.islink(e):
+                if os.path.exists(target):
+                    shutil.rmtree(target)
+                shutil.copytree(e, target, True)
+            else:
+                shutil.copy2(e, target)
+
+# ##
+# Write a file through a temporary file renamed over it
+# Readers see either the previous content or the new one, never a partial file
+# ##
+def writeFileAtomically(path, content):
+    tmpPath = "{0}.{1}.tmp".format(path, os.getpid())
+    try:
+        openedFile = open(tmpPath, "w")
+        openedFile.write(content)
+        openedFile.close()
+        os.rename(tmpPath, path)
+    except Exception:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
+
 def randomMAC():
     mac = [ 0x00, 0x16, 0x3e,
         random.randint(0x00, 0x7f),
@@ -88,6 +107,49 @@ def randomMAC():
         random.randint(0x00, 0xff) ]
     return ':'.join(map(lambda x: "%02x" % x, mac))
     
+# ##
+# Returns the first IPv4 address following the given one that is not already used
+# Only the host addresses of the network of the given one (of prefix length prefix) are returned,
+# the search wraps around to the start of the network and fails once every address is used
+# ##
+def nextIPAddr(ipAddr, used, prefix):
+    value = struct.unpack("!I", socket.inet_aton(ipAddr))[0]
+    size = 1 << (32 - prefix)
+    network = value & ~(size - 1) & 0xffffffff
+    # Networks of more than 2 addresses have a network and a broadcast address
+    (first, last) = (network, network + size - 1)
+    if size > 2:
+        (first, last) = (first + 1, last - 1)
+    for offset in range(1, size):
+        candidate = network + (value - network + offset) % size
+        if first <= candidate <= last and socket.inet_ntoa(struct.pack("!I", candidate)) not in used:
+            return socket.inet_ntoa(struct.pack("!I", candidate))
+    raise AddressAllocationException("No address left after '{0}' in network '{1}/{2}'".format(ipAddr, socket.inet_ntoa(struct.pack("!I", network)), prefix))
+
+# ##
+# Convert a size such as 512, "200M" or "10G" into a number of bytes
+# ##
+def parseSize(value):
+    units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    match = re.match("^([0-9]+)([KMGT]?)B?$", str(value).strip().upper())
+    if match == None:
+        raise InvalidArgumentValue("size", value)
+    return int(match.group(1)) * units[match.group(2)]
+
+def formatSize(size):
+    for unit in ["B", "K", "M", "G"]:
+        if abs(size) < 1024:
+            return "{0:.1f}{1}".format(size, unit)
+        size = size / 1024.0
+    return "{0:.1f}T".format(size)
+
+def formatDuration(seconds):
+    units = [("d", 86400, "h", 3600), ("h", 3600, "m", 60), ("m", 60, "s", 1)]
+    for (unit, length, subUnit, subLength) in units:
+        if seconds >= length:
+            return "{0}{1} {2}{3}".format(seconds // length, unit, (seconds % length) // subLength, subUnit)
+    return "{0}s".format(seconds)
+
 def mkdir_p(path):
     try:
         os.makedirs(path)
@@ -103,21 +165,126 @@ def demote(user_uid, user_gid):
     return result
   
 
-def getAllNetInterfaces():
-    max_possible = 128  # arbitrary. raise if needed.
-    vals = max_possible * 32
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    names = array.array('B', '\0' * vals)
-    outbytes = struct.unpack('iL', fcntl.ioctl(
-        s.fileno(),
-        0x8912,  # SIOCGIFCONF
-        struct.pack('iL', vals, names.buffer_info()[0])
-    ))[0]
-    namestr = names.tostring()
+SYS_NET_DIR = "/sys/class/net"
+PROC_NET_DEV = "/proc/net/dev"
+
+# Interfaces that cannot be used as host interfaces of the guests:
+# the loopback, the host side of the container pairs and the bridges managed by docker
+DEFAULT_EXCLUDED_KINDS = ["loopback", "veth"]
+DEFAULT_EXCLUDED_NAMES = ["^docker[0-9]+$", "^br-[0-9a-f]{12}$"]
+
+# ##
+# Interface of the host
+# ##
+class HostInterface:
+    _name = None
+    _index = None
+    _kind = None
+    _state = None
+    _mtu = None
+    _address = None
+
+    def __init__(self, name, index=None, kind="unknown", state="unknown", mtu=None, address=None):
+        self._name = name
+        self._index = index
+        self._kind = kind
+        self._state = state
+        self._mtu = mtu
+        self._address = address
+
+    def getName(self):
+        return self._name
+
+    def getIndex(self):
+        return self._index
+
+    def getKind(self):
+        return self._kind
+
+    def getState(self):
+        return self._state
+
+    def getMTU(self):
+        return self._mtu
+
+    def getAddress(self):
+        return self._address
+
+    def __str__(self):
+        return self._name
+
+def readSysValue(path, default=None):
+    try:
+        openedFile = open(path, "r")
+        value = openedFile.read().strip()
+        openedFile.close()
+        return value
+    except (IOError, OSError):
+        return default
+
+# ##
+# Guess the kind of an interface from its sysfs attributes
+# ##
+def getNetInterfaceKind(path):
+    if readSysValue(os.path.join(path, "type")) == "772":
+        return "loopback"
+    if os.path.isdir(os.path.join(path, "bridge")):
+        return "bridge"
+    if os.path.isdir(os.path.join(path, "bonding")):
+        return "bond"
+    if os.path.exists(os.path.join(path, "tun_flags")):
+        return "tun"
+    for line in (readSysValue(os.path.join(path, "uevent"), "") or "").splitlines():
+        if line.startswith("DEVTYPE="):
+            return line[len("DEVTYPE="):]
+    if os.path.exists(os.path.join(path, "device")):
+        return "ether"
+    # Virtual interfaces linked to another interface without any other type are the veth pairs
+    if readSysValue(os.path.join(path, "iflink")) != readSysValue(os.path.join(path, "ifindex")):
+        return "veth"
+    return "virtual"
+
+def readNetInterfaces():
+    interfaces = []
+    if os.path.isdir(SYS_NET_DIR):
+        for name in sorted(os.listdir(SYS_NET_DIR)):
+            path = os.path.join(SYS_NET_DIR, name)
+            mtu = readSysValue(os.path.join(path, "mtu"))
+            index = readSysValue(os.path.join(path, "ifindex"))
+            interfaces.append(HostInterface(name,
+                                            int(index) if index != None and index.isdigit() else None,
+                                            getNetInterfaceKind(path),
+                                            readSysValue(os.path.join(path, "operstate"), "unknown"),
+                                            int(mtu) if mtu != None and mtu.isdigit() else None,
+                                            readSysValue(os.path.join(path, "address"))))
+    elif os.path.exists(PROC_NET_DEV):
+        # Without sysfs only the names are known
+        for line in open(PROC_NET_DEV).readlines()[2:]:
+            name = line.split(":", 1)[0].strip()
+            interfaces.append(HostInterface(name, None, "loopback" if name == "lo" else "unknown"))
+    return interfaces
+
+_NET_INTERFACES = None
+
+# ##
+# Returns the interfaces of the host
+# The interfaces are read once per process, refresh forces them to be read again
+# ##
+def getNetInterfaces(refresh=False):
+    global _NET_INTERFACES
+    if _NET_INTERFACES == None or refresh:
+        _NET_INTERFACES = readNetInterfaces()
+    return _NET_INTERFACES
+
+# ##
+# Returns the names of the host interfaces that can be used by the guests
+# Interfaces whose kind is in excludedKinds or whose name matches one of the excludedNames regexes are skipped
+# ##
+def getAllNetInterfaces(excludedKinds=DEFAULT_EXCLUDED_KINDS, excludedNames=DEFAULT_EXCLUDED_NAMES):
+    regexes = [re.compile(r) for r in excludedNames]
     lst = []
-    for i in range(0, outbytes, 40):
-        name = namestr[i:i+16].split('\0', 1)[0]
-        if name != "lo":
-          lst.append(name)
+    for i in getNetInterfaces():
+        if i.getKind() not in excludedKinds and len([r for r in regexes if r.match(i.getName())]) == 0:
+            lst.append(i.getName())
     return lst
  
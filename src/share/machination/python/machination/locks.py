@@ -0,0 +1,83 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import errno
+import fcntl
+
+from machination.constants import MACHINATION_USERLOCKSDIR
+from machination.helpers import mkdir_p
+from machination.loggers import CORELOGGER
+
+# ##
+# Advisory lock held on a file of the locks directory
+# Lock files are kept once created, removing them would let two processes lock different files
+# for the same name. Locks are not reentrant, a process shall not take twice the same lock.
+# ##
+class FileLock:
+  _path = None
+  _description = None
+  _shared = False
+  _file = None
+
+  def __init__(self, path, description, shared=False):
+    self._path = path
+    self._description = description
+    self._shared = shared
+
+  def acquire(self):
+    mkdir_p(os.path.dirname(self._path))
+    self._file = open(self._path, "a")
+    mode = fcntl.LOCK_EX
+    if self._shared:
+      mode = fcntl.LOCK_SH
+    try:
+      fcntl.flock(self._file, mode | fcntl.LOCK_NB)
+    except IOError as e:
+      if e.errno not in (errno.EAGAIN, errno.EACCES):
+        self._file.close()
+        raise
+      CORELOGGER.info("Waiting for {0} to be released by another process...".format(self._description))
+      fcntl.flock(self._file, mode)
+
+  def release(self):
+    if self._file != None:
+      fcntl.flock(self._file, fcntl.LOCK_UN)
+      self._file.close()
+      self._file = None
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, excType, excValue, tb):
+    self.release()
+    return False
+
+# ##
+# Lock of an instance, held while the instance is created, modified or destroyed
+# ##
+def getInstanceLock(name, shared=False):
+  return FileLock(os.path.join(MACHINATION_USERLOCKSDIR, "{0}.lock".format(name)), "machine instance '{0}'".format(name), shared)
+
+# ##
+# Lock of the instances directory, held while the name of a new instance is checked and its directory created
+# Instance locks are always taken before this one
+# ##
+def getRegistryLock():
+  return FileLock(os.path.join(MACHINATION_USERLOCKSDIR, "instances.lock"), "the instances registry")
@@ -42,6 +42,18 @@ PROVISIONERSLOGGER.addHandler(strHandler)
 PROVIDERSLOGGER = logging.getLogger("providers")
 PROVIDERSLOGGER.addHandler(strHandler)
 
+FLEETLOGGER = logging.getLogger("fleet")
+FLEETLOGGER.addHandler(strHandler)
+
+# The daemon keeps its own handler, the output of the commands it runs is sent to their client
+daemonHandler = StreamHandler(sys.stdout)
+daemonHandler.setLevel(logging.DEBUG)
+daemonHandler.setFormatter(formatter)
+
+DAEMONLOGGER = logging.getLogger("daemon")
+DAEMONLOGGER.addHandler(daemonHandler)
+DAEMONLOGGER.setLevel(logging.INFO)
+
   
 def setGlobalLogLevel(lvl):
   FILEGENERATORLOGGER.setLevel(lvl)
@@ -49,4 +61,5 @@ def setGlobalLogLevel(lvl):
   REGISTRYLOGGER.setLevel(lvl)
   COMMANDLINELOGGER.setLevel(lvl)
   PROVISIONERSLOGGER.setLevel(lvl)
-  PROVIDERSLOGGER.setLevel(lvl)
\ No newline at end of file
+  PROVIDERSLOGGER.setLevel(lvl)
+  FLEETLOGGER.setLevel(lvl)
\ No newline at end of file
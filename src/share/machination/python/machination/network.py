@@ -0,0 +1,369 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import socket
+import struct
+import ctypes
+import ctypes.util
+import threading
+import subprocess
+from distutils.spawn import find_executable
+
+from machination.exceptions import NetworkAttachmentException
+from machination.addresses import DEFAULT_ADDRESS_PREFIX
+from machination.helpers import getNetInterfaces
+from machination.loggers import PROVIDERSLOGGER
+
+# ##
+# rtnetlink constants (linux/netlink.h, linux/rtnetlink.h, linux/if_link.h)
+# ##
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_SETLINK = 19
+RTM_NEWADDR = 20
+IFF_UP = 0x1
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_LINK = 5
+IFLA_MASTER = 10
+IFLA_LINKINFO = 18
+IFLA_NET_NS_PID = 19
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+IFLA_MACVLAN_MODE = 1
+MACVLAN_MODE_BRIDGE = 4
+VETH_INFO_PEER = 1
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_BROADCAST = 4
+CLONE_NEWNET = 0x40000000
+
+NLMSG_HEADER = struct.Struct("=IHHII")
+IFINFOMSG = struct.Struct("=BxHiII")
+IFADDRMSG = struct.Struct("=BBBBI")
+RTATTR = struct.Struct("=HH")
+
+# Number of messages sent in one datagram, keeps the datagrams below the socket buffer size
+NETLINK_BATCH_SIZE = 128
+DHCP_CLIENTS = ["udhcpc", "dhcpcd", "dhclient"]
+
+def pad(data):
+  return data + b"\0" * ((4 - len(data) % 4) % 4)
+
+def attr(kind, data):
+  return pad(RTATTR.pack(RTATTR.size + len(data), kind) + data)
+
+def strAttr(kind, value):
+  return attr(kind, value.encode("ascii") + b"\0")
+
+def intAttr(kind, value):
+  return attr(kind, struct.pack("=I", value))
+
+def macAttr(kind, value):
+  return attr(kind, struct.pack("6B", *[int(b, 16) for b in value.replace("-", ":").replace(".", ":").split(":")]))
+
+def parseAttrs(data):
+  attrs = {}
+  while len(data) >= RTATTR.size:
+    (length, kind) = RTATTR.unpack_from(data)
+    if length < RTATTR.size:
+      break
+    attrs[kind] = data[RTATTR.size:length]
+    data = data[(length + 3) & ~3:]
+  return attrs
+
+_LIBC = None
+_NETNS_LOCK = threading.Lock()
+
+def setns(fd):
+  global _LIBC
+  if _LIBC == None:
+    _LIBC = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+  if _LIBC.setns(fd, CLONE_NEWNET) != 0:
+    e = ctypes.get_errno()
+    raise OSError(e, os.strerror(e))
+
+# ##
+# rtnetlink socket
+# A socket stays bound to the network namespace it has been created in, sockets for
+# the containers are created after switching the thread to their namespace
+# ##
+class NetlinkSocket:
+  _socket = None
+  _seq = 0
+
+  def __init__(self, pid=None):
+    if pid == None:
+      self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    else:
+      with _NETNS_LOCK:
+        selfPath = "/proc/thread-self/ns/net"
+        if not os.path.exists(selfPath):
+          selfPath = "/proc/self/ns/net"
+        selfNs = os.open(selfPath, os.O_RDONLY)
+        try:
+          targetNs = os.open("/proc/{0}/ns/net".format(pid), os.O_RDONLY)
+          try:
+            setns(targetNs)
+            try:
+              self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            finally:
+              setns(selfNs)
+          finally:
+            os.close(targetNs)
+        finally:
+          os.close(selfNs)
+    self._socket.bind((0, 0))
+
+  def close(self):
+    self._socket.close()
+
+  def message(self, kind, flags, payload):
+    self._seq += 1
+    return (self._seq, NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), kind, flags, self._seq, 0) + payload)
+
+  def receive(self):
+    data = self._socket.recv(1024 * 1024)
+    while len(data) >= NLMSG_HEADER.size:
+      (length, kind, flags, seq, pid) = NLMSG_HEADER.unpack_from(data)
+      yield (kind, seq, data[NLMSG_HEADER.size:length])
+      data = data[(length + 3) & ~3:]
+
+  # ##
+  # Send the requests, given as (description, type, payload), and wait for all their acknowledgements
+  # Requests are packed in as few datagrams as possible, returns the list of (description, error)
+  # ##
+  def batch(self, requests):
+    failures = []
+    for start in range(0, len(requests), NETLINK_BATCH_SIZE):
+      pending = {}
+      data = b""
+      for (description, kind, payload) in requests[start:start + NETLINK_BATCH_SIZE]:
+        (seq, message) = self.message(kind, NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, payload)
+        pending[seq] = description
+        data += message
+      self._socket.send(data)
+      while len(pending) != 0:
+        for (kind, seq, payload) in self.receive():
+          if kind == NLMSG_ERROR and seq in pending.keys():
+            error = -struct.unpack_from("=i", payload)[0]
+            if error != 0:
+              failures.append((pending[seq], os.strerror(error)))
+            del pending[seq]
+    return failures
+
+  # ##
+  # Returns the indexes of the interfaces of the namespace by name
+  # ##
+  def getLinks(self):
+    (seq, message) = self.message(RTM_GETLINK, NLM_F_REQUEST | NLM_F_DUMP, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+    self._socket.send(message)
+    links = {}
+    while True:
+      for (kind, rseq, payload) in self.receive():
+        if rseq != seq:
+          continue
+        if kind == NLMSG_DONE:
+          return links
+        if kind == NLMSG_ERROR:
+          raise NetworkAttachmentException("Unable to list the interfaces: {0}".format(os.strerror(-struct.unpack_from("=i", payload)[0])))
+        index = IFINFOMSG.unpack_from(payload)[2]
+        attrs = parseAttrs(payload[IFINFOMSG.size:])
+        if IFLA_IFNAME in attrs.keys():
+          links[attrs[IFLA_IFNAME].rstrip(b"\0").decode("ascii")] = index
+
+# ##
+# Class attaching the guest interfaces of instances to their containers
+# Interfaces are created directly in the namespace of the containers: a macvlan when the host
+# interface is a physical one, a veth pair enslaved to the bridge when it is a bridge.
+# All the links of all the instances are created with one netlink batch, then the veth are brought up
+# and the static addresses are set with one batch per container and the DHCP clients of all the interfaces run concurrently.
+# ##
+class NetworkAttacher:
+  _client = None
+  _allocator = None
+
+  # ##
+  # The prefix length of the static addresses is given by the address pools of the allocator
+  # ##
+  def __init__(self, client, allocator=None):
+    self._client = client
+    self._allocator = allocator
+
+  def getPrefix(self, hostInterface):
+    if self._allocator == None:
+      return DEFAULT_ADDRESS_PREFIX
+    return self._allocator.getPrefix(hostInterface)
+
+  @staticmethod
+  def getContainerName(instance):
+    return "machination-{0}".format(instance.getName())
+
+  def getContainerPid(self, name):
+    infos = self._client.inspectContainer(name)
+    if infos == None or not infos["State"]["Running"] or infos["State"].get("Pid", 0) == 0:
+      raise NetworkAttachmentException("Container '{0}' is not running".format(name))
+    return infos["State"]["Pid"]
+
+  # ##
+  # Request creating one guest interface in the namespace of the given process
+  # ##
+  @staticmethod
+  def getLinkRequest(hostInterface, pid, name, guestInterface):
+    mtu = hostInterface.getMTU() or 1500
+    guestAttrs = strAttr(IFLA_IFNAME, name) + intAttr(IFLA_MTU, mtu) + intAttr(IFLA_NET_NS_PID, pid)
+    if guestInterface.getMACAddr():
+      guestAttrs += macAttr(IFLA_ADDRESS, guestInterface.getMACAddr())
+    if hostInterface.getKind() == "bridge":
+      # The host side of the pair stays in the host namespace, enslaved to the bridge
+      # The guest side cannot be brought up before its peer exists, it is brought up from the container namespace
+      peer = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + guestAttrs
+      linkInfo = strAttr(IFLA_INFO_KIND, "veth") + attr(IFLA_INFO_DATA, attr(VETH_INFO_PEER, peer))
+      payload = (IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, IFF_UP, IFF_UP) +
+                 strAttr(IFLA_IFNAME, "mv{0}{1}".format(pid, name)[-15:]) +
+                 intAttr(IFLA_MTU, mtu) +
+                 intAttr(IFLA_MASTER, hostInterface.getIndex()) +
+                 attr(IFLA_LINKINFO, linkInfo))
+    else:
+      linkInfo = strAttr(IFLA_INFO_KIND, "macvlan") + attr(IFLA_INFO_DATA, intAttr(IFLA_MACVLAN_MODE, MACVLAN_MODE_BRIDGE))
+      payload = (IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, IFF_UP, IFF_UP) +
+                 guestAttrs +
+                 intAttr(IFLA_LINK, hostInterface.getIndex()) +
+                 attr(IFLA_LINKINFO, linkInfo))
+    return payload
+
+  @staticmethod
+  def getUpRequest(index):
+    return IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, IFF_UP, IFF_UP)
+
+  @staticmethod
+  def getAddressRequest(index, ipAddr, prefix):
+    packed = socket.inet_aton(ipAddr)
+    broadcast = struct.pack("!I", struct.unpack("!I", packed)[0] | ((1 << (32 - prefix)) - 1))
+    return (IFADDRMSG.pack(socket.AF_INET, prefix, 0, 0, index) +
+            attr(IFA_LOCAL, packed) + attr(IFA_ADDRESS, packed) + attr(IFA_BROADCAST, broadcast))
+
+  @staticmethod
+  def getDHCPCommand(pid, name, guestInterface):
+    client = None
+    for c in DHCP_CLIENTS:
+      client = find_executable(c)
+      if client != None:
+        break
+    if client == None:
+      raise NetworkAttachmentException("DHCP has been requested but no DHCP client could be found")
+    cmd = ["nsenter", "--net=/proc/{0}/ns/net".format(pid), client]
+    hostname = guestInterface.getHostname()
+    if client.endswith("udhcpc"):
+      cmd += ["-qi", name]
+      if hostname:
+        cmd += ["-x", "hostname:{0}".format(hostname)]
+    elif client.endswith("dhcpcd"):
+      cmd += ["-q", name]
+      if hostname:
+        cmd += ["-h", hostname]
+    else:
+      # dhclient stays in background once the lease is obtained, it is stopped through its pid file
+      pidFile = "/var/run/dhclient.{0}.{1}.pid".format(pid, name)
+      return (cmd + ["-1", "-pf", pidFile, name], pidFile)
+    return (cmd, None)
+
+  # ##
+  # Attach the guest interfaces of the given instances to their running containers
+  # Guest interfaces are named eth1, eth2... in the order of the instance configuration
+  # ##
+  def attach(self, instances):
+    hostInterfaces = dict((i.getName(), i) for i in getNetInterfaces(True))
+    linkRequests = []
+    guestRequests = {}
+    dhcpCommands = []
+    for instance in instances:
+      containerName = NetworkAttacher.getContainerName(instance)
+      guestInterfaces = instance.getGuestInterfaces()
+      if len(guestInterfaces) == 0:
+        continue
+      pid = self.getContainerPid(containerName)
+      for (counter, i) in enumerate(guestInterfaces):
+        name = "eth{0}".format(counter + 1)
+        if i.getHostInterface() not in hostInterfaces.keys():
+          raise NetworkAttachmentException("Host interface '{0}' of instance '{1}' does not exist".format(i.getHostInterface(), instance.getName()))
+        description = "{0} of '{1}'".format(name, containerName)
+        linkRequests.append((description, RTM_NEWLINK, NetworkAttacher.getLinkRequest(hostInterfaces[i.getHostInterface()], pid, name, i)))
+        if hostInterfaces[i.getHostInterface()].getKind() != "bridge" and hostInterfaces[i.getHostInterface()].getState() == "down":
+          PROVIDERSLOGGER.warning("Host interface '{0}' is down, {1} will not be reachable.".format(i.getHostInterface(), description))
+        if hostInterfaces[i.getHostInterface()].getKind() == "bridge":
+          guestRequests.setdefault(pid, []).append((description, name, None, None))
+        if i.getIPAddr() == "dhcp":
+          dhcpCommands.append((description,) + NetworkAttacher.getDHCPCommand(pid, name, i))
+        else:
+          guestRequests.setdefault(pid, []).append((description, name, i.getIPAddr(), self.getPrefix(i.getHostInterface())))
+
+    failures = []
+    if len(linkRequests) != 0:
+      s = NetlinkSocket()
+      try:
+        failures += s.batch(linkRequests)
+      finally:
+        s.close()
+      PROVIDERSLOGGER.debug("{0} interface(s) created.".format(len(linkRequests) - len(failures)))
+
+    for (pid, entries) in guestRequests.items():
+      s = NetlinkSocket(pid)
+      try:
+        links = s.getLinks()
+        requests = []
+        for (description, name, ipAddr, prefix) in entries:
+          if name not in links.keys() or description in [d for (d, e) in failures]:
+            continue
+          if ipAddr == None:
+            requests.append((description, RTM_SETLINK, NetworkAttacher.getUpRequest(links[name])))
+          else:
+            requests.append((description, RTM_NEWADDR, NetworkAttacher.getAddressRequest(links[name], ipAddr, prefix)))
+        failures += s.batch(requests)
+      finally:
+        s.close()
+
+    processes = []
+    for (description, cmd, pidFile) in dhcpCommands:
+      if description in [d for (d, e) in failures]:
+        continue
+      PROVIDERSLOGGER.debug("Running '{0}'".format(" ".join(cmd)))
+      devnull = open(os.devnull, "w")
+      processes.append((description, pidFile, subprocess.Popen(cmd, stdout=devnull, stderr=devnull)))
+    for (description, pidFile, p) in processes:
+      if p.wait() != 0:
+        failures.append((description, "DHCP client failed"))
+      if pidFile != None and os.path.exists(pidFile):
+        try:
+          os.kill(int(open(pidFile).read().strip()), 15)
+        except (OSError, ValueError):
+          pass
+        os.remove(pidFile)
+
+    if len(failures) != 0:
+      raise NetworkAttachmentException("Unable to attach {0}".format(", ".join(["{0} ({1})".format(d, e) for (d, e) in failures])))
@@ -0,0 +1,215 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import re
+import sys
+import fcntl
+import random
+import subprocess
+import traceback
+
+from machination.constants import MACHINATION_USERDIR
+from machination.constants import MACHINATION_INSTALLDIR
+
+from machination.providers import DockerProvider
+from machination.helpers import mkdir_p
+from machination.loggers import PROVIDERSLOGGER
+
+POOL_CONTAINER_PREFIX = "machination-pool-"
+POOL_LABEL = "machination.pool"
+
+# ##
+# Class representing the warm pools of containers
+# Pools are declared in the user settings:
+#   pools:
+#     - { template: "basebox:1.0", arch: x64, os_version: trusty, provisioner: ansible, size: 2 }
+#   pool_max_containers: 10
+#   pool_min_free_memory: 536870912
+# Pooled containers are started in advance from the image of the template,
+# a new docker instance matching a pool claims one of them instead of starting a new container.
+# ##
+class WarmPool:
+  _client = None
+  _settings = None
+  _templates = None
+
+  def __init__(self, client, settings, templates):
+    self._client = client
+    self._settings = settings
+    self._templates = templates
+
+  @staticmethod
+  def getKey(template, arch, osVersion, provisioner):
+    return re.sub("[^0-9a-zA-Z]", "-", "{0}-{1}-{2}-{3}".format(template, arch, osVersion, provisioner)).lower()
+
+  # ##
+  # Pools declared in the settings, as (key, spec) pairs
+  # ##
+  def getPools(self):
+    pools = []
+    for spec in self._settings.get("pools", []) or []:
+      if type(spec) is dict and "template" in spec.keys() and str(spec["template"]) in self._templates.keys():
+        template = self._templates[str(spec["template"])]
+        arch = str(spec.get("arch", template.getArchs()[0]))
+        osVersion = str(spec.get("os_version", template.getOsVersions()[0]))
+        provisioner = str(spec.get("provisioner", template.getProvisioners()[0]))
+        pools.append((WarmPool.getKey(template, arch, osVersion, provisioner),
+                      {"template": template, "arch": arch, "os_version": osVersion, "provisioner": provisioner,
+                       "size": int(spec.get("size", 1))}))
+      else:
+        PROVIDERSLOGGER.warning("Invalid pool description in settings: {0}".format(spec))
+    return pools
+
+  # ##
+  # Containers currently waiting in the given pool
+  # ##
+  def getContainers(self, key=None):
+    containers = []
+    for c in self._client.getContainers(True):
+      labels = c.get("Labels") or {}
+      names = [n.lstrip("/") for n in c.get("Names", [])]
+      if POOL_LABEL in labels.keys() and (key == None or labels[POOL_LABEL] == key):
+        if len([n for n in names if n.startswith(POOL_CONTAINER_PREFIX)]) != 0 and c.get("State", "running") == "running":
+          containers.append(c)
+    return containers
+
+  @staticmethod
+  def getFreeMemory():
+    try:
+      for line in open("/proc/meminfo"):
+        if line.startswith("MemAvailable:"):
+          return int(line.split()[1]) * 1024
+    except IOError:
+      pass
+    return None
+
+  # ##
+  # Check if the host can afford one more pooled container
+  # ##
+  def hasResources(self, count):
+    if count >= int(self._settings.get("pool_max_containers", 10)):
+      PROVIDERSLOGGER.debug("Maximum number of pooled containers reached.")
+      return False
+    freeMemory = WarmPool.getFreeMemory()
+    if freeMemory != None and freeMemory < int(self._settings.get("pool_min_free_memory", 512 * 1024 * 1024)):
+      PROVIDERSLOGGER.debug("Not enough free memory to start a pooled container.")
+      return False
+    return True
+
+  def startContainer(self, key, spec):
+    image = DockerProvider.getImageNameFor(spec["template"], spec["arch"], spec["os_version"], spec["provisioner"])
+    tag = str(spec["template"].getVersion())
+    if not self._client.hasImage(image, tag):
+      PROVIDERSLOGGER.debug("Image '{0}:{1}' is not built yet, pool '{2}' cannot be filled.".format(image, tag, key))
+      return False
+    name = "{0}{1}-{2:06x}".format(POOL_CONTAINER_PREFIX, key, random.randint(0, 0xffffff))
+    config = {
+      "Image": "{0}:{1}".format(image, tag),
+      "Cmd": ["/sbin/init"],
+      "Tty": True,
+      "OpenStdin": True,
+      "Labels": {POOL_LABEL: key},
+      "HostConfig": {"Privileged": True}
+    }
+    self._client.createContainer(name, config)
+    self._client.startContainer(name)
+    PROVIDERSLOGGER.debug("Pooled container '{0}' started.".format(name))
+    return True
+
+  # ##
+  # Start the missing containers of every pool
+  # Only one process fills the pools at a time
+  # ##
+  def fill(self):
+    mkdir_p(MACHINATION_USERDIR)
+    lockFile = open(os.path.join(MACHINATION_USERDIR, "pool.lock"), "w")
+    try:
+      fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      PROVIDERSLOGGER.debug("Pools are already being filled by another process.")
+      lockFile.close()
+      return 0
+    started = 0
+    try:
+      count = len(self.getContainers())
+      for (key, spec) in self.getPools():
+        missing = spec["size"] - len(self.getContainers(key))
+        for i in range(0, missing):
+          if not self.hasResources(count) or not self.startContainer(key, spec):
+            break
+          count += 1
+          started += 1
+    finally:
+      fcntl.flock(lockFile, fcntl.LOCK_UN)
+      lockFile.close()
+    return started
+
+  # ##
+  # Fill the pools in a detached process
+  # ##
+  def fillInBackground(self):
+    devnull = open(os.devnull, "w")
+    subprocess.Popen([sys.executable, os.path.join(MACHINATION_INSTALLDIR, "bin", "machination"), "pool", "fill"],
+                     stdin=open(os.devnull, "r"), stdout=devnull, stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+  def drain(self):
+    removed = 0
+    for c in self.getContainers():
+      self._client.removeContainer(c["Id"], True)
+      removed += 1
+    return removed
+
+  # ##
+  # Give a pooled container to an instance
+  # The container is renamed after the instance, its interfaces are attached and
+  # it is registered as the vagrant machine of the instance
+  # Returns True if a container has been claimed
+  # ##
+  def claim(self, instance):
+    if not isinstance(instance.getProvider(), DockerProvider) or len([f for f in instance.getSharedFolders() if f.getMode() != "rsync"]) != 0:
+      # Volumes cannot be added to a running container, rsync folders are copied in it once claimed
+      return False
+    key = WarmPool.getKey(instance.getTemplate(), instance.getArch(), instance.getOsVersion(), instance.getProvisioner())
+    if key not in [k for (k, spec) in self.getPools()]:
+      return False
+    for c in self.getContainers(key):
+      name = "machination-{0}".format(instance.getName())
+      try:
+        self._client.renameContainer(c["Id"], name)
+      except Exception as e:
+        # Another process may have claimed it
+        PROVIDERSLOGGER.debug("Unable to claim pooled container '{0}': {1}".format(c["Id"], str(e)))
+        PROVIDERSLOGGER.debug(traceback.format_exc())
+        continue
+      try:
+        # Attached as root, or through sudo otherwise, as done when the provider starts the container
+        instance.getProvider().attachInterfaces(instance)
+        # The container is already running, it will not be started again by the provider
+        instance.getProvider().copyFolders(instance)
+      except Exception:
+        self._client.removeContainer(c["Id"], True)
+        raise
+      machineDir = os.path.join(instance.getPath(), ".vagrant", "machines", name, "docker")
+      mkdir_p(machineDir)
+      openedFile = open(os.path.join(machineDir, "id"), "w")
+      openedFile.write(c["Id"])
+      openedFile.close()
+      PROVIDERSLOGGER.debug("Pooled container '{0}' claimed by instance '{1}'.".format(c["Id"], instance.getName()))
+      return True
+    return False
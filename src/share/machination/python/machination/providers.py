@@ -1,10 +1,31 @@
 import subprocess
 import re
-from machination.helpers import accepts
+import os
+import sys
+import signal
+import time
+import calendar
+import traceback
+from multiprocessing.pool import ThreadPool
 from machination.exceptions import InvalidArgumentValue
+from machination.exceptions import DockerEngineException
+from machination.globals import DOCKER_CLIENT
+from machination.globals import SETTINGS
+from machination.globals import ADDRESS_ALLOCATOR
+from machination.constants import MACHINATION_INSTALLDIR
+from machination.constants import MACHINATION_USERSSHDIR
+from machination.constants import MACHINATION_SSHCONFIGFILE_NAME
+from machination.constants import MACHINATION_IMAGEFILE_NAME
+from machination.helpers import mkdir_p
+from machination.helpers import writeFileAtomically
+from machination.network import NetworkAttacher
 from machination.loggers import PROVIDERSLOGGER
 
 from abc import abstractmethod
+
+# Maximum number of instances probed at the same time when their states are listed
+STATE_PROBE_WORKERS = 32
+STATE_PROBE_TIMEOUT = 10
  
 class Provider(object):
     @abstractmethod
@@ -12,11 +33,11 @@ class Provider(object):
       pass
     
     @staticmethod
-    @accepts(str)
     def fromString(val):
       vals = {
                 "docker" : DockerProvider,
                 "vbox" : VBoxProvider,
+                "fake" : FakeProvider,
                 }
       if val in vals:
         return vals[val]
@@ -30,20 +51,254 @@ class Provider(object):
     @abstractmethod
     def needsProvision(self,instance):
       pass
+
+    # ##
+    # Function generating the builder used to provision again the image of an existing instance
+    # ##
+    def generateUpdateFilesFor(self,instance):
+      raise RuntimeError("Provider '{0}' does not support updating instances".format(self))
+
+    # ##
+    # Image used by the instance as "<repository>:<tag>", None if the provider does not rely on images
+    # ##
+    def getImageReference(self,instance):
+      return None
+
+    # ##
+    # Function giving the image built by an update to the instance
+    # ##
+    def applyUpdate(self,instance):
+      pass
+
+    # ##
+    # Function giving to a copy of the instance its own version of the image of the instance
+    # ##
+    def copyImage(self,source,instance):
+      pass
+
+    # ##
+    # Files of the instance directory that are specific to the machine (runtime state, build artifacts)
+    # ##
+    def getTransientFiles(self,instance):
+      return [".vagrant"]
+
+    # ##
+    # Function to start an instance
+    # By default, instances are driven by vagrant
+    # ##
+    def start(self,instance):
+      p = subprocess.Popen("vagrant up", shell=True, stderr=subprocess.PIPE, cwd=instance.getPath())
+      err = p.communicate()[1]
+      if p.returncode != 0:
+        PROVIDERSLOGGER.critical(err)
+        raise RuntimeError("Error while starting machine instance: '{0}'".format(instance.getName()));
+
+    # ##
+    # Function to stop an instance
+    # ##
+    def stop(self,instance):
+      p = subprocess.Popen("vagrant halt", shell=True, stderr=subprocess.PIPE, cwd=instance.getPath())
+      p.communicate()[0]
+      if p.returncode != 0:
+        raise RuntimeError("Error while stopping machine instance: '{0}'".format(instance.getName()));
+
+    # ##
+    # Function to destroy the machine attached to an instance
+    # ##
+    def destroy(self,instance):
+      p = subprocess.Popen("vagrant destroy -f", shell=True, stdout=subprocess.PIPE, cwd=instance.getPath())
+      p.wait()
+      if p.returncode != 0:
+        raise RuntimeError("Error while destroying machine instance '{0}'".format(instance.getName()));
+
+    # ##
+    # Function to check if an instance is running
+    # ##
+    def isStarted(self,instance):
+      p = subprocess.Popen("vagrant status", shell=True,  stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=instance.getPath())
+      isStarted = False
+      out = p.communicate()[0]
+      isStarted = (isStarted or (re.search("(.*)machination-{0}(.*)running(.*)".format(instance.getName()),out) != None))
+      if p.returncode == 0 and isStarted:
+        return True
+      else:
+        return False
+
+    # ##
+    # Function returning for how long a running instance has been started, in seconds
+    # Returns None if it cannot be known
+    # ##
+    def getUptime(self,instance):
+      return None
+
+    # ##
+    # Function returning the state of an instance as ("running"|"stopped", uptime)
+    # ##
+    def getState(self,instance):
+      if self.isStarted(instance):
+        return ("running",self.getUptime(instance))
+      return ("stopped",None)
+
+    # ##
+    # Function calling the given function on each instance concurrently
+    # Returns a dict name -> result, the result of a call that failed or that did not return
+    # within the timeout is None
+    # ##
+    @staticmethod
+    def probe(function,instances,timeout=STATE_PROBE_TIMEOUT):
+      results = {}
+      if len(instances) == 0:
+        return results
+      workers = min(len(instances),STATE_PROBE_WORKERS)
+      pool = ThreadPool(workers)
+      complete = False
+      try:
+        pending = [(i.getName(),pool.apply_async(function,(i,))) for i in instances]
+        # Probes are started by batches of workers, each batch gets the full timeout
+        deadline = time.time() + timeout * ((len(instances) + workers - 1) // workers)
+        for (name,r) in pending:
+          try:
+            results[name] = r.get(max(0,deadline - time.time()))
+          except Exception as e:
+            PROVIDERSLOGGER.debug("Unable to probe instance '{0}': {1}".format(name,str(e) or "timeout"))
+            results[name] = None
+        complete = len([r for (name,r) in pending if not r.ready()]) == 0
+      finally:
+        if complete:
+          pool.close()
+        else:
+          # Probes that are still running are abandoned
+          pool.terminate()
+      return results
+
+    # ##
+    # Function returning the states of several instances as a dict name -> (state, uptime)
+    # Instances that cannot be probed in time are in the "unknown" state
+    # ##
+    def getStates(self,instances,timeout=STATE_PROBE_TIMEOUT):
+      states = {}
+      for (name,state) in Provider.probe(self.getState,instances,timeout).items():
+        states[name] = state or ("unknown",None)
+      return states
+
+    # ##
+    # Function to retrieve the IP address of a running instance
+    # Returns None if the address cannot be retrieved
+    # ##
+    def getIPAddr(self,instance):
+      config = self.getSSHConfig(instance)
+      if config != None:
+        ipAddrSearchGroup = re.search("HostName (.*)",config)
+        if ipAddrSearchGroup != None:
+          return ipAddrSearchGroup.group(1).strip()
+      return None
+
+    def getSSHConfigPath(self,instance):
+      return os.path.join(instance.getPath(),MACHINATION_SSHCONFIGFILE_NAME)
+
+    # ##
+    # Path of the socket of the master connection shared by the ssh sessions of an instance
+    # ##
+    def getSSHControlPath(self,instance):
+      return os.path.join(MACHINATION_USERSSHDIR,"{0}.sock".format(instance.getName()))
+
+    # ##
+    # Function returning the OpenSSH configuration of a running instance, None if it cannot be retrieved
+    # The configuration is cached in the instance directory until the instance is started, stopped or
+    # destroyed. The ssh sessions using it share a master connection kept open in the background.
+    # ##
+    def getSSHConfig(self,instance):
+      try:
+        openedFile = open(self.getSSHConfigPath(instance),"r")
+        config = openedFile.read()
+        openedFile.close()
+        return config
+      except IOError:
+        pass
+      config = self.generateSSHConfig(instance)
+      if config == None:
+        return None
+      mkdir_p(MACHINATION_USERSSHDIR)
+      config += "  ControlMaster auto\n"
+      config += "  ControlPath {0}\n".format(self.getSSHControlPath(instance))
+      config += "  ControlPersist {0}\n".format(SETTINGS.get("ssh_control_persist","10m"))
+      writeFileAtomically(self.getSSHConfigPath(instance),config)
+      return config
+
+    # ##
+    # By default, the configuration is given by vagrant
+    # ##
+    def generateSSHConfig(self,instance):
+      p = subprocess.Popen(["vagrant","ssh-config"], stderr=subprocess.PIPE, stdout=subprocess.PIPE, cwd=instance.getPath())
+      out = p.communicate()[0]
+      if not isinstance(out,str):
+        out = out.decode("utf-8")
+      if p.returncode != 0 or re.search("HostName (.*)",out) == None:
+        return None
+      return out.rstrip() + "\n"
+
+    # ##
+    # Function forgetting the ssh configuration of an instance and closing its master connection
+    # ##
+    def invalidateSSHConfig(self,instance):
+      if os.path.exists(self.getSSHControlPath(instance)):
+        devnull = open(os.devnull,"w")
+        subprocess.call(["ssh","-O","exit","-o","ControlPath={0}".format(self.getSSHControlPath(instance)),"machination-{0}".format(instance.getName())],
+                        stdin=open(os.devnull,"r"), stdout=devnull, stderr=devnull)
+      if os.path.exists(self.getSSHConfigPath(instance)):
+        os.remove(self.getSSHConfigPath(instance))
+
+    # ##
+    # Arguments of the ssh command connecting to an instance
+    # ##
+    def getSSHArguments(self,instance,options=[]):
+      config = self.getSSHConfig(instance)
+      if config == None:
+        raise RuntimeError("Unable to retrieve the ssh configuration of machine instance '{0}'".format(instance.getName()))
+      host = re.search("^Host (.*)$",config,re.MULTILINE).group(1).strip()
+      return ["ssh","-F",self.getSSHConfigPath(instance)] + options + [host]
+
+    # ##
+    # Function running a command in an instance without a terminal
+    # Returns the process running it, its output and errors are readable on its stdout
+    # ##
+    def execute(self,instance,command):
+      return subprocess.Popen(self.getSSHArguments(instance,["-T","-o","BatchMode=yes"]) + [command], stdin=open(os.devnull,"r"),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    # ##
+    # Function to ssh to an instance
+    # ##
+    def ssh(self,instance,command = None):
+      args = self.getSSHArguments(instance)
+      if command != None:
+        args.append(command)
+      p = subprocess.Popen(args)
+      p.wait()
+      return p.returncode
     
 class DockerProvider(Provider):
+    # ##
+    # By default, the provisioned container is committed to the image of the instance so that
+    # the layers of the base image are shared. The "export" build mode of the settings flattens
+    # the container through a tarball exported in the instance directory then imported again.
+    # ##
     @abstractmethod
     def generateFilesFor(self,instance):
-      folders = {}
-      for f in instance.getSharedFolders():
-        folders[f.getHostDir()] = f.getGuestDir()
+      if SETTINGS.get("docker_build_mode", "commit") == "export":
+        self.generateExportFilesFor(instance)
+      else:
+        self.generateCommitFilesFor(instance,"aacebedo/ubuntu-{{user `os_version`}}-vagrant-{{user `architecture`}}",True)
+      PROVIDERSLOGGER.debug("Files generated for docker provider.")
+
+    def generateExportFilesFor(self,instance):
       instance.getPackerFile()["variables"]["provider"] = self.__str__().lower()
       builder = {}
       builder["type"] = "docker"
       builder["image"] = "aacebedo/ubuntu-{{user `os_version`}}-vagrant-{{user `architecture`}}"
       builder["export_path"] = "machination-{{user `template_name`}}-{{user `architecture`}}-{{user `os_version`}}-{{user `provisioner`}}.tar"
       builder["run_command"] = ["-d","-i","-t", "--privileged","{{.Image}}","/sbin/init"]
-      builder["volumes"] = folders
+      builder["volumes"] = DockerProvider.getVolumes(instance)
       instance.getPackerFile()["builders"].append(builder)
       
       postproc = {}
@@ -51,18 +306,323 @@ class DockerProvider(Provider):
       postproc["repository"] = "machination-{{user `template_name`}}-{{user `architecture`}}-{{user `os_version`}}-{{user `provisioner`}}"
       postproc["tag"] = str(instance.getTemplate().getVersion())
       instance.getPackerFile()["post-processors"].append(postproc)
-      PROVIDERSLOGGER.debug("Files generated for docker provider.")
+
+    # ##
+    # The given image is started, provisioned and committed then tagged as the image of the instance
+    # ##
+    def generateCommitFilesFor(self,instance,image,pull,tag=None):
+      instance.getPackerFile()["variables"]["provider"] = self.__str__().lower()
+      builder = {}
+      builder["type"] = "docker"
+      builder["image"] = image
+      builder["pull"] = pull
+      builder["commit"] = True
+      builder["run_command"] = ["-d","-i","-t", "--privileged","{{.Image}}","/sbin/init"]
+      builder["volumes"] = DockerProvider.getVolumes(instance)
+      instance.getPackerFile()["builders"].append(builder)
+
+      postproc = {}
+      postproc["type"] = "docker-tag"
+      postproc["repository"] = DockerProvider.getImageName(instance)
+      postproc["tag"] = tag or str(instance.getTemplate().getVersion())
+      postproc["force"] = True
+      instance.getPackerFile()["post-processors"].append(postproc)
+
+    # ##
+    # Volumes of the build container, mounted according to the mode of the shared folders
+    # Copied folders are mounted read-only, their changes are not meant to reach the host
+    # ##
+    @staticmethod
+    def getVolumes(instance):
+      folders = {}
+      for f in instance.getSharedFolders():
+        if f.getMode() in ["cached", "delegated"]:
+          folders[f.getHostDir()] = "{0}:{1}".format(f.getGuestDir(), f.getMode())
+        elif f.isCopied():
+          folders[f.getHostDir()] = "{0}:ro".format(f.getGuestDir())
+        else:
+          folders[f.getHostDir()] = f.getGuestDir()
+      return folders
+
+    # ##
+    # The current image of the instance is started, provisioned and committed under a tag of the
+    # instance so that the image shared by the other instances of the template is left untouched
+    # ##
+    def generateUpdateFilesFor(self,instance):
+      self.generateCommitFilesFor(instance,self.getImageReference(instance),False,DockerProvider.getInstanceImageTag(instance))
+      PROVIDERSLOGGER.debug("Update files generated for docker provider.")
+
+    @staticmethod
+    def getInstanceImageTag(instance):
+      return "{0}-{1}".format(instance.getTemplate().getVersion(), instance.getName()).lower()
+
+    # ##
+    # The image of the instance is recorded in its directory, its container is created again from it
+    # ##
+    def applyUpdate(self,instance):
+      image = "{0}:{1}".format(DockerProvider.getImageName(instance), DockerProvider.getInstanceImageTag(instance))
+      writeFileAtomically(os.path.join(instance.getPath(), MACHINATION_IMAGEFILE_NAME), image + "\n")
+      started = self.isStarted(instance)
+      self.destroy(instance)
+      if started:
+        self.start(instance)
+
+    # ##
+    # The image of an updated instance is tagged again for its copy, later updates of the source do not change it
+    # ##
+    def copyImage(self,source,instance):
+      if not os.path.exists(os.path.join(source.getPath(), MACHINATION_IMAGEFILE_NAME)):
+        return
+      imageName = DockerProvider.getImageName(instance)
+      tag = DockerProvider.getInstanceImageTag(instance)
+      if DOCKER_CLIENT.isAvailable():
+        DOCKER_CLIENT.tagImage(self.getImageReference(source), imageName, tag, True)
+      else:
+        p = subprocess.Popen(["docker", "tag", self.getImageReference(source), "{0}:{1}".format(imageName, tag)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        err = p.communicate()[1]
+        if p.returncode != 0:
+          raise RuntimeError("Unable to tag the image of machine instance '{0}': {1}".format(instance.getName(), err))
+      writeFileAtomically(os.path.join(instance.getPath(), MACHINATION_IMAGEFILE_NAME), "{0}:{1}\n".format(imageName, tag))
+
+    # ##
+    # The export tarball is only written by the "export" build mode
+    # ##
+    def getTransientFiles(self,instance):
+      exportFile = "machination-{0}-{1}-{2}-{3}.tar".format(instance.getTemplate().getName(),
+                                                         instance.getArch(),
+                                                         instance.getOsVersion(),
+                                                         instance.getProvisioner())
+      return [".vagrant",exportFile]
+
+    # ##
+    # Instances use the image of their template until they are updated
+    # ##
+    def getImageReference(self,instance):
+      try:
+        openedFile = open(os.path.join(instance.getPath(), MACHINATION_IMAGEFILE_NAME), "r")
+        image = openedFile.read().strip()
+        openedFile.close()
+        if image != "":
+          return image
+      except IOError:
+        pass
+      return "{0}:{1}".format(DockerProvider.getImageName(instance),instance.getTemplate().getVersion())
 
     def __str__(self):
       return "docker"
+
+    # ##
+    # By default, the containers of the instances are driven directly through the docker engine,
+    # the "vagrant" docker driver of the settings drives them with vagrant and the Vagrantfile.
+    # Vagrant is also used when the docker engine cannot be reached.
+    # ##
+    def isNative(self):
+      if SETTINGS.get("docker_driver", "native") == "vagrant":
+        return False
+      if not DOCKER_CLIENT.isAvailable():
+        PROVIDERSLOGGER.debug("Docker engine API is not available, falling back to vagrant.")
+        return False
+      return True
+
+    # ##
+    # Configuration of the container of an instance, equivalent to the one created by vagrant from the Vagrantfile
+    # ##
+    def getContainerConfig(self,instance):
+      binds = []
+      tmpfs = {}
+      for f in instance.getSharedFolders():
+        if f.getMode() in ["cached", "delegated"]:
+          binds.append("{0}:{1}:{2}".format(f.getHostDir(), f.getGuestDir(), f.getMode()))
+        elif f.getMode() == "tmpfs":
+          tmpfs[f.getGuestDir()] = "exec"
+        elif not f.isCopied():
+          binds.append("{0}:{1}".format(f.getHostDir(), f.getGuestDir()))
+      hostConfig = {"Privileged": True, "Binds": binds}
+      if len(tmpfs) != 0:
+        hostConfig["Tmpfs"] = tmpfs
+      return {
+        "Image": self.getImageReference(instance),
+        "Hostname": NetworkAttacher.getContainerName(instance),
+        "Cmd": ["/sbin/init"],
+        "Tty": True,
+        "OpenStdin": True,
+        "HostConfig": hostConfig
+      }
+
+    def start(self,instance):
+      if not self.isNative():
+        return Provider.start(self,instance)
+      name = NetworkAttacher.getContainerName(instance)
+      infos = DOCKER_CLIENT.inspectContainer(name)
+      if infos != None and infos["State"]["Running"]:
+        PROVIDERSLOGGER.debug("Container '{0}' is already running.".format(name))
+        return
+      if infos == None:
+        DOCKER_CLIENT.createContainer(name, self.getContainerConfig(instance))
+      DOCKER_CLIENT.startContainer(name)
+      self.copyFolders(instance)
+      self.attachInterfaces(instance)
+      PROVIDERSLOGGER.debug("Container '{0}' started.".format(name))
+
+    # ##
+    # Copy the content of the rsync and tmpfs folders in the running container
+    # ##
+    def copyFolders(self,instance):
+      name = NetworkAttacher.getContainerName(instance)
+      for f in [f for f in instance.getSharedFolders() if f.isCopied()]:
+        tar = subprocess.Popen(["tar", "-C", f.getHostDir(), "-cf", "-", "."], stdout=subprocess.PIPE)
+        p = subprocess.Popen(["docker", "exec", "-i", name, "sh", "-c", "mkdir -p '{0}' && tar -C '{0}' -xf -".format(f.getGuestDir())],
+                             stdin=tar.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        tar.stdout.close()
+        err = p.communicate()[1]
+        tar.wait()
+        if tar.returncode != 0 or p.returncode != 0:
+          raise RuntimeError("Unable to copy folder '{0}' in machine instance '{1}': {2}".format(f.getHostDir(), instance.getName(), err))
+
+    # ##
+    # The guest interfaces are attached by machination as root, as done by the Vagrantfile
+    # ##
+    def attachInterfaces(self,instance):
+      if len(instance.getGuestInterfaces()) == 0:
+        return
+      if os.geteuid() == 0:
+        NetworkAttacher(DOCKER_CLIENT, ADDRESS_ALLOCATOR).attach([instance])
+      else:
+        PROVIDERSLOGGER.info("Additionnal network interfaces require root access.")
+        p = subprocess.Popen(["sudo", sys.executable, os.path.join(MACHINATION_INSTALLDIR, "bin", "machination"), "attach", instance.getName()])
+        p.wait()
+        if p.returncode != 0:
+          raise RuntimeError("Unable to attach the network interfaces of machine instance '{0}'".format(instance.getName()))
+
+    def stop(self,instance):
+      if not self.isNative():
+        return Provider.stop(self,instance)
+      if DOCKER_CLIENT.isContainerRunning(NetworkAttacher.getContainerName(instance)):
+        DOCKER_CLIENT.stopContainer(NetworkAttacher.getContainerName(instance))
+
+    def destroy(self,instance):
+      if not self.isNative():
+        return Provider.destroy(self,instance)
+      if DOCKER_CLIENT.inspectContainer(NetworkAttacher.getContainerName(instance)) != None:
+        DOCKER_CLIENT.removeContainer(NetworkAttacher.getContainerName(instance), True)
+
+    # ##
+    # The container has the same name whichever driver created it, vagrant is only asked when
+    # the docker engine cannot be reached
+    # ##
+    def isStarted(self,instance):
+      if not DOCKER_CLIENT.isAvailable():
+        return Provider.isStarted(self,instance)
+      return DOCKER_CLIENT.isContainerRunning(NetworkAttacher.getContainerName(instance))
+
+    def getIPAddr(self,instance):
+      if not self.isNative():
+        return Provider.getIPAddr(self,instance)
+      infos = DOCKER_CLIENT.inspectContainer(NetworkAttacher.getContainerName(instance))
+      if infos == None or not infos["NetworkSettings"].get("IPAddress"):
+        return None
+      return infos["NetworkSettings"]["IPAddress"]
+
+    # ##
+    # The configuration is the one vagrant would give, built from the state of the container
+    # ##
+    def generateSSHConfig(self,instance):
+      if not self.isNative():
+        return Provider.generateSSHConfig(self,instance)
+      ipAddr = self.getIPAddr(instance)
+      if ipAddr == None:
+        return None
+      config = "Host {0}\n".format(NetworkAttacher.getContainerName(instance))
+      config += "  HostName {0}\n".format(ipAddr)
+      config += "  User vagrant\n"
+      config += "  Port 22\n"
+      config += "  UserKnownHostsFile /dev/null\n"
+      config += "  StrictHostKeyChecking no\n"
+      config += "  PasswordAuthentication no\n"
+      config += "  IdentityFile {0}\n".format(self.getSSHKey(instance))
+      config += "  IdentitiesOnly yes\n"
+      config += "  LogLevel FATAL\n"
+      config += "  ForwardAgent yes\n"
+      config += "  ForwardX11 yes\n"
+      return config
+
+    # ##
+    # Private key used to ssh to an instance
+    # Vagrant replaces the insecure key of the box by a key of its own when it starts a machine
+    # ##
+    def getSSHKey(self,instance):
+      vagrantKey = os.path.join(instance.getPath(), ".vagrant", "machines", NetworkAttacher.getContainerName(instance), "docker", "private_key")
+      if os.path.exists(vagrantKey):
+        return vagrantKey
+      vagrantHome = os.getenv("VAGRANT_HOME", os.path.join(os.path.expanduser("~"), ".vagrant.d"))
+      return SETTINGS.get("ssh_private_key", os.path.join(vagrantHome, "insecure_private_key"))
+
+    # ##
+    # States of the instances are read from one listing of the containers, only the
+    # running containers are inspected to get their uptime
+    # ##
+    def getStates(self,instances,timeout=STATE_PROBE_TIMEOUT):
+      try:
+        containers = {}
+        for c in DOCKER_CLIENT.getContainers(True):
+          for n in c.get("Names") or []:
+            containers[n.lstrip("/")] = c
+      except DockerEngineException as e:
+        PROVIDERSLOGGER.debug("Unable to use docker engine API, probing instances one by one: {0}".format(str(e)))
+        return Provider.getStates(self,instances,timeout)
+      states = {}
+      running = []
+      for i in instances:
+        c = containers.get("machination-{0}".format(i.getName()),None)
+        if c != None and (c.get("State") == "running" or (c.get("State") == None and c.get("Status","").startswith("Up"))):
+          running.append(i)
+        else:
+          states[i.getName()] = ("stopped",None)
+      for (name,uptime) in Provider.probe(self.getUptime,running,timeout).items():
+        states[name] = ("running",uptime)
+      return states
+
+    def getUptime(self,instance):
+      try:
+        infos = DOCKER_CLIENT.inspectContainer("machination-{0}".format(instance.getName()))
+      except DockerEngineException as e:
+        PROVIDERSLOGGER.debug("Unable to get uptime of instance '{0}': {1}".format(instance.getName(),str(e)))
+        return None
+      if infos == None or not infos["State"]["Running"]:
+        return None
+      startedAt = infos["State"].get("StartedAt","")
+      if not startedAt.startswith("0001"):
+        try:
+          return max(0,int(time.time() - calendar.timegm(time.strptime(startedAt[0:19],"%Y-%m-%dT%H:%M:%S"))))
+        except ValueError:
+          PROVIDERSLOGGER.debug(traceback.format_exc())
+      return None
     
+    # ##
+    # Name of the image built for an instance
+    # ##
+    @staticmethod
+    def getImageName(instance):
+      return DockerProvider.getImageNameFor(instance.getTemplate(), instance.getArch(),
+                                            instance.getOsVersion(), instance.getProvisioner())
+
+    @staticmethod
+    def getImageNameFor(template, arch, osVersion, provisioner):
+      return "machination-{0}-{1}-{2}-{3}".format(template.getName().lower(),
+                                                  str(arch).lower(),
+                                                  str(osVersion).lower(),
+                                                  str(provisioner).lower())
+
     @abstractmethod
     def needsProvision(self,instance):
-      imageName = "machination-{0}-{1}-{2}-{3}".format(instance.getTemplate().getName().lower(),
-                                                           str(instance.getArch()).lower(),
-                                                           instance.getOsVersion().lower(),
-                                                           str(instance.getProvisioner()).lower())
-      regex = ("(.*){0}( *){1}(.*)".format(imageName,str(instance.getTemplate().getVersion())))
+      (imageName, tag) = self.getImageReference(instance).rsplit(":", 1)
+      try:
+        return not DOCKER_CLIENT.hasImage(imageName,tag)
+      except DockerEngineException as e:
+        # The daemon socket may not be reachable by the current user, fall back to the command line
+        PROVIDERSLOGGER.debug("Unable to use docker engine API, falling back to docker command line: {0}".format(str(e)))
+      regex = ("(.*){0}( *){1}(.*)".format(imageName,tag))
       p = subprocess.Popen("docker images -a", shell=True, stderr=subprocess.PIPE,stdout=subprocess.PIPE)
       out = p.communicate()[0]
       if p.returncode == 0:
@@ -102,4 +662,117 @@ class VBoxProvider(Provider):
     @abstractmethod
     def needsProvision(self,instance):
       # Vbox always needs provisioning
-      return True
\ No newline at end of file
+      return True
+
+# ##
+# Provider that does not rely on any virtualization infrastructure
+# Instances are represented by a lightweight local process, it is meant to
+# exercise machination itself in functional and load tests.
+# ##
+class FakeProvider(Provider):
+    PIDFILE_NAME = "fake.pid"
+
+    def generateFilesFor(self,instance):
+      instance.getPackerFile()["variables"]["provider"] = self.__str__().lower()
+      PROVIDERSLOGGER.debug("Files generated for fake provider.")
+
+    def __str__(self):
+      return "fake"
+
+    def needsProvision(self,instance):
+      # There is no image to build
+      return False
+
+    def generateUpdateFilesFor(self,instance):
+      instance.getPackerFile()["variables"]["provider"] = self.__str__().lower()
+
+    def getTransientFiles(self,instance):
+      return [FakeProvider.PIDFILE_NAME]
+
+    def getPidFile(self,instance):
+      return os.path.join(instance.getPath(),FakeProvider.PIDFILE_NAME)
+
+    def getPid(self,instance):
+      pid = None
+      try:
+        openedFile = open(self.getPidFile(instance),"r")
+        pid = int(openedFile.read().strip())
+        openedFile.close()
+      except (IOError,ValueError):
+        pid = None
+      return pid
+
+    def start(self,instance):
+      if not self.isStarted(instance):
+        # The stand-in process is a shell named after the instance that sleeps until it is killed
+        p = subprocess.Popen(["/bin/sh","-c","while :; do sleep 3600; done","machination-{0}".format(instance.getName())],
+                             stdin=open(os.devnull,"r"), stdout=open(os.devnull,"w"), stderr=subprocess.STDOUT,
+                             cwd=instance.getPath(), close_fds=True, preexec_fn=os.setsid)
+        openedFile = open(self.getPidFile(instance),"w")
+        openedFile.write(str(p.pid))
+        openedFile.close()
+        PROVIDERSLOGGER.debug("Fake machine of instance '{0}' started with pid {1}.".format(instance.getName(),p.pid))
+
+    def stop(self,instance):
+      pid = self.getPid(instance)
+      if pid != None and self.isStarted(instance):
+        try:
+          # The stand-in is a session leader, kill its whole process group
+          os.killpg(pid,signal.SIGTERM)
+        except OSError:
+          pass
+        try:
+          os.waitpid(pid,os.WNOHANG)
+        except OSError:
+          pass
+      if os.path.exists(self.getPidFile(instance)):
+        os.remove(self.getPidFile(instance))
+
+    def destroy(self,instance):
+      self.stop(instance)
+
+    # ##
+    # Commands are ran by a local shell in the instance directory
+    # ##
+    def execute(self,instance,command):
+      return subprocess.Popen(["/bin/sh", "-c", command], stdin=open(os.devnull,"r"),
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=instance.getPath())
+
+    def isStarted(self,instance):
+      pid = self.getPid(instance)
+      if pid == None:
+        return False
+      try:
+        os.kill(pid,0)
+      except OSError:
+        return False
+      # Make sure the pid has not been reused and that the process is not a zombie
+      procDir = os.path.join("/proc",str(pid))
+      if os.path.exists(procDir):
+        try:
+          stat = open(os.path.join(procDir,"stat"),"r").read()
+          cmdline = open(os.path.join(procDir,"cmdline"),"r").read()
+        except IOError:
+          return False
+        if stat[stat.rfind(")")+2:].startswith("Z"):
+          return False
+        return ("machination-{0}".format(instance.getName()) in cmdline)
+      return True
+
+    def getUptime(self,instance):
+      if not self.isStarted(instance):
+        return None
+      # The pid file is written when the stand-in process is started
+      return max(0,int(time.time() - os.path.getmtime(self.getPidFile(instance))))
+
+    def getIPAddr(self,instance):
+      return "127.0.0.1"
+
+    def ssh(self,instance,command = None):
+      # Commands are executed locally in the instance directory
+      if command == None:
+        p = subprocess.Popen(["/bin/sh"], cwd=instance.getPath())
+      else:
+        p = subprocess.Popen(["/bin/sh","-c",command], cwd=instance.getPath())
+      p.wait()
+      return p.returncode
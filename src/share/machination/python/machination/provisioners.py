@@ -2,19 +2,18 @@ import shutil
 import yaml
 import os
 
-from machination.helpers import accepts
 from machination.exceptions import InvalidArgumentValue
 from machination.exceptions import PathNotExistError
-from machination.exceptions import InvalidMachineTemplateException
  
-from machination.constants import MACHINATION_DEFAULTANSIBLEROLESDIR
-from machination.constants import MACHINATION_USERANSIBLEROLESDIR
 from machination.constants import MACHINATION_DEFAULTANSIBLEPLAYBOOKSDIR
 from machination.constants import MACHINATION_USERANSIBLEPLAYBOOKSDIR
+from machination.constants import MACHINATION_ROLESSTATEFILE_NAME
 
 from machination.loggers import FILEGENERATORLOGGER
 
 from machination.helpers import mkdir_p
+from machination.helpers import writeFileAtomically
+from machination.globals import ROLE_REGISTRY
 
 from abc import abstractmethod
 
@@ -24,7 +23,6 @@ class Provisioner(object):
       pass
     
     @staticmethod
-    @accepts(str)
     def fromString(val):
       vals = {
                 "ansible" : AnsibleProvisioner,
@@ -37,48 +35,112 @@ class Provisioner(object):
     @abstractmethod
     def __str__(self):
       pass
+
+    # ##
+    # Function returning the roles that changed since they were last applied to the instance
+    # ##
+    @abstractmethod
+    def getOutdatedRoles(self,instance):
+      pass
+
+    # ##
+    # Function generating the files needed to re-apply the given roles to an instance
+    # ##
+    @abstractmethod
+    def generateUpdateFilesFor(self,instance,roles):
+      pass
+
+    # ##
+    # Function recording the state of the roles applied to an instance
+    # ##
+    @abstractmethod
+    def saveRolesState(self,instance):
+      pass
       
 class AnsibleProvisioner(Provisioner):
+    @staticmethod
+    def getRoleDir(role):
+      return ROLE_REGISTRY.getRoleDir(role)
+
+    @staticmethod
+    def getRoleDependencies(role):
+      return ROLE_REGISTRY.getDependencies(role)
+
+    # ##
+    # Function returning the given roles and all their dependencies
+    # Dependencies are listed before the roles depending on them
+    # ##
+    @staticmethod
+    def getRolesClosure(roles):
+      closure = []
+      def visit(role):
+        if role not in closure:
+          for d in AnsibleProvisioner.getRoleDependencies(role):
+            visit(d)
+          closure.append(role)
+      for r in roles:
+        visit(r)
+      return closure
+
     @staticmethod
     def copyRole(dest,role):
-      roleDir = None
-      roleDirs = [os.path.join(MACHINATION_DEFAULTANSIBLEROLESDIR,role),os.path.join(MACHINATION_USERANSIBLEROLESDIR,role)]
+      roleDir = AnsibleProvisioner.getRoleDir(role)
+      roleDest = os.path.join(dest,"roles",role)
+      if os.path.exists(roleDest):
+        shutil.rmtree(roleDest)
+      shutil.copytree(roleDir, roleDest, True)
+      for r in AnsibleProvisioner.getRoleDependencies(role):
+        if not os.path.exists(os.path.join(dest,"roles",r)):
+          AnsibleProvisioner.copyRole(dest,r)
+
+    @staticmethod
+    def getRolesStatePath(instance):
+      return os.path.join(instance.getPath(),"provisioners","ansible",MACHINATION_ROLESSTATEFILE_NAME)
 
-      for tmpRoleDir in roleDirs:
-        if os.path.exists(tmpRoleDir):
-          roleDir = tmpRoleDir
-          break
+    # ##
+    # Function computing the hash of each role used by an instance
+    # ##
+    @staticmethod
+    def getRolesHashes(instance):
+      hashes = {}
+      for r in AnsibleProvisioner.getRolesClosure(instance.getTemplate().getRoles()):
+        hashes[r] = ROLE_REGISTRY.getHash(r)
+      return hashes
+
+    def saveRolesState(self,instance):
+      writeFileAtomically(AnsibleProvisioner.getRolesStatePath(instance),yaml.dump(AnsibleProvisioner.getRolesHashes(instance),default_flow_style=False))
+
+    # ##
+    # Roles whose content changed are outdated, so are the roles depending on them
+    # ##
+    def getOutdatedRoles(self,instance):
+      applied = {}
+      if os.path.exists(AnsibleProvisioner.getRolesStatePath(instance)):
+        openedFile = open(AnsibleProvisioner.getRolesStatePath(instance))
+        applied = yaml.load(openedFile) or {}
+        openedFile.close()
+      current = AnsibleProvisioner.getRolesHashes(instance)
+      outdated = []
+      for r in AnsibleProvisioner.getRolesClosure(instance.getTemplate().getRoles()):
+        if applied.get(r) != current[r]:
+          outdated.append(r)
         else:
-          roleDir = None
-
-      if roleDir != None and os.path.exists(roleDir):
-        shutil.copytree(roleDir, os.path.join(dest,"roles",role), True)
-        metaPath = os.path.join(roleDir,"meta","main.yml")
-        if os.path.exists(metaPath):
-          openedFile = open(metaPath)
-          metas = yaml.load(openedFile)
-          if "dependencies" in metas.keys():
-            for r in metas["dependencies"]:
-              if "role" in r.keys() and not os.path.exists(os.path.join(dest,"roles",r["role"])):
-                AnsibleProvisioner.copyRole(dest,r["role"])
-      else:
-        raise InvalidMachineTemplateException("Unable to find ansible role '{0}'.".format(role))
+          for d in AnsibleProvisioner.getRoleDependencies(r):
+            if d in outdated:
+              outdated.append(r)
+              break
+      return outdated
 
-    @abstractmethod
-    def generateFilesFor(self,instance):
-      if not os.path.exists(instance.getPath()):
-          raise PathNotExistError(instance.getPath())
-      ansibleFilesDest = os.path.join(instance.getPath(),"provisioners","ansible")
-      mkdir_p(os.path.join(ansibleFilesDest))
-      playbookPath = os.path.join(instance.getPath(),"provisioners","ansible","machine.playbook")
+    @staticmethod
+    def writePlaybook(path,roles):
       playbook = [{}]
       playbook[0]["hosts"] = "all"
-      playbook[0]["roles"] = instance.getTemplate().getRoles()
-      playbookFile = open(playbookPath,'w')
+      playbook[0]["roles"] = roles
+      playbookFile = open(path,'w')
       playbookFile.write(yaml.dump(playbook,default_flow_style=False))
-    
-      for r in playbook[0]["roles"]:
-          AnsibleProvisioner.copyRole(ansibleFilesDest,r)
+      playbookFile.close()
+
+    def generateProvisionersFor(self,instance,playbook):
       instance.getPackerFile()["variables"]["provisioner"] = self.__str__().lower()
       instance.getPackerFile()["variables"]["ansible_staging_directory"] = "/tmp/packer-provisioner-ansible-local"
       
@@ -100,7 +162,7 @@ class AnsibleProvisioner(Provisioner):
       
       provisioner = {}
       provisioner["type"] = "ansible-local"
-      provisioner["playbook_file"] = "provisioners/ansible/machine.playbook"
+      provisioner["playbook_file"] = "provisioners/ansible/{0}".format(playbook)
       instance.getPackerFile()["provisioners"].append(provisioner)
       
       provisioner = {}
@@ -112,7 +174,29 @@ class AnsibleProvisioner(Provisioner):
       provisioner["type"] = "shell"
       provisioner["inline"] = ["apt-get remove -y ansible && apt-get autoremove -y"]
       instance.getPackerFile()["provisioners"].append(provisioner)
-      
+
+    @abstractmethod
+    def generateFilesFor(self,instance):
+      if not os.path.exists(instance.getPath()):
+          raise PathNotExistError(instance.getPath())
+      ansibleFilesDest = os.path.join(instance.getPath(),"provisioners","ansible")
+      mkdir_p(os.path.join(ansibleFilesDest))
+      AnsibleProvisioner.writePlaybook(os.path.join(ansibleFilesDest,"machine.playbook"),instance.getTemplate().getRoles())
+    
+      for r in instance.getTemplate().getRoles():
+          AnsibleProvisioner.copyRole(ansibleFilesDest,r)
+      self.generateProvisionersFor(instance,"machine.playbook")
+
+    # ##
+    # Only the given roles are staged again and played
+    # ##
+    def generateUpdateFilesFor(self,instance,roles):
+      ansibleFilesDest = os.path.join(instance.getPath(),"provisioners","ansible")
+      mkdir_p(os.path.join(ansibleFilesDest))
+      AnsibleProvisioner.writePlaybook(os.path.join(ansibleFilesDest,"machine.update.playbook"),roles)
+      for r in roles:
+        AnsibleProvisioner.copyRole(ansibleFilesDest,r)
+      self.generateProvisionersFor(instance,"machine.update.playbook")
        
     def __str__(self):
       return "ansible"
@@ -18,75 +18,404 @@
 
 import yaml
 import os
+import marshal
 import traceback
 
 from machination.helpers import listPath
-from machination.helpers import accepts
+from machination.helpers import mkdir_p
+from machination.helpers import hashDirectory
 from machination.loggers import REGISTRYLOGGER
 from machination.constants import MACHINATION_CONFIGFILE_NAME
+from machination.validation import TrustedLoader
+from machination.exceptions import InvalidMachineTemplateException
+from machination.watcher import INSTANCE_CHANGE
+from machination.watcher import TEMPLATE_CHANGE
+from machination.watcher import ROLE_CHANGE
+# ##
+# Lightweight handle on an instance stored in a directory
+# The name and the path come from the directory entry, the configuration of the instance
+# is only loaded when another attribute is accessed
+# ##
+class MachineInstanceHandle(object):
+  __slots__ = ("_name", "_path", "_instance", "_mtime")
+
+  def __init__(self, name, path):
+    self._name = name
+    self._path = path
+    self._instance = None
+    self._mtime = None
+
+  def getName(self):
+    return self._name
+
+  def getPath(self):
+    return self._path
+
+  def isLoaded(self):
+    return self._instance != None
+
+  # ##
+  # Check if the loaded instance still matches its configuration file
+  # ##
+  def isCurrent(self):
+    if self._instance == None:
+      return True
+    try:
+      return os.stat(os.path.join(self._path, MACHINATION_CONFIGFILE_NAME)).st_mtime == self._mtime
+    except OSError:
+      return False
+
+  # ##
+  # Function to load the instance from its configuration file
+  # ##
+  def load(self):
+    if self._instance == None:
+      filename = os.path.join(self._path, MACHINATION_CONFIGFILE_NAME)
+      openedFile = open(filename, "r")
+      try:
+        self._mtime = os.fstat(openedFile.fileno()).st_mtime
+        self._instance = yaml.load(openedFile)
+      finally:
+        openedFile.close()
+      REGISTRYLOGGER.debug("Instance stored in '{0}' loaded".format(filename))
+    return self._instance
+
+  def __getattr__(self, attr):
+    return getattr(self.load(), attr)
+
+  def __str__(self):
+    return self._name
+
 # ##
 # Class representing the set of instances available
+# Handles are kept between calls so that an instance already loaded is not loaded again
+# until its configuration file changes
+# When the registry is watched, the directories are only listed once, the instances are then
+# updated from the change events. Updates replace the mappings instead of modifying them
+# so that the events can be applied while the instances are read.
 # ##
 class MachineInstanceRegistry():
   _instanceDirs = None
+  _handles = None
+  _watched = False
+  _instances = None
 
   # ##
   # Constructor
   # ##
-  @accepts(None, list)
   def __init__(self, instanceDirs):
     REGISTRYLOGGER.debug("Template registry initialized.")
     self._instanceDirs = instanceDirs
+    self._handles = {}
+    self._instances = None
     REGISTRYLOGGER.debug("Instances are searched in the following directories: {0}".format(', '.join(self._instanceDirs)))
 
   # ##
   # Function to retrieve the available instances
+  # Only the instance directories are listed, each instance is loaded on first use
   # ##
+  def getInstanceDirs(self):
+    return self._instanceDirs
+
+  def setWatched(self, watched):
+    self._watched = watched
+    self._instances = None
+
   def getInstances(self):
+    if self._watched and self._instances != None:
+      return dict(self._instances)
     _instances = {}
+    handles = {}
     for d in self._instanceDirs:
-      path = listPath(d)
-      # For each path to scan
-      for iDir in path:
-        # Check if the file exists and if there is a VagrantFile and a config file in it
-        if os.path.isdir(iDir) and os.path.exists(os.path.join(iDir, "Vagrantfile")) and os.path.exists(os.path.join(iDir, MACHINATION_CONFIGFILE_NAME)):
-          try:
-            filename = os.path.join(iDir, MACHINATION_CONFIGFILE_NAME)
-            openedFile = open(filename, "r")
-            instance = yaml.load(openedFile)
-            _instances[instance.getName()] = instance
-            REGISTRYLOGGER.debug("Instance stored in '{0}' loaded".format(filename))
-            
-          except Exception as e:
-            REGISTRYLOGGER.error("Unable to load instance stored in '{0}': {1}".format(iDir, str(e)))
-            REGISTRYLOGGER.debug(traceback.format_exc())
+      if os.path.isdir(d):
+        for name in os.listdir(d):
+          # Hidden entries hold temporary data, directories without configuration are being created
+          path = os.path.join(d, name)
+          if not name.startswith(".") and MachineInstanceRegistry.isInstanceDir(path):
+            handle = self._handles.get(path, None)
+            if handle == None or not handle.isCurrent():
+              handle = MachineInstanceHandle(name, path)
+            handles[path] = handle
+            _instances[name] = handle
+    self._handles = handles
+    if self._watched:
+      self._instances = dict(_instances)
     return _instances
 
+  @staticmethod
+  def isInstanceDir(path):
+    return os.path.exists(os.path.join(path, MACHINATION_CONFIGFILE_NAME))
+
+  # ##
+  # Function updating the instances from change events
+  # ##
+  def applyChanges(self, events):
+    if self._instances == None:
+      return
+    instances = dict(self._instances)
+    handles = dict(self._handles)
+    for e in events:
+      if e.getKind() != INSTANCE_CHANGE:
+        continue
+      if e.isRescan():
+        self._instances = None
+        return
+      if e.getName().startswith("."):
+        continue
+      handle = handles.pop(e.getPath(), None)
+      if instances.get(e.getName(), None) is handle:
+        instances.pop(e.getName(), None)
+      if e.getAction() != "removed" and MachineInstanceRegistry.isInstanceDir(e.getPath()):
+        if handle == None or not handle.isCurrent():
+          handle = MachineInstanceHandle(e.getName(), e.getPath())
+          REGISTRYLOGGER.debug("Instance '{0}' changed".format(e.getName()))
+        handles[e.getPath()] = handle
+        instances[e.getName()] = handle
+      else:
+        REGISTRYLOGGER.debug("Instance '{0}' removed".format(e.getName()))
+    self._handles = handles
+    self._instances = instances
+
+  # ##
+  # Function to check every instance and report all the errors found
+  # Instances are loaded without validation then checked in one pass
+  # ##
+  def validate(self):
+    errors = []
+    for (name, handle) in sorted(self.getInstances().items()):
+      try:
+        openedFile = open(os.path.join(handle.getPath(), MACHINATION_CONFIGFILE_NAME), "r")
+        instance = yaml.load(openedFile, Loader=TrustedLoader)
+        openedFile.close()
+        errors.extend(instance.validate())
+      except Exception as e:
+        errors.append("{0}: {1}".format(name, str(e)))
+        REGISTRYLOGGER.debug(traceback.format_exc())
+    return errors
+
 # ##
 # Class to retrieve the available templates
+# Templates are compiled once into a cache storing their validated content as primitive types.
+# A template is parsed from YAML again only when its file is new or has changed (mtime or size).
+# Loaded templates are also kept in memory, the cache file is only read for the files that changed.
+# When the registry is watched, the files are not checked anymore, templates are updated from the change events.
 # ##
 class MachineTemplateRegistry():
+    CACHE_VERSION = 1
     _templateDirs = None
+    _cachePath = None
+    _loaded = None
+    _templates = None
+    _watched = False
     # ##
     # Constructor
     # ##
-    @accepts(None, list)
-    def __init__(self, templateDirs):
+    def __init__(self, templateDirs, cachePath=None):
       self._templateDirs = templateDirs
+      self._cachePath = cachePath
+      self._loaded = {}
       REGISTRYLOGGER.debug("Templates are searched in the following directories: {0}".format(','.join(self._templateDirs)))
 
+    def loadCache(self):
+      if self._cachePath != None and os.path.exists(self._cachePath):
+        try:
+          openedFile = open(self._cachePath, "rb")
+          cache = marshal.load(openedFile)
+          openedFile.close()
+          if type(cache) is dict and cache.get("version") == MachineTemplateRegistry.CACHE_VERSION:
+            return cache["templates"]
+        except Exception as e:
+          REGISTRYLOGGER.debug("Unable to load compiled templates from '{0}': {1}".format(self._cachePath, str(e)))
+      return {}
+
+    def saveCache(self, entries):
+      if self._cachePath == None:
+        return
+      try:
+        mkdir_p(os.path.dirname(self._cachePath))
+        tmpPath = "{0}.{1}".format(self._cachePath, os.getpid())
+        openedFile = open(tmpPath, "wb")
+        marshal.dump({"version": MachineTemplateRegistry.CACHE_VERSION, "templates": entries}, openedFile)
+        openedFile.close()
+        os.rename(tmpPath, self._cachePath)
+      except Exception as e:
+        REGISTRYLOGGER.debug("Unable to save compiled templates in '{0}': {1}".format(self._cachePath, str(e)))
+
+    def getTemplateDirs(self):
+      return self._templateDirs
+
+    def setWatched(self, watched):
+      self._watched = watched
+      self._templates = None
+
+    @staticmethod
+    def isTemplateFile(f):
+      return os.path.isfile(f) and os.path.splitext(os.path.basename(f))[1] == ".template"
+
+    # ##
+    # Function loading a template from the memory, the cache or its file
+    # The cache file is read on first need and kept in the given mapping
+    # Returns the cache entry of the template and the template
+    # ##
+    def loadTemplate(self, f, cache):
+      # Imported here as the core module relies on the registries
+      from machination.core import MachineTemplate
+      stat = os.stat(f)
+      (entry, template) = self._loaded.get(f, (None, None))
+      if entry != None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        return (entry, template)
+      if "entries" not in cache.keys():
+        cache["entries"] = self.loadCache()
+      entry = cache["entries"].get(f, None)
+      if entry != None and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+        template = MachineTemplate.fromCompiled(entry["template"])
+        REGISTRYLOGGER.debug("Template stored in '{0}' loaded from cache".format(f))
+      else:
+        openedFile = open(os.path.join(f), "r")
+        template = yaml.load(openedFile)
+        openedFile.close()
+        entry = {"mtime": stat.st_mtime, "size": stat.st_size, "template": template.toCompiled()}
+        REGISTRYLOGGER.debug("Template stored in '{0}' loaded".format(f))
+      return (entry, template)
+
+    # ##
+    # Function keeping the loaded templates, the cache file is written when they changed
+    # ##
+    def setLoaded(self, loaded, cache):
+      entries = dict((f, entry) for (f, (entry, template)) in loaded.items())
+      if ("entries" in cache.keys() and entries != cache["entries"]) or set(loaded.keys()) != set(self._loaded.keys()):
+        self.saveCache(entries)
+      self._loaded = loaded
+      self._templates = dict(("{0}:{1}".format(t.getName(), t.getVersion()), t) for (entry, t) in loaded.values())
+
     def getTemplates(self):
-      machineTemplates = {}
+      if self._watched and self._templates != None:
+        return dict(self._templates)
+      cache = {}
+      loaded = {}
       for d in self._templateDirs:
-        files = listPath(d)
-        for f in files:
-          if os.path.isfile(f) and  os.path.splitext(os.path.basename(f))[1] == ".template":
+        for f in listPath(d):
+          if MachineTemplateRegistry.isTemplateFile(f):
             try:
-              openedFile = open(os.path.join(f), "r")
-              template = yaml.load(openedFile)
-              machineTemplates["{0}:{1}".format(template.getName(),template.getVersion())] = template
-              REGISTRYLOGGER.debug("Template stored in '{0}' loaded".format(f))
+              loaded[f] = self.loadTemplate(f, cache)
             except Exception as e:
               REGISTRYLOGGER.warning("Unable to load template stored in '{0}: {1}".format(f,str(e)))
               REGISTRYLOGGER.debug(traceback.format_exc())
-      return machineTemplates
+      self.setLoaded(loaded, cache)
+      return dict(self._templates)
+
+    # ##
+    # Function updating the templates from change events
+    # ##
+    def applyChanges(self, events):
+      if self._templates == None:
+        return
+      cache = {}
+      loaded = dict(self._loaded)
+      for e in events:
+        if e.getKind() != TEMPLATE_CHANGE:
+          continue
+        if e.isRescan():
+          self._templates = None
+          return
+        loaded.pop(e.getPath(), None)
+        if e.getAction() != "removed" and MachineTemplateRegistry.isTemplateFile(e.getPath()):
+          try:
+            loaded[e.getPath()] = self.loadTemplate(e.getPath(), cache)
+          except Exception as ex:
+            REGISTRYLOGGER.warning("Unable to load template stored in '{0}: {1}".format(e.getPath(),str(ex)))
+            REGISTRYLOGGER.debug(traceback.format_exc())
+      self.setLoaded(loaded, cache)
+
+    # ##
+    # Function to check every template file and report all the errors found
+    # ##
+    def validate(self):
+      errors = []
+      for d in self._templateDirs:
+        for f in sorted(listPath(d)):
+          if os.path.isfile(f) and  os.path.splitext(os.path.basename(f))[1] == ".template":
+            try:
+              openedFile = open(f, "r")
+              template = yaml.load(openedFile, Loader=TrustedLoader)
+              openedFile.close()
+              errors.extend(template.validate())
+            except Exception as e:
+              errors.append("{0}: {1}".format(f, str(e)))
+              REGISTRYLOGGER.debug(traceback.format_exc())
+      return errors
+
+# ##
+# Class giving access to the ansible roles
+# Roles are searched in the given directories in order. When the registry is watched, the directory,
+# the dependencies and the hash of a role are kept until the role changes.
+# ##
+class RoleRegistry():
+  _roleDirs = None
+  _roles = None
+  _watched = False
+
+  def __init__(self, roleDirs):
+    self._roleDirs = roleDirs
+    self._roles = {}
+
+  def getRoleDirs(self):
+    return self._roleDirs
+
+  def setWatched(self, watched):
+    self._watched = watched
+    self._roles = {}
+
+  def getRoleInfo(self, role, key, function):
+    if not self._watched:
+      return function(role)
+    infos = self._roles.get(role, None)
+    if infos == None:
+      infos = {}
+      self._roles[role] = infos
+    if key not in infos.keys():
+      infos[key] = function(role)
+    return infos[key]
+
+  def findRoleDir(self, role):
+    for d in self._roleDirs:
+      if os.path.exists(os.path.join(d, role)):
+        return os.path.join(d, role)
+    raise InvalidMachineTemplateException("Unable to find ansible role '{0}'.".format(role))
+
+  def readDependencies(self, role):
+    dependencies = []
+    metaPath = os.path.join(self.getRoleDir(role), "meta", "main.yml")
+    if os.path.exists(metaPath):
+      openedFile = open(metaPath)
+      metas = yaml.load(openedFile)
+      openedFile.close()
+      if metas != None and "dependencies" in metas.keys():
+        for r in metas["dependencies"]:
+          if "role" in r.keys():
+            dependencies.append(r["role"])
+    return dependencies
+
+  def getRoleDir(self, role):
+    return self.getRoleInfo(role, "dir", self.findRoleDir)
+
+  def getDependencies(self, role):
+    return self.getRoleInfo(role, "dependencies", self.readDependencies)
+
+  def getHash(self, role):
+    return self.getRoleInfo(role, "hash", lambda r: hashDirectory(self.getRoleDir(r)))
+
+  # ##
+  # Function forgetting the roles that changed
+  # ##
+  def applyChanges(self, events):
+    roles = dict(self._roles)
+    for e in events:
+      if e.getKind() != ROLE_CHANGE:
+        continue
+      if e.isRescan():
+        roles = {}
+        break
+      roles.pop(e.getName(), None)
+      REGISTRYLOGGER.debug("Role '{0}' changed".format(e.getName()))
+    self._roles = roles
@@ -0,0 +1,143 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import json
+import socket
+
+from machination.exceptions import DaemonException
+from machination.constants import MACHINATION_DAEMONSOCKET
+
+RPC_VERSION = 1
+# Time given to the peer to send a message, in seconds
+RPC_TIMEOUT = 10
+# Commands served by the daemon, the other ones need a terminal or run for long and are executed in-process
+DAEMON_COMMANDS = ("list", "infos", "check", "version")
+
+# ##
+# Protocol between the machination command and the daemon
+# Messages are JSON objects, one per line. The client sends the arguments of the command and its
+# working directory, the daemon answers with the output of the command and ends with its exit code:
+#   {"version": 1, "argv": ["list", "instances"], "cwd": "/home/user"}
+#   {"stream": "stdout", "output": "Machine instances:\n"}
+#   {"exit": 0}
+# ##
+def sendMessage(sock, message):
+  sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+
+class MessageReader:
+  _sock = None
+  _buffer = None
+
+  def __init__(self, sock):
+    self._sock = sock
+    self._buffer = b""
+
+  # ##
+  # Returns the next message or None when the peer closed the connection
+  # ##
+  def read(self):
+    while b"\n" not in self._buffer:
+      data = self._sock.recv(65536)
+      if not data:
+        return None
+      self._buffer += data
+    (line, self._buffer) = self._buffer.split(b"\n", 1)
+    try:
+      message = json.loads(line.decode("utf-8"))
+    except ValueError as e:
+      raise DaemonException("Invalid message received: {0}".format(str(e)))
+    if type(message) is not dict:
+      raise DaemonException("Invalid message received: {0}".format(message))
+    return message
+
+# ##
+# Check if a command line can be sent to the daemon
+# ##
+def isServedByDaemon(argv):
+  if os.getenv("MACHINATION_NO_DAEMON", "") != "" or os.getenv("_ARGCOMPLETE", "") != "":
+    return False
+  for a in argv[1:]:
+    if not a.startswith("-"):
+      return a in DAEMON_COMMANDS
+  return False
+
+# ##
+# Client sending commands to the daemon
+# ##
+class DaemonClient:
+  _socketPath = None
+
+  def __init__(self, socketPath=MACHINATION_DAEMONSOCKET):
+    self._socketPath = socketPath
+
+  def getSocketPath(self):
+    return self._socketPath
+
+  # ##
+  # Returns a socket connected to the daemon or None if no daemon is listening
+  # ##
+  def connect(self):
+    if not os.path.exists(self._socketPath):
+      return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self._socketPath)
+    except socket.error:
+      sock.close()
+      return None
+    return sock
+
+  def isRunning(self):
+    sock = self.connect()
+    if sock == None:
+      return False
+    sock.close()
+    return True
+
+  # ##
+  # Run a command in the daemon, its output is written in the given streams
+  # Returns the exit code of the command or None if no daemon could run it
+  # ##
+  def run(self, argv, streams):
+    sock = self.connect()
+    if sock == None:
+      return None
+    try:
+      sendMessage(sock, {"version": RPC_VERSION, "argv": list(argv[1:]), "cwd": os.getcwd()})
+      reader = MessageReader(sock)
+      while True:
+        message = reader.read()
+        if message == None:
+          raise DaemonException("Connection to the daemon lost")
+        if "output" in message.keys():
+          output = message["output"]
+          if not isinstance(output, str):
+            output = output.encode("utf-8")
+          stream = streams.get(message.get("stream", "stdout"), streams["stdout"])
+          stream.write(output)
+          stream.flush()
+        elif "exit" in message.keys():
+          return message["exit"]
+        elif "error" in message.keys():
+          # The daemon refused the request, e.g. it runs another version
+          return None
+    except socket.error as e:
+      raise DaemonException("Connection to the daemon lost: {0}".format(str(e)))
+    finally:
+      sock.close()
@@ -0,0 +1,67 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import yaml
+import traceback
+
+from machination.loggers import CORELOGGER
+
+# ##
+# Class giving access to the user settings
+# Settings are stored as a YAML mapping in the user directory and loaded on first access,
+# they are loaded again when the file changes
+# ##
+class Settings:
+  _path = None
+  _values = None
+  _mtime = None
+
+  def __init__(self, path):
+    self._path = path
+    self._values = None
+
+  def getPath(self):
+    return self._path
+
+  def getModificationTime(self):
+    try:
+      return os.stat(self._path).st_mtime
+    except OSError:
+      return None
+
+  def load(self):
+    self._values = {}
+    self._mtime = self.getModificationTime()
+    if os.path.exists(self._path):
+      try:
+        openedFile = open(self._path, "r")
+        values = yaml.safe_load(openedFile)
+        openedFile.close()
+        if type(values) is dict:
+          self._values = values
+        else:
+          CORELOGGER.warning("Settings stored in '{0}' are not a mapping, they are ignored".format(self._path))
+      except Exception as e:
+        CORELOGGER.warning("Unable to load settings stored in '{0}': {1}".format(self._path, str(e)))
+        CORELOGGER.debug(traceback.format_exc())
+
+  def get(self, key, default=None):
+    if self._values == None or self._mtime != self.getModificationTime():
+      self.load()
+    return self._values.get(key, default)
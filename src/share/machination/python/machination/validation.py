@@ -0,0 +1,119 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import re
+import yaml
+
+from machination.exceptions import ValidationException
+
+# ##
+# Rule checking one value of an object
+# Regexes are compiled when the rule is declared, not when a value is checked
+# ##
+class Rule:
+  _name = None
+  _types = None
+  _pattern = None
+  _elementTypes = None
+  _nonEmpty = False
+  _allowNone = False
+  _check = None
+  _checkMessage = None
+
+  def __init__(self, name, types=None, pattern=None, elementTypes=None, nonEmpty=False, allowNone=False, check=None, checkMessage="is invalid"):
+    self._name = name
+    self._types = types
+    if pattern != None:
+      self._pattern = re.compile(pattern)
+    self._elementTypes = elementTypes
+    self._nonEmpty = nonEmpty
+    self._allowNone = allowNone
+    self._check = check
+    self._checkMessage = checkMessage
+
+  def getName(self):
+    return self._name
+
+  # ##
+  # Returns the list of errors found for the given value
+  # ##
+  def validate(self, value):
+    if value == None:
+      if self._allowNone:
+        return []
+      return ["{0} is missing".format(self._name)]
+    if self._types != None and not isinstance(value, self._types):
+      return ["{0} has an invalid type ({1})".format(self._name, type(value).__name__)]
+    if self._nonEmpty and len(value) == 0:
+      return ["{0} is empty".format(self._name)]
+    if self._pattern != None and self._pattern.match(value) == None:
+      return ["{0} is invalid: {1}".format(self._name, value)]
+    errors = []
+    if self._elementTypes != None:
+      for e in value:
+        if not isinstance(e, self._elementTypes):
+          errors.append("{0} contains an invalid element: {1}".format(self._name, e))
+    if len(errors) == 0 and self._check != None and not self._check(value):
+      errors.append("{0} {1}: {2}".format(self._name, self._checkMessage, value))
+    return errors
+
+# ##
+# Set of rules describing an object
+# ##
+class Schema:
+  _name = None
+  _rules = None
+
+  def __init__(self, name, rules):
+    self._name = name
+    self._rules = rules
+
+  def getName(self):
+    return self._name
+
+  # ##
+  # Check every rule against the given values and returns all the errors found
+  # ##
+  def validate(self, values, context=None):
+    prefix = ""
+    if context != None:
+      prefix = "{0}: ".format(context)
+    errors = []
+    for r in self._rules:
+      for e in r.validate(values.get(r.getName(), None)):
+        errors.append(prefix + e)
+    return errors
+
+  # ##
+  # Raise an exception listing all the errors found in the given values
+  # ##
+  def check(self, values, context=None):
+    errors = self.validate(values, context)
+    if len(errors) != 0:
+      raise ValidationException("Invalid {0}".format(self._name), errors)
+
+# ##
+# YAML loader marking the loaded data as trusted
+# Objects created through this loader do not run their validation, it is meant for
+# data that have already been validated or that are validated afterwards in batch
+# ##
+class TrustedLoader(yaml.Loader):
+  trusted = True
+
+def isTrusted(loader):
+  return getattr(loader, "trusted", False)
@@ -0,0 +1,325 @@
+##########################################################################
+# Machination
+# Copyright (c) 2014, Alexandre ACEBEDO, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+##########################################################################
+
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import traceback
+from abc import abstractmethod
+
+from machination.exceptions import WatcherException
+from machination.loggers import REGISTRYLOGGER
+
+TEMPLATE_CHANGE = "template"
+INSTANCE_CHANGE = "instance"
+ROLE_CHANGE = "role"
+
+# Time without any change after which the pending events are emitted, in seconds
+WATCH_DEBOUNCE_DELAY = 0.2
+# Longest time the events are held during a burst of changes, in seconds
+WATCH_DEBOUNCE_MAX_DELAY = 2
+# Interval between two scans of the polling watcher, in seconds
+WATCH_POLL_INTERVAL = 2
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# ##
+# Change of a template, an instance or a role
+# The name is the one of the entry directly under the watched directory (template file, instance or role directory),
+# the action is "changed", "removed" or "rescan" when the changes of the whole directory are unknown
+# ##
+class ChangeEvent:
+  _kind = None
+  _name = None
+  _path = None
+  _action = None
+
+  def __init__(self, kind, name, path, action):
+    self._kind = kind
+    self._name = name
+    self._path = path
+    self._action = action
+
+  def getKind(self):
+    return self._kind
+
+  def getName(self):
+    return self._name
+
+  def getPath(self):
+    return self._path
+
+  def getAction(self):
+    return self._action
+
+  def isRescan(self):
+    return self._action == "rescan"
+
+  def __str__(self):
+    return "{0} {1} {2}".format(self._kind, self._name or self._path, self._action)
+
+# ##
+# Thread watching directories and emitting change events to its listeners
+# Roots are given as (kind, path, depth) where depth is the number of levels watched under the path,
+# None for the whole tree. Changes are grouped by entry and emitted once no change happened for
+# WATCH_DEBOUNCE_DELAY so that a burst, like the copy of a role tree, gives one event per entry.
+# ##
+class Watcher(threading.Thread):
+  _roots = None
+  _listeners = None
+
+  def __init__(self, roots):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._roots = roots
+    self._listeners = []
+
+  def addListener(self, listener):
+    self._listeners.append(listener)
+
+  # ##
+  # Function waiting for changes at most timeout seconds (forever if None)
+  # Returns the changed paths as (root, path) pairs, path is None when the whole root shall be scanned again
+  # ##
+  @abstractmethod
+  def waitChanges(self, timeout):
+    pass
+
+  def getEntry(self, root, path):
+    (kind, rootPath, depth) = root
+    relPath = os.path.relpath(path, rootPath)
+    if relPath == "." or relPath.startswith(".."):
+      return None
+    name = relPath.split(os.sep)[0]
+    return (kind, name, os.path.join(rootPath, name))
+
+  def dispatch(self, pending):
+    events = []
+    for (kind, name, path) in sorted(pending):
+      if name == None:
+        events.append(ChangeEvent(kind, None, path, "rescan"))
+      elif os.path.exists(path):
+        events.append(ChangeEvent(kind, name, path, "changed"))
+      else:
+        events.append(ChangeEvent(kind, name, path, "removed"))
+    REGISTRYLOGGER.debug("Changes: {0}".format(", ".join([str(e) for e in events])))
+    for listener in self._listeners:
+      try:
+        listener(events)
+      except Exception as e:
+        REGISTRYLOGGER.warning("Unable to apply changes: {0}".format(str(e)))
+        REGISTRYLOGGER.debug(traceback.format_exc())
+
+  def run(self):
+    pending = set()
+    first = None
+    last = None
+    while True:
+      timeout = None
+      if len(pending) != 0:
+        timeout = max(0, min(last + WATCH_DEBOUNCE_DELAY, first + WATCH_DEBOUNCE_MAX_DELAY) - time.time())
+      try:
+        changes = self.waitChanges(timeout)
+      except Exception as e:
+        REGISTRYLOGGER.warning("Unable to watch changes: {0}".format(str(e)))
+        REGISTRYLOGGER.debug(traceback.format_exc())
+        changes = [(r, None) for r in self._roots]
+        time.sleep(WATCH_POLL_INTERVAL)
+      now = time.time()
+      for (root, path) in changes:
+        if path == None:
+          pending.add((root[0], None, root[1]))
+        else:
+          entry = self.getEntry(root, path)
+          if entry == None:
+            pending.add((root[0], None, root[1]))
+          else:
+            pending.add(entry)
+        if first == None:
+          first = now
+        last = now
+      if len(pending) != 0 and now >= min(last + WATCH_DEBOUNCE_DELAY, first + WATCH_DEBOUNCE_MAX_DELAY):
+        self.dispatch(pending)
+        pending = set()
+        first = None
+
+# ##
+# Watcher relying on inotify, directories are watched up to the depth of their root
+# ##
+class InotifyWatcher(Watcher):
+  _libc = None
+  _fd = None
+  _watches = None
+
+  def __init__(self, roots):
+    Watcher.__init__(self, roots)
+    libraryName = ctypes.util.find_library("c")
+    if libraryName == None:
+      raise WatcherException("Unable to find the C library")
+    self._libc = ctypes.CDLL(libraryName, use_errno=True)
+    if not hasattr(self._libc, "inotify_init1"):
+      raise WatcherException("inotify is not available")
+    self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+    if self._fd < 0:
+      raise WatcherException("Unable to initialize inotify: {0}".format(os.strerror(ctypes.get_errno())))
+    self._watches = {}
+    for r in self._roots:
+      self.addWatch(r, r[1], 0)
+
+  def addWatch(self, root, path, level):
+    wd = self._libc.inotify_add_watch(self._fd, path.encode("utf-8"), INOTIFY_MASK | IN_ONLYDIR)
+    if wd < 0:
+      err = ctypes.get_errno()
+      if err == errno.ENOSPC:
+        raise WatcherException("Unable to watch '{0}': the limit of inotify watches is reached".format(path))
+      # The directory has been removed or is not a directory
+      return
+    self._watches[wd] = (root, path, level)
+    depth = root[2]
+    if depth == None or level + 1 < depth:
+      try:
+        names = os.listdir(path)
+      except OSError:
+        return
+      for name in names:
+        if os.path.isdir(os.path.join(path, name)) and not os.path.islink(os.path.join(path, name)):
+          self.addWatch(root, os.path.join(path, name), level + 1)
+
+  def waitChanges(self, timeout):
+    try:
+      (readable, writable, errors) = select.select([self._fd], [], [], timeout)
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+    if len(readable) == 0:
+      return []
+    data = os.read(self._fd, 65536)
+    changes = []
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+      (wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+      name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0")
+      if not isinstance(name, str):
+        name = name.decode("utf-8", "replace")
+      offset += INOTIFY_EVENT.size + length
+      if mask & IN_Q_OVERFLOW:
+        REGISTRYLOGGER.debug("inotify queue overflowed, watched directories are scanned again")
+        changes.extend([(r, None) for r in self._roots])
+        continue
+      if wd not in self._watches.keys():
+        continue
+      (root, path, level) = self._watches[wd]
+      if mask & IN_IGNORED:
+        del self._watches[wd]
+        continue
+      if mask & IN_MOVE_SELF:
+        # The directory now lives elsewhere, its changes are not related to the root anymore
+        self._libc.inotify_rm_watch(self._fd, wd)
+      if len(name) != 0:
+        path = os.path.join(path, name)
+        depth = root[2]
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and (depth == None or level + 1 < depth):
+          self.addWatch(root, path, level + 1)
+      elif level == 0:
+        # The root itself has been removed or moved
+        changes.append((root, None))
+        continue
+      changes.append((root, path))
+    return changes
+
+# ##
+# Watcher comparing the modification times of the entries at each scan
+# Used when inotify is not available
+# ##
+class PollingWatcher(Watcher):
+  _snapshots = None
+  _nextScan = 0
+
+  def __init__(self, roots):
+    Watcher.__init__(self, roots)
+    self._snapshots = [self.scan(r) for r in self._roots]
+    self._nextScan = time.time() + WATCH_POLL_INTERVAL
+
+  def scan(self, root):
+    (kind, rootPath, depth) = root
+    entries = {}
+    for (d, dirs, files) in os.walk(rootPath):
+      level = 0
+      if d != rootPath:
+        level = os.path.relpath(d, rootPath).count(os.sep) + 1
+      for name in dirs + files:
+        try:
+          stat = os.lstat(os.path.join(d, name))
+          entries[os.path.join(d, name)] = (stat.st_mtime, stat.st_size)
+        except OSError:
+          pass
+      if depth != None and level + 1 >= depth:
+        del dirs[:]
+    return entries
+
+  def waitChanges(self, timeout):
+    delay = max(0, self._nextScan - time.time())
+    if timeout != None and timeout < delay:
+      time.sleep(timeout)
+      return []
+    time.sleep(delay)
+    self._nextScan = time.time() + WATCH_POLL_INTERVAL
+    changes = []
+    for (idx, r) in enumerate(self._roots):
+      snapshot = self.scan(r)
+      previous = self._snapshots[idx]
+      for path in set(snapshot.keys()) ^ set(previous.keys()):
+        changes.append((r, path))
+      for path in set(snapshot.keys()) & set(previous.keys()):
+        if snapshot[path] != previous[path]:
+          changes.append((r, path))
+      self._snapshots[idx] = snapshot
+    return changes
+
+# ##
+# Function returning an inotify watcher or a polling one when inotify cannot be used
+# ##
+def createWatcher(roots, polling=False):
+  if not polling:
+    try:
+      return InotifyWatcher(roots)
+    except (WatcherException, OSError) as e:
+      REGISTRYLOGGER.warning("Unable to use inotify, changes are polled: {0}".format(str(e)))
+      REGISTRYLOGGER.debug(traceback.format_exc())
+  return PollingWatcher(roots)